@@ -71,61 +71,62 @@ INSERT INTO categories (name) VALUES
 SELECT setval(pg_get_serial_sequence('categories', 'category_id'), (SELECT MAX(category_id) FROM categories));
 
 -- location 資料插入
-INSERT INTO location (location_name, city, district, street, number) VALUES 
+-- 座標是大概的位置（找附近的物品用）
+INSERT INTO location (location_name, city, district, street, number, lat, lon) VALUES 
 -- 新竹區 (交大/清大周邊)
-('交大光復校區', '新竹市', '東區', '大學路', '1001號'),
-('清華大學', '新竹市', '東區', '光復路二段', '101號'),
-('交大土地公廟', '新竹市', '東區', '大學路', '50號'),
-('清大夜市 (清夜)', '新竹市', '東區', '建功路', '20號'),
-('金山街商圈', '新竹市', '東區', '金山街', '30號'),
-('交大博愛校區', '新竹市', '東區', '大學路', '1號'),
-('愛買新竹店', '新竹市', '東區', '公道五路二段', '469號'),
-('好市多 (Costco)', '新竹市', '東區', '慈雲路', '182號'),
-('新竹馬偕醫院', '新竹市', '東區', '光復路二段', '295號'),
-('新竹火車站', '新竹市', '東區', '中華路二段', '445號'),
-('新竹高鐵站', '新竹縣', '竹北市', '高鐵七路', '6號'),
-('新竹巨城 (Big City)', '新竹市', '東區', '勝利路', '1號'),
-('晶品城購物廣場', '新竹市', '東區', '林森路', '18號'),
-('新竹大遠百', '新竹市', '北區', '西大路', '323號'),
-('竹北大遠百', '新竹縣', '竹北市', '莊敬北路', '18號'),
-('清大南大校區', '新竹市', '東區', '南大路', '521號'),
-('新莊車站', '新竹市', '東區', '新莊街', '120號'),
-('長春街口', '新竹市', '東區', '長春街', '55號'),
-('關新公園', '新竹市', '東區', '關新路', '19巷'),
-('迪卡儂新竹店', '新竹市', '東區', '埔頂路', '88號'),
+('交大光復校區', '新竹市', '東區', '大學路', '1001號', 24.7869, 120.9968),
+('清華大學', '新竹市', '東區', '光復路二段', '101號', 24.7961, 120.9967),
+('交大土地公廟', '新竹市', '東區', '大學路', '50號', 24.788, 120.999),
+('清大夜市 (清夜)', '新竹市', '東區', '建功路', '20號', 24.7936, 120.9925),
+('金山街商圈', '新竹市', '東區', '金山街', '30號', 24.7745, 121.018),
+('交大博愛校區', '新竹市', '東區', '大學路', '1號', 24.8012, 120.9836),
+('愛買新竹店', '新竹市', '東區', '公道五路二段', '469號', 24.8075, 120.992),
+('好市多 (Costco)', '新竹市', '東區', '慈雲路', '182號', 24.808, 121.002),
+('新竹馬偕醫院', '新竹市', '東區', '光復路二段', '295號', 24.7995, 120.992),
+('新竹火車站', '新竹市', '東區', '中華路二段', '445號', 24.8016, 120.9716),
+('新竹高鐵站', '新竹縣', '竹北市', '高鐵七路', '6號', 24.8082, 121.0402),
+('新竹巨城 (Big City)', '新竹市', '東區', '勝利路', '1號', 24.8097, 120.975),
+('晶品城購物廣場', '新竹市', '東區', '林森路', '18號', 24.799, 120.9705),
+('新竹大遠百', '新竹市', '北區', '西大路', '323號', 24.804, 120.965),
+('竹北大遠百', '新竹縣', '竹北市', '莊敬北路', '18號', 24.829, 121.012),
+('清大南大校區', '新竹市', '東區', '南大路', '521號', 24.794, 120.956),
+('新莊車站', '新竹市', '東區', '新莊街', '120號', 24.7873, 121.0225),
+('長春街口', '新竹市', '東區', '長春街', '55號', 24.784, 121.008),
+('關新公園', '新竹市', '東區', '關新路', '19巷', 24.782, 121.013),
+('迪卡儂新竹店', '新竹市', '東區', '埔頂路', '88號', 24.789, 121.018),
 -- 台北區
-('台灣大學', '台北市', '大安區', '羅斯福路四段', '1號'),
-('台北車站', '台北市', '中正區', '北平西路', '3號'),
-('台北101', '台北市', '信義區', '市府路', '45號'),
-('東區商圈', '台北市', '大安區', '忠孝東路四段', '200號'),
-('台北小巨蛋', '台北市', '松山區', '南京東路四段', '2號'),
-('東吳大學', '台北市', '士林區', '臨溪路', '70號'),
-('政治大學', '台北市', '文山區', '指南路二段', '64號'),
-('美麗華百樂園', '台北市', '中山區', '敬業三路', '20號'),
-('統一時代百貨', '台北市', '信義區', '忠孝東路五段', '8號'),
-('板橋大遠百', '新北市', '板橋區', '新站路', '28號'),
+('台灣大學', '台北市', '大安區', '羅斯福路四段', '1號', 25.0173, 121.5397),
+('台北車站', '台北市', '中正區', '北平西路', '3號', 25.0478, 121.517),
+('台北101', '台北市', '信義區', '市府路', '45號', 25.034, 121.5645),
+('東區商圈', '台北市', '大安區', '忠孝東路四段', '200號', 25.0415, 121.5505),
+('台北小巨蛋', '台北市', '松山區', '南京東路四段', '2號', 25.0517, 121.5498),
+('東吳大學', '台北市', '士林區', '臨溪路', '70號', 25.0951, 121.547),
+('政治大學', '台北市', '文山區', '指南路二段', '64號', 24.9866, 121.576),
+('美麗華百樂園', '台北市', '中山區', '敬業三路', '20號', 25.0834, 121.5575),
+('統一時代百貨', '台北市', '信義區', '忠孝東路五段', '8號', 25.0403, 121.566),
+('板橋大遠百', '新北市', '板橋區', '新站路', '28號', 25.013, 121.465),
 -- 台中區
-('東海大學', '台中市', '西屯區', '台灣大道四段', '1727號'),
-('中興大學', '台中市', '南區', '興大路', '145號'),
-('逢甲夜市', '台中市', '西屯區', '文華路', '100號'),
-('台中大遠百', '台中市', '西屯區', '台灣大道三段', '251號'),
-('中友百貨', '台中市', '北區', '三民路三段', '161號'),
-('勤美誠品', '台中市', '西區', '公益路', '68號'),
-('台中火車站', '台中市', '中區', '台灣大道一段', '1號'),
-('台中高鐵站', '台中市', '烏日區', '站區二路', '8號'),
-('秋紅谷', '台中市', '西屯區', '市政北七路', '77號'),
-('秀泰生活文心店', '台中市', '南屯區', '文心南路', '289號'),
+('東海大學', '台中市', '西屯區', '台灣大道四段', '1727號', 24.181, 120.601),
+('中興大學', '台中市', '南區', '興大路', '145號', 24.1215, 120.675),
+('逢甲夜市', '台中市', '西屯區', '文華路', '100號', 24.1745, 120.646),
+('台中大遠百', '台中市', '西屯區', '台灣大道三段', '251號', 24.165, 120.643),
+('中友百貨', '台中市', '北區', '三民路三段', '161號', 24.152, 120.685),
+('勤美誠品', '台中市', '西區', '公益路', '68號', 24.151, 120.663),
+('台中火車站', '台中市', '中區', '台灣大道一段', '1號', 24.1372, 120.6868),
+('台中高鐵站', '台中市', '烏日區', '站區二路', '8號', 24.112, 120.616),
+('秋紅谷', '台中市', '西屯區', '市政北七路', '77號', 24.168, 120.64),
+('秀泰生活文心店', '台中市', '南屯區', '文心南路', '289號', 24.133, 120.649),
 -- 台南/高雄區
-('成功大學', '台南市', '東區', '大學路', '1號'),
-('南紡購物中心', '台南市', '東區', '中華東路一段', '366號'),
-('新光三越新天地', '台南市', '中西區', '西門路一段', '658號'),
-('台南高鐵站', '台南市', '仁德區', '歸仁大道', '100號'),
-('中山大學', '高雄市', '鼓山區', '蓮海路', '70號'),
-('左營高鐵站', '高雄市', '左營區', '高鐵路', '105號'),
-('新光三越三多店', '高雄市', '前鎮區', '三多三路', '213號'),
-('大立百貨', '高雄市', '苓雅區', '五福三路', '57號'),
-('高雄科技大學', '高雄市', '三民區', '建工路', '415號'),
-('高雄大學', '高雄市', '楠梓區', '高雄大學路', '700號');
+('成功大學', '台南市', '東區', '大學路', '1號', 22.999, 120.22),
+('南紡購物中心', '台南市', '東區', '中華東路一段', '366號', 22.991, 120.233),
+('新光三越新天地', '台南市', '中西區', '西門路一段', '658號', 22.987, 120.198),
+('台南高鐵站', '台南市', '仁德區', '歸仁大道', '100號', 22.925, 120.286),
+('中山大學', '高雄市', '鼓山區', '蓮海路', '70號', 22.627, 120.266),
+('左營高鐵站', '高雄市', '左營區', '高鐵路', '105號', 22.687, 120.308),
+('新光三越三多店', '高雄市', '前鎮區', '三多三路', '213號', 22.614, 120.304),
+('大立百貨', '高雄市', '苓雅區', '五福三路', '57號', 22.621, 120.299),
+('高雄科技大學', '高雄市', '三民區', '建工路', '415號', 22.651, 120.328),
+('高雄大學', '高雄市', '楠梓區', '高雄大學路', '700號', 22.733, 120.286);
 
 SELECT setval(pg_get_serial_sequence('location', 'location_id'), (SELECT MAX(location_id) FROM location));
 
@@ -0,0 +1,78 @@
+-- 001: 全文搜尋
+-- 已經用舊版 schema.sql 建好的資料庫跑這個就好，新建的資料庫 schema.sql 裡面已經有了
+-- psql -d <DB_NAME> -f migrations/001_fulltext_search.sql
+
+-- 全文搜尋用的斷詞
+-- 中文沒有空白可以斷詞，所以中日文字切成「單字 + 相鄰兩字 (bigram)」，英文數字就照單字切
+-- 例如 '微積分課本' -> 微, 微積, 積, 積分, 分, 分課, 課, 課本, 本
+CREATE OR REPLACE FUNCTION cjk_tsvector(txt text) RETURNS tsvector AS $$
+DECLARE
+    run text;
+    lexemes text[] := '{}';
+    pos int := 0;
+    n int;
+BEGIN
+    FOR run IN
+        SELECT m[1]
+        FROM regexp_matches(lower(normalize(COALESCE(txt, ''), NFKC)), '([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff]+|[a-z0-9]+)', 'g') AS m
+    LOOP
+        IF run ~ '^[a-z0-9]' THEN
+            pos := pos + 1;
+            lexemes := lexemes || format('''%s'':%s', run, LEAST(pos, 16383));
+        ELSE
+            n := char_length(run);
+            FOR k IN 1..n LOOP
+                pos := pos + 1;
+                lexemes := lexemes || format('''%s'':%s', substr(run, k, 1), LEAST(pos, 16383));
+                IF k < n THEN
+                    lexemes := lexemes || format('''%s'':%s', substr(run, k, 2), LEAST(pos, 16383));
+                END IF;
+            END LOOP;
+        END IF;
+    END LOOP;
+
+    RETURN array_to_string(lexemes, ' ')::tsvector;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE PARALLEL SAFE;
+
+-- 搜尋字串轉成 tsquery：中文連續的 bigram 用 <-> 接起來（等於要求整段字連在一起出現），
+-- 英文單字用前綴比對，不同段之間用 & 連接；完全沒有可搜尋的字就回傳 NULL
+CREATE OR REPLACE FUNCTION cjk_tsquery(txt text) RETURNS tsquery AS $$
+DECLARE
+    run text;
+    parts text[] := '{}';
+    grams text[];
+    n int;
+BEGIN
+    FOR run IN
+        SELECT m[1]
+        FROM regexp_matches(lower(normalize(COALESCE(txt, ''), NFKC)), '([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff]+|[a-z0-9]+)', 'g') AS m
+    LOOP
+        IF run ~ '^[a-z0-9]' THEN
+            parts := parts || format('''%s'':*', run);
+        ELSE
+            n := char_length(run);
+            IF n = 1 THEN
+                parts := parts || format('''%s''', run);
+            ELSE
+                grams := '{}';
+                FOR k IN 1..n - 1 LOOP
+                    grams := grams || format('''%s''', substr(run, k, 2));
+                END LOOP;
+                parts := parts || ('(' || array_to_string(grams, ' <-> ') || ')');
+            END IF;
+        END IF;
+    END LOOP;
+
+    IF cardinality(parts) = 0 THEN
+        RETURN NULL;
+    END IF;
+    RETURN array_to_string(parts, ' & ')::tsquery;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE PARALLEL SAFE;
+
+ALTER TABLE post ADD COLUMN IF NOT EXISTS search_tsv tsvector GENERATED ALWAYS AS (cjk_tsvector(description)) STORED;
+ALTER TABLE item ADD COLUMN IF NOT EXISTS search_tsv tsvector GENERATED ALWAYS AS (cjk_tsvector(item_name)) STORED;
+
+CREATE INDEX IF NOT EXISTS item_search_idx ON item USING gin (search_tsv);
+CREATE INDEX IF NOT EXISTS post_search_idx ON post USING gin (search_tsv);
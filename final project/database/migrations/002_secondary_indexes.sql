@@ -0,0 +1,28 @@
+-- 002: 補上常用查詢的 index
+-- 用 CONCURRENTLY 建，不會擋住線上的寫入；不能包在 transaction 裡，直接用 psql -f 跑就好
+-- psql -d <DB_NAME> -f migrations/002_secondary_indexes.sql
+
+-- 常用查詢的 index（主鍵跟 username 以外的）
+-- item：trigger 跟每個 join 都用 post_id 找；partial index 只放還有庫存的，比較小
+CREATE INDEX CONCURRENTLY IF NOT EXISTS item_post_id_idx ON item (post_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS item_in_stock_post_idx ON item (post_id) WHERE quantity > 0;
+-- 物品模式的排序 / 分頁順序，有分類篩選時用第二個
+CREATE INDEX CONCURRENTLY IF NOT EXISTS item_browse_idx ON item (quantity DESC, post_id DESC, category_id, item_id) WHERE quantity > 0;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS item_category_browse_idx ON item (category_id, quantity DESC, post_id DESC, item_id) WHERE quantity > 0;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS item_location_id_idx ON item (location_id);
+-- post：個人頁面照時間列出自己的貼文；貼文模式只看還在進行中的
+CREATE INDEX CONCURRENTLY IF NOT EXISTS post_user_time_idx ON post (user_id, post_time DESC);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS post_available_idx ON post (post_id DESC) WHERE available;
+-- comment：一篇貼文的評價、某人有沒有評過這篇；user_id 給刪帳號的 cascade 用
+CREATE INDEX CONCURRENTLY IF NOT EXISTS comment_post_user_idx ON comment (post_id, user_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS comment_user_id_idx ON comment (user_id);
+-- trade：個人頁面的索取紀錄；item_id 給刪貼文的 cascade 用
+CREATE INDEX CONCURRENTLY IF NOT EXISTS trade_user_time_idx ON trade (user_id, trade_time DESC);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS trade_item_id_idx ON trade (item_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS phone_user_id_idx ON phone (user_id);
+
+ANALYZE item;
+ANALYZE post;
+ANALYZE comment;
+ANALYZE trade;
+ANALYZE phone;
@@ -0,0 +1,40 @@
+-- 003: 索取改成呼叫 claim_item()，一次完成檢查、扣庫存、寫 trade
+-- psql -d <DB_NAME> -f migrations/003_claim_item.sql
+
+-- 索取：檢查 + 扣庫存 + 寫 trade 一次做完，app 只要呼叫一次
+-- 先用 FOR UPDATE 鎖住 item 那一列，同時搶同一個東西的人會排隊，輪到的時候看到的就是最新的庫存，
+-- 不會超賣，也不用靠 CHECK (quantity >= 0) 失敗再 rollback
+-- 回傳的 status：ok / invalid_quantity / not_found / own_item / unavailable / insufficient
+CREATE OR REPLACE FUNCTION claim_item(p_user_id int, p_item_id int, p_quantity int)
+RETURNS TABLE (status text, item_name text, remaining int) AS $$
+#variable_conflict use_column
+DECLARE
+    target record;
+BEGIN
+    IF p_quantity IS NULL OR p_quantity <= 0 THEN
+        RETURN QUERY SELECT 'invalid_quantity'::text, NULL::text, NULL::int;
+        RETURN;
+    END IF;
+
+    SELECT i.item_name, i.quantity, p.user_id AS owner_id, p.available
+    INTO target
+    FROM item i JOIN post p ON p.post_id = i.post_id
+    WHERE i.item_id = p_item_id
+    FOR UPDATE OF i;
+
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'not_found'::text, NULL::text, NULL::int;
+    ELSIF target.owner_id = p_user_id THEN
+        RETURN QUERY SELECT 'own_item'::text, target.item_name, target.quantity;
+    ELSIF target.quantity = 0 OR NOT target.available THEN
+        RETURN QUERY SELECT 'unavailable'::text, target.item_name, target.quantity;
+    ELSIF target.quantity < p_quantity THEN
+        RETURN QUERY SELECT 'insufficient'::text, target.item_name, target.quantity;
+    ELSE
+        -- 扣庫存、更新 post.available 交給 trade 的 trigger
+        INSERT INTO trade (user_id, item_id, quantity, trade_time)
+        VALUES (p_user_id, p_item_id, p_quantity, NOW());
+        RETURN QUERY SELECT 'ok'::text, target.item_name, target.quantity - p_quantity;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,119 @@
+-- 004: 批次索取 claim_items()，trade 的 trigger 也要一起換成新版
+-- psql -d <DB_NAME> -f migrations/004_claim_items.sql
+
+CREATE OR REPLACE FUNCTION update_inventory() RETURNS TRIGGER AS $$
+DECLARE
+    target_post_id INT;
+    remaining_items INT;
+BEGIN
+    -- 找到 item 在哪個 post
+    SELECT post_id INTO target_post_id FROM item WHERE item_id = NEW.item_id;
+
+    -- 把 item 庫存減少
+    UPDATE item
+    SET quantity = quantity - NEW.quantity
+    WHERE item_id = NEW.item_id;
+
+    -- 批次索取 (claim_items) 會自己在最後每篇 post 檢查一次，這裡就不用每一列都算
+    IF COALESCE(current_setting('giveaway.batch_claim', true), '') = 'on' THEN
+        RETURN NEW;
+    END IF;
+
+    -- 檢查有沒有其他數量大於 0 的物品
+    SELECT COUNT(*) INTO remaining_items
+    FROM item
+    WHERE post_id = target_post_id
+    AND quantity > 0;
+
+    -- 如果物品數量都歸 0 了 -> post available = false
+    IF remaining_items = 0 THEN
+        UPDATE post
+        SET available = false
+        WHERE post_id = target_post_id;
+    END IF;
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 批次索取：一次拿好幾個物品，全部成功才算數，有一個不行就都不拿
+-- 每個物品回傳一列，status 跟 claim_item() 一樣；只要有一列不是 ok，整批都沒有寫入
+-- 同一個 item 出現好幾次會把數量加起來
+CREATE OR REPLACE FUNCTION claim_items(p_user_id int, p_item_ids int[], p_quantities int[])
+RETURNS TABLE (item_id int, status text, item_name text, remaining int) AS $$
+#variable_conflict use_column
+DECLARE
+    req record;
+    failed boolean := false;
+    ok_ids int[] := '{}';
+    ok_quantities int[] := '{}';
+    touched_posts int[] := '{}';
+BEGIN
+    IF cardinality(p_item_ids) IS DISTINCT FROM cardinality(p_quantities) THEN
+        RAISE EXCEPTION 'claim_items: item_ids 跟 quantities 長度不一樣';
+    END IF;
+
+    -- 照 item_id 的順序上鎖，兩個人同時批次索取重疊的物品也不會 deadlock
+    FOR req IN
+        WITH wanted AS (
+            SELECT w.item_id,
+                   SUM(w.quantity)::int AS quantity,
+                   bool_or(w.quantity IS NULL OR w.quantity <= 0) AS bad_quantity
+            FROM unnest(p_item_ids, p_quantities) AS w(item_id, quantity)
+            GROUP BY w.item_id
+        ), locked AS (
+            SELECT i.item_id, i.post_id, i.item_name, i.quantity, p.user_id AS owner_id, p.available
+            FROM item i JOIN post p ON p.post_id = i.post_id
+            WHERE i.item_id IN (SELECT w.item_id FROM wanted w)
+            ORDER BY i.item_id
+            FOR UPDATE OF i
+        )
+        SELECT w.item_id, w.quantity AS want, w.bad_quantity,
+               l.item_id IS NOT NULL AS found, l.post_id, l.item_name, l.quantity, l.owner_id, l.available
+        FROM wanted w LEFT JOIN locked l ON l.item_id = w.item_id
+        ORDER BY w.item_id
+    LOOP
+        item_id := req.item_id;
+        item_name := req.item_name;
+        remaining := req.quantity;
+
+        IF req.bad_quantity THEN
+            status := 'invalid_quantity';
+        ELSIF NOT req.found THEN
+            status := 'not_found';
+        ELSIF req.owner_id = p_user_id THEN
+            status := 'own_item';
+        ELSIF req.quantity = 0 OR NOT req.available THEN
+            status := 'unavailable';
+        ELSIF req.quantity < req.want THEN
+            status := 'insufficient';
+        ELSE
+            status := 'ok';
+            remaining := req.quantity - req.want;
+            ok_ids := ok_ids || req.item_id;
+            ok_quantities := ok_quantities || req.want;
+            touched_posts := touched_posts || req.post_id;
+        END IF;
+
+        failed := failed OR status <> 'ok';
+        RETURN NEXT;
+    END LOOP;
+
+    IF failed OR cardinality(ok_ids) = 0 THEN
+        RETURN;
+    END IF;
+
+    -- trade 的 trigger 還是會一列一列扣庫存，但先跳過「檢查 post 還有沒有東西」那段
+    PERFORM set_config('giveaway.batch_claim', 'on', true);
+    INSERT INTO trade (user_id, item_id, quantity, trade_time)
+    SELECT p_user_id, t.item_id, t.quantity, NOW()
+    FROM unnest(ok_ids, ok_quantities) AS t(item_id, quantity);
+    PERFORM set_config('giveaway.batch_claim', 'off', true);
+
+    -- 每篇 post 只檢查一次：都拿完了就結案
+    UPDATE post p
+    SET available = false
+    WHERE p.post_id = ANY(touched_posts)
+    AND NOT EXISTS (SELECT 1 FROM item i WHERE i.post_id = p.post_id AND i.quantity > 0);
+END;
+$$ LANGUAGE plpgsql;
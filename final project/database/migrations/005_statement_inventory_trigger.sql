@@ -0,0 +1,143 @@
+-- 005: trade 的 trigger 從 FOR EACH ROW 換成 FOR EACH STATEMENT
+-- 一次 INSERT 很多筆 trade（例如匯入舊資料）時，不用每一筆都重算一次整篇 post
+-- psql -d <DB_NAME> -f migrations/005_statement_inventory_trigger.sql
+
+BEGIN;
+
+-- 舊版的 trigger function：每一筆 trade 都查一次 post、扣一次庫存、數一次 post 剩幾個物品
+-- 已經換成下面 statement-level 的版本，留著給 tools/compare_inventory_triggers.py 對照用
+CREATE OR REPLACE FUNCTION update_inventory() RETURNS TRIGGER AS $$
+DECLARE
+    target_post_id INT;
+    remaining_items INT;
+BEGIN
+    -- 找到 item 在哪個 post
+    SELECT post_id INTO target_post_id FROM item WHERE item_id = NEW.item_id;
+
+    -- 把 item 庫存減少
+    UPDATE item
+    SET quantity = quantity - NEW.quantity
+    WHERE item_id = NEW.item_id;
+
+    -- 檢查有沒有其他數量大於 0 的物品
+    SELECT COUNT(*) INTO remaining_items
+    FROM item
+    WHERE post_id = target_post_id
+    AND quantity > 0;
+
+    -- 如果物品數量都歸 0 了 -> post available = false
+    IF remaining_items = 0 THEN
+        UPDATE post
+        SET available = false
+        WHERE post_id = target_post_id;
+    END IF;
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 扣庫存：一個 INSERT 不管塞幾筆 trade 只跑一次
+-- new_trades 是這次 INSERT 進來的所有 trade，同一個 item 的數量先加總再一次扣，
+-- 再對有動到的 post 各檢查一次還有沒有庫存，結果跟舊版一列一列做一樣
+CREATE OR REPLACE FUNCTION update_inventory_batch() RETURNS TRIGGER AS $$
+BEGIN
+    -- 照 item_id 順序先鎖，跟 claim_items() 一樣，避免兩個大量匯入互相 deadlock
+    PERFORM 1 FROM item WHERE item_id IN (SELECT item_id FROM new_trades) ORDER BY item_id FOR UPDATE;
+
+    UPDATE item i
+    SET quantity = i.quantity - t.quantity
+    FROM (SELECT item_id, SUM(quantity) AS quantity FROM new_trades GROUP BY item_id) t
+    WHERE i.item_id = t.item_id;
+
+    -- 有動到的 post 各檢查一次，物品數量都歸 0 了 -> post available = false
+    UPDATE post p
+    SET available = false
+    WHERE p.post_id IN (SELECT i.post_id FROM item i WHERE i.item_id IN (SELECT item_id FROM new_trades))
+    AND NOT EXISTS (SELECT 1 FROM item i WHERE i.post_id = p.post_id AND i.quantity > 0);
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trade_insert_trigger ON trade;
+DROP TRIGGER IF EXISTS trade_inventory_trigger ON trade;
+CREATE TRIGGER trade_inventory_trigger
+AFTER INSERT ON trade
+REFERENCING NEW TABLE AS new_trades
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_inventory_batch();
+
+-- claim_items() 不用再自己處理 post.available 了
+-- 批次索取：一次拿好幾個物品，全部成功才算數，有一個不行就都不拿
+-- 每個物品回傳一列，status 跟 claim_item() 一樣；只要有一列不是 ok，整批都沒有寫入
+-- 同一個 item 出現好幾次會把數量加起來
+CREATE OR REPLACE FUNCTION claim_items(p_user_id int, p_item_ids int[], p_quantities int[])
+RETURNS TABLE (item_id int, status text, item_name text, remaining int) AS $$
+#variable_conflict use_column
+DECLARE
+    req record;
+    failed boolean := false;
+    ok_ids int[] := '{}';
+    ok_quantities int[] := '{}';
+BEGIN
+    IF cardinality(p_item_ids) IS DISTINCT FROM cardinality(p_quantities) THEN
+        RAISE EXCEPTION 'claim_items: item_ids 跟 quantities 長度不一樣';
+    END IF;
+
+    -- 照 item_id 的順序上鎖，兩個人同時批次索取重疊的物品也不會 deadlock
+    FOR req IN
+        WITH wanted AS (
+            SELECT w.item_id,
+                   SUM(w.quantity)::int AS quantity,
+                   bool_or(w.quantity IS NULL OR w.quantity <= 0) AS bad_quantity
+            FROM unnest(p_item_ids, p_quantities) AS w(item_id, quantity)
+            GROUP BY w.item_id
+        ), locked AS (
+            SELECT i.item_id, i.item_name, i.quantity, p.user_id AS owner_id, p.available
+            FROM item i JOIN post p ON p.post_id = i.post_id
+            WHERE i.item_id IN (SELECT w.item_id FROM wanted w)
+            ORDER BY i.item_id
+            FOR UPDATE OF i
+        )
+        SELECT w.item_id, w.quantity AS want, w.bad_quantity,
+               l.item_id IS NOT NULL AS found, l.item_name, l.quantity, l.owner_id, l.available
+        FROM wanted w LEFT JOIN locked l ON l.item_id = w.item_id
+        ORDER BY w.item_id
+    LOOP
+        item_id := req.item_id;
+        item_name := req.item_name;
+        remaining := req.quantity;
+
+        IF req.bad_quantity THEN
+            status := 'invalid_quantity';
+        ELSIF NOT req.found THEN
+            status := 'not_found';
+        ELSIF req.owner_id = p_user_id THEN
+            status := 'own_item';
+        ELSIF req.quantity = 0 OR NOT req.available THEN
+            status := 'unavailable';
+        ELSIF req.quantity < req.want THEN
+            status := 'insufficient';
+        ELSE
+            status := 'ok';
+            remaining := req.quantity - req.want;
+            ok_ids := ok_ids || req.item_id;
+            ok_quantities := ok_quantities || req.want;
+        END IF;
+
+        failed := failed OR status <> 'ok';
+        RETURN NEXT;
+    END LOOP;
+
+    IF failed OR cardinality(ok_ids) = 0 THEN
+        RETURN;
+    END IF;
+
+    -- 一句 INSERT 寫完，trade 的 trigger 會一次扣庫存，每篇 post 也只檢查一次
+    INSERT INTO trade (user_id, item_id, quantity, trade_time)
+    SELECT p_user_id, t.item_id, t.quantity, NOW()
+    FROM unnest(ok_ids, ok_quantities) AS t(item_id, quantity);
+END;
+$$ LANGUAGE plpgsql;
+
+COMMIT;
@@ -0,0 +1,186 @@
+-- 006: 庫存計數
+-- post 加上 remaining_quantity / remaining_items，另外加一張 category_stock 記每個分類還剩多少，
+-- 由 item 的 trigger 維護；最後從現有資料算一次初始值
+-- psql -d <DB_NAME> -f migrations/006_stock_counters.sql
+
+BEGIN;
+
+ALTER TABLE post ADD COLUMN IF NOT EXISTS remaining_quantity int NOT NULL DEFAULT 0;
+ALTER TABLE post ADD COLUMN IF NOT EXISTS remaining_items int NOT NULL DEFAULT 0;
+
+-- 每個分類還剩多少東西，首頁的總數直接從這裡加
+-- 同一個分類拆成 16 個 shard (item_id % 16)，不然同分類的索取都要搶同一列
+CREATE TABLE IF NOT EXISTS category_stock (
+	category_id int NOT NULL,
+	shard smallint NOT NULL,
+	remaining_quantity bigint NOT NULL DEFAULT 0,
+	remaining_items int NOT NULL DEFAULT 0,
+	PRIMARY KEY (category_id, shard),
+	FOREIGN KEY (category_id) references categories on delete cascade
+);
+
+-- 庫存計數：item 新增 / 修改 / 刪除時，跟著調整 post 跟 category_stock 上的數字
+-- 這樣判斷 post 還有沒有東西、首頁的總數都不用再去 COUNT / SUM 整張 item
+-- INSERT / UPDATE / DELETE 各綁一個 statement-level trigger，共用這個 function
+CREATE OR REPLACE FUNCTION update_stock_counters() RETURNS TRIGGER AS $$
+DECLARE
+    post_ids int[];
+    category_ids int[];
+    shards int[];
+    quantities int[];
+    item_counts int[];
+BEGIN
+    -- 先把這次動到的 item 換成「加多少、減多少」：新的列算正的，舊的列算負的
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(post_id), array_agg(category_id), array_agg(item_id % 16),
+               array_agg(quantity), array_agg((quantity > 0)::int)
+        INTO post_ids, category_ids, shards, quantities, item_counts
+        FROM new_items;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(post_id), array_agg(category_id), array_agg(item_id % 16),
+               array_agg(-quantity), array_agg(-(quantity > 0)::int)
+        INTO post_ids, category_ids, shards, quantities, item_counts
+        FROM old_items;
+    ELSE
+        SELECT array_agg(d.post_id), array_agg(d.category_id), array_agg(d.item_id % 16),
+               array_agg(d.quantity), array_agg(d.items)
+        INTO post_ids, category_ids, shards, quantities, item_counts
+        FROM (
+            SELECT post_id, category_id, item_id, quantity, (quantity > 0)::int AS items FROM new_items
+            UNION ALL
+            SELECT post_id, category_id, item_id, -quantity, -(quantity > 0)::int FROM old_items
+        ) d;
+    END IF;
+
+    IF post_ids IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    -- 照 post_id 順序先鎖，同時有好幾個 transaction 在改同一批 post 也不會 deadlock
+    PERFORM 1 FROM post WHERE post_id = ANY(post_ids) ORDER BY post_id FOR UPDATE;
+
+    -- 物品數量都歸 0 了 -> post available = false（跟以前一樣，不會自己變回 true）
+    UPDATE post p
+    SET remaining_quantity = p.remaining_quantity + d.quantity,
+        remaining_items = p.remaining_items + d.items,
+        available = p.available AND p.remaining_items + d.items > 0
+    FROM (
+        SELECT d.post_id, SUM(d.quantity) AS quantity, SUM(d.items) AS items
+        FROM unnest(post_ids, quantities, item_counts) AS d(post_id, quantity, items)
+        GROUP BY d.post_id
+    ) d
+    WHERE p.post_id = d.post_id
+    AND (d.quantity <> 0 OR d.items <> 0);
+
+    INSERT INTO category_stock AS cs (category_id, shard, remaining_quantity, remaining_items)
+    SELECT d.category_id, d.shard, SUM(d.quantity), SUM(d.items)
+    FROM unnest(category_ids, shards, quantities, item_counts) AS d(category_id, shard, quantity, items)
+    GROUP BY d.category_id, d.shard
+    HAVING SUM(d.quantity) <> 0 OR SUM(d.items) <> 0
+    ORDER BY d.category_id, d.shard
+    ON CONFLICT (category_id, shard) DO UPDATE
+    SET remaining_quantity = cs.remaining_quantity + EXCLUDED.remaining_quantity,
+        remaining_items = cs.remaining_items + EXCLUDED.remaining_items;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS item_stock_insert_trigger ON item;
+DROP TRIGGER IF EXISTS item_stock_update_trigger ON item;
+DROP TRIGGER IF EXISTS item_stock_delete_trigger ON item;
+
+CREATE TRIGGER item_stock_insert_trigger
+AFTER INSERT ON item
+REFERENCING NEW TABLE AS new_items
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_stock_counters();
+
+CREATE TRIGGER item_stock_update_trigger
+AFTER UPDATE ON item
+REFERENCING OLD TABLE AS old_items NEW TABLE AS new_items
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_stock_counters();
+
+CREATE TRIGGER item_stock_delete_trigger
+AFTER DELETE ON item
+REFERENCING OLD TABLE AS old_items
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_stock_counters();
+
+-- 扣庫存：一個 INSERT 不管塞幾筆 trade 只跑一次
+-- new_trades 是這次 INSERT 進來的所有 trade，同一個 item 的數量先加總再一次扣，
+-- 結案的判斷在 item 的 trigger 裡，每篇 post 只看一次計數，結果跟舊版一列一列做一樣
+CREATE OR REPLACE FUNCTION update_inventory_batch() RETURNS TRIGGER AS $$
+BEGIN
+    -- 照 item_id 順序先鎖，跟 claim_items() 一樣，避免兩個大量匯入互相 deadlock
+    PERFORM 1 FROM item WHERE item_id IN (SELECT item_id FROM new_trades) ORDER BY item_id FOR UPDATE;
+
+    -- post 的庫存計數、available 會由 item 的 trigger (update_stock_counters) 跟著更新
+    UPDATE item i
+    SET quantity = i.quantity - t.quantity
+    FROM (SELECT item_id, SUM(quantity) AS quantity FROM new_trades GROUP BY item_id) t
+    WHERE i.item_id = t.item_id;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 檢查計數有沒有跟 item 對不起來，回傳對不起來的 post / 分類（flask stock check 用）
+CREATE OR REPLACE FUNCTION stock_counter_drift()
+RETURNS TABLE (kind text, id int, counted_quantity bigint, actual_quantity bigint,
+               counted_items bigint, actual_items bigint) AS $$
+    WITH actual_post AS (
+        SELECT post_id, SUM(quantity) AS quantity, COUNT(*) FILTER (WHERE quantity > 0) AS items
+        FROM item GROUP BY post_id
+    ), actual_category AS (
+        SELECT category_id, SUM(quantity) AS quantity, COUNT(*) FILTER (WHERE quantity > 0) AS items
+        FROM item GROUP BY category_id
+    ), counted_category AS (
+        SELECT category_id, SUM(remaining_quantity) AS quantity, SUM(remaining_items) AS items
+        FROM category_stock GROUP BY category_id
+    )
+    SELECT 'post', p.post_id, p.remaining_quantity::bigint, COALESCE(a.quantity, 0),
+           p.remaining_items::bigint, COALESCE(a.items, 0)
+    FROM post p LEFT JOIN actual_post a ON a.post_id = p.post_id
+    WHERE (p.remaining_quantity, p.remaining_items) IS DISTINCT FROM (COALESCE(a.quantity, 0), COALESCE(a.items, 0))
+    UNION ALL
+    SELECT 'category', COALESCE(c.category_id, a.category_id), COALESCE(c.quantity, 0), COALESCE(a.quantity, 0),
+           COALESCE(c.items, 0), COALESCE(a.items, 0)
+    FROM counted_category c FULL JOIN actual_category a ON a.category_id = c.category_id
+    WHERE (COALESCE(c.quantity, 0), COALESCE(c.items, 0)) IS DISTINCT FROM (COALESCE(a.quantity, 0), COALESCE(a.items, 0))
+    ORDER BY 1, 2;
+$$ LANGUAGE sql STABLE;
+
+-- 從 item 重算所有計數，回傳修正了幾篇 post、幾個分類
+-- 過程中會鎖住 item 不讓別人寫（讀不影響），資料很多的話請挑沒人用的時候跑
+CREATE OR REPLACE FUNCTION rebuild_stock_counters(OUT fixed_posts int, OUT fixed_categories int) AS $$
+BEGIN
+    LOCK TABLE item IN SHARE MODE;
+    LOCK TABLE category_stock IN EXCLUSIVE MODE;
+
+    SELECT COUNT(*) FILTER (WHERE kind = 'category') INTO fixed_categories FROM stock_counter_drift();
+
+    UPDATE post p
+    SET remaining_quantity = COALESCE(a.quantity, 0),
+        remaining_items = COALESCE(a.items, 0)
+    FROM post p2
+    LEFT JOIN (
+        SELECT post_id, SUM(quantity) AS quantity, COUNT(*) FILTER (WHERE quantity > 0) AS items
+        FROM item GROUP BY post_id
+    ) a ON a.post_id = p2.post_id
+    WHERE p.post_id = p2.post_id
+    AND (p.remaining_quantity, p.remaining_items) IS DISTINCT FROM (COALESCE(a.quantity, 0), COALESCE(a.items, 0));
+    GET DIAGNOSTICS fixed_posts = ROW_COUNT;
+
+    DELETE FROM category_stock;
+    INSERT INTO category_stock (category_id, shard, remaining_quantity, remaining_items)
+    SELECT category_id, item_id % 16, SUM(quantity), COUNT(*) FILTER (WHERE quantity > 0)
+    FROM item
+    GROUP BY category_id, item_id % 16;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT * FROM rebuild_stock_counters();
+
+COMMIT;
@@ -0,0 +1,126 @@
+-- 007: 使用者評價改成存起來（user_reputation），comment 的 trigger 維護；最後從現有資料算一次初始值
+-- psql -d <DB_NAME> -f migrations/007_user_reputation.sql
+
+BEGIN;
+
+-- 每個使用者收到的評價（評在他貼文上的 comment），comment 的 trigger 維護
+-- 個人頁面、首頁發文者旁邊的分數直接讀這裡，不用每次 JOIN post、comment 再 AVG
+CREATE TABLE IF NOT EXISTS user_reputation (
+	user_id int NOT NULL,
+	rating_sum bigint NOT NULL DEFAULT 0,
+	rating_count int NOT NULL DEFAULT 0,
+	avg_rating numeric GENERATED ALWAYS AS (rating_sum::numeric / NULLIF(rating_count, 0)) STORED,
+	updated_at timestamp NOT NULL DEFAULT current_timestamp,
+	PRIMARY KEY (user_id),
+	FOREIGN KEY (user_id) references users on delete cascade
+);
+
+-- 評價計數：comment 新增 / 刪除時調整發文者的 user_reputation
+-- 整篇 post 被刪掉的時候，post 的 BEFORE DELETE trigger 會先把那篇的評價一次扣掉；
+-- 之後 cascade 刪 comment 時 post 已經不在了，JOIN 不到就不會重複扣
+CREATE OR REPLACE FUNCTION update_user_reputation() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO user_reputation AS r (user_id, rating_sum, rating_count)
+        SELECT p.user_id, SUM(c.rating), COUNT(*)
+        FROM new_comments c JOIN post p ON p.post_id = c.post_id
+        GROUP BY p.user_id
+        ORDER BY p.user_id
+        ON CONFLICT (user_id) DO UPDATE
+        SET rating_sum = r.rating_sum + EXCLUDED.rating_sum,
+            rating_count = r.rating_count + EXCLUDED.rating_count,
+            updated_at = current_timestamp;
+    ELSE
+        -- 只用 UPDATE：發文者可能正在被刪除，不能再 INSERT 一列回去
+        UPDATE user_reputation r
+        SET rating_sum = r.rating_sum - d.rating_sum,
+            rating_count = r.rating_count - d.rating_count,
+            updated_at = current_timestamp
+        FROM (
+            SELECT p.user_id, SUM(c.rating) AS rating_sum, COUNT(*) AS rating_count
+            FROM old_comments c JOIN post p ON p.post_id = c.post_id
+            GROUP BY p.user_id
+        ) d
+        WHERE r.user_id = d.user_id
+        AND EXISTS (SELECT 1 FROM users u WHERE u.user_id = r.user_id);
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS comment_reputation_insert_trigger ON comment;
+CREATE TRIGGER comment_reputation_insert_trigger
+AFTER INSERT ON comment
+REFERENCING NEW TABLE AS new_comments
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_user_reputation();
+
+DROP TRIGGER IF EXISTS comment_reputation_delete_trigger ON comment;
+CREATE TRIGGER comment_reputation_delete_trigger
+AFTER DELETE ON comment
+REFERENCING OLD TABLE AS old_comments
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_user_reputation();
+
+CREATE OR REPLACE FUNCTION remove_post_reputation() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE user_reputation r
+    SET rating_sum = r.rating_sum - d.rating_sum,
+        rating_count = r.rating_count - d.rating_count,
+        updated_at = current_timestamp
+    FROM (
+        SELECT SUM(rating) AS rating_sum, COUNT(*) AS rating_count
+        FROM comment
+        WHERE post_id = OLD.post_id
+    ) d
+    WHERE r.user_id = OLD.user_id
+    AND d.rating_count > 0
+    -- 整個使用者被刪掉時 users 那列已經不在了，user_reputation 等一下也會 cascade 刪掉，不用扣
+    -- （硬要 UPDATE 的話，同一個 transaction 裡第二次改到這列會觸發 FK 檢查而失敗）
+    AND EXISTS (SELECT 1 FROM users u WHERE u.user_id = r.user_id);
+
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS post_reputation_delete_trigger ON post;
+CREATE TRIGGER post_reputation_delete_trigger
+BEFORE DELETE ON post
+FOR EACH ROW
+EXECUTE FUNCTION remove_post_reputation();
+
+-- 檢查 user_reputation 有沒有跟 comment 對不起來（flask reputation check 用）
+CREATE OR REPLACE FUNCTION reputation_drift()
+RETURNS TABLE (user_id int, counted_sum bigint, actual_sum bigint, counted_count bigint, actual_count bigint) AS $$
+    WITH actual AS (
+        SELECT p.user_id, SUM(c.rating) AS rating_sum, COUNT(*) AS rating_count
+        FROM comment c JOIN post p ON p.post_id = c.post_id
+        GROUP BY p.user_id
+    )
+    SELECT COALESCE(r.user_id, a.user_id), COALESCE(r.rating_sum, 0), COALESCE(a.rating_sum, 0),
+           COALESCE(r.rating_count, 0)::bigint, COALESCE(a.rating_count, 0)
+    FROM user_reputation r FULL JOIN actual a ON a.user_id = r.user_id
+    WHERE (COALESCE(r.rating_sum, 0), COALESCE(r.rating_count, 0)) IS DISTINCT FROM (COALESCE(a.rating_sum, 0), COALESCE(a.rating_count, 0))
+    ORDER BY 1;
+$$ LANGUAGE sql STABLE;
+
+-- 從 comment 重算所有人的評價，回傳修正了幾個人
+CREATE OR REPLACE FUNCTION rebuild_user_reputation(OUT fixed_users int) AS $$
+BEGIN
+    LOCK TABLE comment IN SHARE MODE;
+    LOCK TABLE user_reputation IN EXCLUSIVE MODE;
+
+    SELECT COUNT(*) INTO fixed_users FROM reputation_drift();
+
+    DELETE FROM user_reputation;
+    INSERT INTO user_reputation (user_id, rating_sum, rating_count)
+    SELECT p.user_id, SUM(c.rating), COUNT(*)
+    FROM comment c JOIN post p ON p.post_id = c.post_id
+    GROUP BY p.user_id;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT * FROM rebuild_user_reputation();
+
+COMMIT;
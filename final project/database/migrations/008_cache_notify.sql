@@ -0,0 +1,52 @@
+-- 008: 快取作廢通知，資料有變動就 NOTIFY giveaway_cache，讓每個 worker 清掉自己的快取
+-- psql -d <DB_NAME> -f migrations/008_cache_notify.sql
+
+BEGIN;
+
+-- 快取作廢通知：這些表有變動就 NOTIFY giveaway_cache，內容是表格名稱
+-- 每個 app worker 都有一個背景 thread 在 LISTEN（giveaway_app/cache_listener.py），收到就清掉相關的快取
+-- 同一個 transaction 裡同樣的通知只會送一次，一次改很多列也只有一則
+CREATE OR REPLACE FUNCTION notify_cache_change() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('giveaway_cache', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS categories_cache_notify_trigger ON categories;
+CREATE TRIGGER categories_cache_notify_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON categories
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_cache_change();
+
+DROP TRIGGER IF EXISTS users_cache_notify_trigger ON users;
+CREATE TRIGGER users_cache_notify_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON users
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_cache_change();
+
+DROP TRIGGER IF EXISTS post_cache_notify_trigger ON post;
+CREATE TRIGGER post_cache_notify_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON post
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_cache_change();
+
+DROP TRIGGER IF EXISTS item_cache_notify_trigger ON item;
+CREATE TRIGGER item_cache_notify_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON item
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_cache_change();
+
+DROP TRIGGER IF EXISTS trade_cache_notify_trigger ON trade;
+CREATE TRIGGER trade_cache_notify_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON trade
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_cache_change();
+
+DROP TRIGGER IF EXISTS comment_cache_notify_trigger ON comment;
+CREATE TRIGGER comment_cache_notify_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON comment
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_cache_change();
+
+COMMIT;
@@ -0,0 +1,307 @@
+-- 009: 過期的物品下架
+-- item 加上 expired，背景的 expire_items() 把過了 expiration_date 的物品標起來；
+-- 標起來的物品不算庫存（post / category_stock 的計數扣掉、全部過期的 post 結案）、不能索取
+-- 首頁的 partial index 只放沒過期又還有庫存的，舊資料再多首頁要掃的範圍也不會變大
+-- psql -d <DB_NAME> -f migrations/009_item_expiration.sql
+
+BEGIN;
+
+ALTER TABLE item ADD COLUMN IF NOT EXISTS expired boolean NOT NULL DEFAULT false;   -- expire_items() 標的，只標還有庫存的
+
+-- 庫存計數：item 新增 / 修改 / 刪除時，跟著調整 post 跟 category_stock 上的數字
+-- 這樣判斷 post 還有沒有東西、首頁的總數都不用再去 COUNT / SUM 整張 item
+-- INSERT / UPDATE / DELETE 各綁一個 statement-level trigger，共用這個 function
+-- 過期的物品 (expired) 不算庫存：標成過期就跟被拿完一樣，從計數裡扣掉
+CREATE OR REPLACE FUNCTION update_stock_counters() RETURNS TRIGGER AS $$
+DECLARE
+    post_ids int[];
+    category_ids int[];
+    shards int[];
+    quantities int[];
+    item_counts int[];
+BEGIN
+    -- 先把這次動到的 item 換成「加多少、減多少」：新的列算正的，舊的列算負的
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(post_id), array_agg(category_id), array_agg(item_id % 16),
+               array_agg(CASE WHEN expired THEN 0 ELSE quantity END), array_agg((quantity > 0 AND NOT expired)::int)
+        INTO post_ids, category_ids, shards, quantities, item_counts
+        FROM new_items;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(post_id), array_agg(category_id), array_agg(item_id % 16),
+               array_agg(CASE WHEN expired THEN 0 ELSE -quantity END), array_agg(-(quantity > 0 AND NOT expired)::int)
+        INTO post_ids, category_ids, shards, quantities, item_counts
+        FROM old_items;
+    ELSE
+        SELECT array_agg(d.post_id), array_agg(d.category_id), array_agg(d.item_id % 16),
+               array_agg(d.quantity), array_agg(d.items)
+        INTO post_ids, category_ids, shards, quantities, item_counts
+        FROM (
+            SELECT post_id, category_id, item_id, CASE WHEN expired THEN 0 ELSE quantity END AS quantity,
+                   (quantity > 0 AND NOT expired)::int AS items
+            FROM new_items
+            UNION ALL
+            SELECT post_id, category_id, item_id, CASE WHEN expired THEN 0 ELSE -quantity END,
+                   -(quantity > 0 AND NOT expired)::int
+            FROM old_items
+        ) d;
+    END IF;
+
+    IF post_ids IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    -- 照 post_id 順序先鎖，同時有好幾個 transaction 在改同一批 post 也不會 deadlock
+    PERFORM 1 FROM post WHERE post_id = ANY(post_ids) ORDER BY post_id FOR UPDATE;
+
+    -- 物品數量都歸 0（或都過期）了 -> post available = false（跟以前一樣，不會自己變回 true）
+    UPDATE post p
+    SET remaining_quantity = p.remaining_quantity + d.quantity,
+        remaining_items = p.remaining_items + d.items,
+        available = p.available AND p.remaining_items + d.items > 0
+    FROM (
+        SELECT d.post_id, SUM(d.quantity) AS quantity, SUM(d.items) AS items
+        FROM unnest(post_ids, quantities, item_counts) AS d(post_id, quantity, items)
+        GROUP BY d.post_id
+    ) d
+    WHERE p.post_id = d.post_id
+    AND (d.quantity <> 0 OR d.items <> 0);
+
+    INSERT INTO category_stock AS cs (category_id, shard, remaining_quantity, remaining_items)
+    SELECT d.category_id, d.shard, SUM(d.quantity), SUM(d.items)
+    FROM unnest(category_ids, shards, quantities, item_counts) AS d(category_id, shard, quantity, items)
+    GROUP BY d.category_id, d.shard
+    HAVING SUM(d.quantity) <> 0 OR SUM(d.items) <> 0
+    ORDER BY d.category_id, d.shard
+    ON CONFLICT (category_id, shard) DO UPDATE
+    SET remaining_quantity = cs.remaining_quantity + EXCLUDED.remaining_quantity,
+        remaining_items = cs.remaining_items + EXCLUDED.remaining_items;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 檢查計數有沒有跟 item 對不起來，回傳對不起來的 post / 分類（flask stock check 用）
+CREATE OR REPLACE FUNCTION stock_counter_drift()
+RETURNS TABLE (kind text, id int, counted_quantity bigint, actual_quantity bigint,
+               counted_items bigint, actual_items bigint) AS $$
+    WITH actual_post AS (
+        SELECT post_id, COALESCE(SUM(quantity) FILTER (WHERE NOT expired), 0) AS quantity,
+               COUNT(*) FILTER (WHERE quantity > 0 AND NOT expired) AS items
+        FROM item GROUP BY post_id
+    ), actual_category AS (
+        SELECT category_id, COALESCE(SUM(quantity) FILTER (WHERE NOT expired), 0) AS quantity,
+               COUNT(*) FILTER (WHERE quantity > 0 AND NOT expired) AS items
+        FROM item GROUP BY category_id
+    ), counted_category AS (
+        SELECT category_id, SUM(remaining_quantity) AS quantity, SUM(remaining_items) AS items
+        FROM category_stock GROUP BY category_id
+    )
+    SELECT 'post', p.post_id, p.remaining_quantity::bigint, COALESCE(a.quantity, 0),
+           p.remaining_items::bigint, COALESCE(a.items, 0)
+    FROM post p LEFT JOIN actual_post a ON a.post_id = p.post_id
+    WHERE (p.remaining_quantity, p.remaining_items) IS DISTINCT FROM (COALESCE(a.quantity, 0), COALESCE(a.items, 0))
+    UNION ALL
+    SELECT 'category', COALESCE(c.category_id, a.category_id), COALESCE(c.quantity, 0), COALESCE(a.quantity, 0),
+           COALESCE(c.items, 0), COALESCE(a.items, 0)
+    FROM counted_category c FULL JOIN actual_category a ON a.category_id = c.category_id
+    WHERE (COALESCE(c.quantity, 0), COALESCE(c.items, 0)) IS DISTINCT FROM (COALESCE(a.quantity, 0), COALESCE(a.items, 0))
+    ORDER BY 1, 2;
+$$ LANGUAGE sql STABLE;
+
+-- 從 item 重算所有計數，回傳修正了幾篇 post、幾個分類
+-- 過程中會鎖住 item 不讓別人寫（讀不影響），資料很多的話請挑沒人用的時候跑
+CREATE OR REPLACE FUNCTION rebuild_stock_counters(OUT fixed_posts int, OUT fixed_categories int) AS $$
+BEGIN
+    LOCK TABLE item IN SHARE MODE;
+    LOCK TABLE category_stock IN EXCLUSIVE MODE;
+
+    SELECT COUNT(*) FILTER (WHERE kind = 'category') INTO fixed_categories FROM stock_counter_drift();
+
+    UPDATE post p
+    SET remaining_quantity = COALESCE(a.quantity, 0),
+        remaining_items = COALESCE(a.items, 0)
+    FROM post p2
+    LEFT JOIN (
+        SELECT post_id, COALESCE(SUM(quantity) FILTER (WHERE NOT expired), 0) AS quantity,
+               COUNT(*) FILTER (WHERE quantity > 0 AND NOT expired) AS items
+        FROM item GROUP BY post_id
+    ) a ON a.post_id = p2.post_id
+    WHERE p.post_id = p2.post_id
+    AND (p.remaining_quantity, p.remaining_items) IS DISTINCT FROM (COALESCE(a.quantity, 0), COALESCE(a.items, 0));
+    GET DIAGNOSTICS fixed_posts = ROW_COUNT;
+
+    DELETE FROM category_stock;
+    INSERT INTO category_stock (category_id, shard, remaining_quantity, remaining_items)
+    SELECT category_id, item_id % 16, COALESCE(SUM(quantity) FILTER (WHERE NOT expired), 0),
+           COUNT(*) FILTER (WHERE quantity > 0 AND NOT expired)
+    FROM item
+    GROUP BY category_id, item_id % 16;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 過期下架：過了 expiration_date 還有庫存的物品標成 expired，一次最多 p_limit 筆，回傳標了幾筆
+-- 扣計數、全部過期的 post 結案都交給 item 的 trigger (update_stock_counters)
+-- SKIP LOCKED：正在被索取的先跳過下一輪再標，好幾個 worker 同時跑也不會互等
+-- app 的背景 thread（giveaway_app/expiry_sweeper.py）跟 flask stock expire 都是呼叫這個
+-- 沒有要標的就直接回傳 0，不跑 UPDATE：item 的 statement trigger 連 0 列都會 NOTIFY，每輪空掃都會清掉所有快取
+CREATE OR REPLACE FUNCTION expire_items(p_limit int) RETURNS int AS $$
+DECLARE
+    due int[];
+    n int;
+BEGIN
+    SELECT array_agg(d.item_id) INTO due
+    FROM (
+        SELECT item_id
+        FROM item
+        WHERE quantity > 0 AND NOT expired AND expiration_date <= NOW()
+        ORDER BY expiration_date
+        LIMIT p_limit
+        FOR UPDATE SKIP LOCKED
+    ) d;
+    IF due IS NULL THEN
+        RETURN 0;
+    END IF;
+
+    UPDATE item SET expired = true WHERE item_id = ANY(due);
+    GET DIAGNOSTICS n = ROW_COUNT;
+    RETURN n;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 索取：檢查 + 扣庫存 + 寫 trade 一次做完，app 只要呼叫一次
+-- 先用 FOR UPDATE 鎖住 item 那一列，同時搶同一個東西的人會排隊，輪到的時候看到的就是最新的庫存，
+-- 不會超賣，也不用靠 CHECK (quantity >= 0) 失敗再 rollback
+-- 回傳的 status：ok / invalid_quantity / not_found / own_item / unavailable / expired / insufficient
+-- 過期但 expire_items() 還沒標到的也算 expired
+CREATE OR REPLACE FUNCTION claim_item(p_user_id int, p_item_id int, p_quantity int)
+RETURNS TABLE (status text, item_name text, remaining int) AS $$
+#variable_conflict use_column
+DECLARE
+    target record;
+BEGIN
+    IF p_quantity IS NULL OR p_quantity <= 0 THEN
+        RETURN QUERY SELECT 'invalid_quantity'::text, NULL::text, NULL::int;
+        RETURN;
+    END IF;
+
+    SELECT i.item_name, i.quantity, p.user_id AS owner_id, p.available,
+           i.expired OR i.expiration_date <= NOW() AS expired
+    INTO target
+    FROM item i JOIN post p ON p.post_id = i.post_id
+    WHERE i.item_id = p_item_id
+    FOR UPDATE OF i;
+
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'not_found'::text, NULL::text, NULL::int;
+    ELSIF target.owner_id = p_user_id THEN
+        RETURN QUERY SELECT 'own_item'::text, target.item_name, target.quantity;
+    ELSIF target.expired THEN
+        RETURN QUERY SELECT 'expired'::text, target.item_name, target.quantity;
+    ELSIF target.quantity = 0 OR NOT target.available THEN
+        RETURN QUERY SELECT 'unavailable'::text, target.item_name, target.quantity;
+    ELSIF target.quantity < p_quantity THEN
+        RETURN QUERY SELECT 'insufficient'::text, target.item_name, target.quantity;
+    ELSE
+        -- 扣庫存、更新 post.available 交給 trade 的 trigger
+        INSERT INTO trade (user_id, item_id, quantity, trade_time)
+        VALUES (p_user_id, p_item_id, p_quantity, NOW());
+        RETURN QUERY SELECT 'ok'::text, target.item_name, target.quantity - p_quantity;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 批次索取：一次拿好幾個物品，全部成功才算數，有一個不行就都不拿
+-- 每個物品回傳一列，status 跟 claim_item() 一樣；只要有一列不是 ok，整批都沒有寫入
+-- 同一個 item 出現好幾次會把數量加起來
+CREATE OR REPLACE FUNCTION claim_items(p_user_id int, p_item_ids int[], p_quantities int[])
+RETURNS TABLE (item_id int, status text, item_name text, remaining int) AS $$
+#variable_conflict use_column
+DECLARE
+    req record;
+    failed boolean := false;
+    ok_ids int[] := '{}';
+    ok_quantities int[] := '{}';
+BEGIN
+    IF cardinality(p_item_ids) IS DISTINCT FROM cardinality(p_quantities) THEN
+        RAISE EXCEPTION 'claim_items: item_ids 跟 quantities 長度不一樣';
+    END IF;
+
+    -- 照 item_id 的順序上鎖，兩個人同時批次索取重疊的物品也不會 deadlock
+    FOR req IN
+        WITH wanted AS (
+            SELECT w.item_id,
+                   SUM(w.quantity)::int AS quantity,
+                   bool_or(w.quantity IS NULL OR w.quantity <= 0) AS bad_quantity
+            FROM unnest(p_item_ids, p_quantities) AS w(item_id, quantity)
+            GROUP BY w.item_id
+        ), locked AS (
+            SELECT i.item_id, i.item_name, i.quantity, p.user_id AS owner_id, p.available,
+                   i.expired OR i.expiration_date <= NOW() AS expired
+            FROM item i JOIN post p ON p.post_id = i.post_id
+            WHERE i.item_id IN (SELECT w.item_id FROM wanted w)
+            ORDER BY i.item_id
+            FOR UPDATE OF i
+        )
+        SELECT w.item_id, w.quantity AS want, w.bad_quantity,
+               l.item_id IS NOT NULL AS found, l.item_name, l.quantity, l.owner_id, l.available, l.expired
+        FROM wanted w LEFT JOIN locked l ON l.item_id = w.item_id
+        ORDER BY w.item_id
+    LOOP
+        item_id := req.item_id;
+        item_name := req.item_name;
+        remaining := req.quantity;
+
+        IF req.bad_quantity THEN
+            status := 'invalid_quantity';
+        ELSIF NOT req.found THEN
+            status := 'not_found';
+        ELSIF req.owner_id = p_user_id THEN
+            status := 'own_item';
+        ELSIF req.expired THEN
+            status := 'expired';
+        ELSIF req.quantity = 0 OR NOT req.available THEN
+            status := 'unavailable';
+        ELSIF req.quantity < req.want THEN
+            status := 'insufficient';
+        ELSE
+            status := 'ok';
+            remaining := req.quantity - req.want;
+            ok_ids := ok_ids || req.item_id;
+            ok_quantities := ok_quantities || req.want;
+        END IF;
+
+        failed := failed OR status <> 'ok';
+        RETURN NEXT;
+    END LOOP;
+
+    IF failed OR cardinality(ok_ids) = 0 THEN
+        RETURN;
+    END IF;
+
+    -- 一句 INSERT 寫完，trade 的 trigger 會一次扣庫存，每篇 post 也只檢查一次
+    INSERT INTO trade (user_id, item_id, quantity, trade_time)
+    SELECT p_user_id, t.item_id, t.quantity, NOW()
+    FROM unnest(ok_ids, ok_quantities) AS t(item_id, quantity);
+END;
+$$ LANGUAGE plpgsql;
+
+-- 現在已經過期的先一次標完：資料多的話一筆一筆過 trigger 太慢，先關掉 trigger 標完再整個重算計數
+ALTER TABLE item DISABLE TRIGGER item_stock_update_trigger;
+UPDATE item SET expired = true WHERE quantity > 0 AND NOT expired AND expiration_date <= NOW();
+ALTER TABLE item ENABLE TRIGGER item_stock_update_trigger;
+
+SELECT * FROM rebuild_stock_counters();
+
+-- 全部都過期的 post 結案（trigger 平常會做，上面關掉了）
+UPDATE post SET available = false WHERE available AND remaining_items = 0;
+
+COMMIT;
+
+-- index 不放在 transaction 裡，CONCURRENTLY 建的時候不會擋住寫入
+-- 首頁物品模式的排序 / 分頁順序：只放沒過期、還有庫存的，取代 002 的 item_browse_idx / item_category_browse_idx
+CREATE INDEX CONCURRENTLY IF NOT EXISTS item_live_browse_idx ON item (quantity DESC, post_id DESC, category_id, item_id) WHERE quantity > 0 AND NOT expired;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS item_live_category_browse_idx ON item (category_id, quantity DESC, post_id DESC, item_id) WHERE quantity > 0 AND NOT expired;
+-- expire_items() 找下一批要過期的
+CREATE INDEX CONCURRENTLY IF NOT EXISTS item_expiring_idx ON item (expiration_date) WHERE quantity > 0 AND NOT expired;
+DROP INDEX CONCURRENTLY IF EXISTS item_browse_idx;
+DROP INDEX CONCURRENTLY IF EXISTS item_category_browse_idx;
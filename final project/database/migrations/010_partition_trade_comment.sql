@@ -0,0 +1,276 @@
+-- 010: trade / comment 改成照時間分區（一個月一個分區）
+-- 個人頁面的紀錄都是照時間倒著看，分區之後只會掃到最近幾個月；很舊的月份可以整個分區拆下來封存
+-- （flask --app app partitions archive），不用一筆一筆 DELETE
+-- 舊的資料會搬到新的分區表，搬的時候 trade / comment 會鎖住，請在沒人用的時候跑
+-- psql -d <DB_NAME> -f migrations/010_partition_trade_comment.sql
+
+BEGIN;
+
+-- 已經封存（從 comment 拆走）的評價，user_reputation 的數字還是有算進去
+-- reputation_drift / rebuild_user_reputation 要加上這裡才對得起來
+CREATE TABLE IF NOT EXISTS archived_reputation (
+	user_id int NOT NULL,
+	rating_sum bigint NOT NULL DEFAULT 0,
+	rating_count int NOT NULL DEFAULT 0,
+	PRIMARY KEY (user_id),
+	FOREIGN KEY (user_id) references users on delete cascade
+);
+
+-- 舊的表先改名，等一下把資料搬過去再刪掉
+-- 已經是分區表的話（這個 migration 跑過了）就不動
+DO $$
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = 'trade'::regclass) = 'r' THEN
+        LOCK TABLE trade IN ACCESS EXCLUSIVE MODE;
+        ALTER TABLE trade RENAME TO trade_unpartitioned;
+        ALTER INDEX trade_pkey RENAME TO trade_unpartitioned_pkey;
+        DROP INDEX IF EXISTS trade_user_time_idx;
+        DROP INDEX IF EXISTS trade_item_id_idx;
+        -- 序號要留給新的表用，舊的表刪掉時不要一起刪
+        ALTER SEQUENCE trade_trade_id_seq OWNED BY NONE;
+    END IF;
+    IF (SELECT relkind FROM pg_class WHERE oid = 'comment'::regclass) = 'r' THEN
+        LOCK TABLE comment IN ACCESS EXCLUSIVE MODE;
+        ALTER TABLE comment RENAME TO comment_unpartitioned;
+        ALTER INDEX comment_pkey RENAME TO comment_unpartitioned_pkey;
+        DROP INDEX IF EXISTS comment_post_user_idx;
+        DROP INDEX IF EXISTS comment_user_id_idx;
+        ALTER SEQUENCE comment_comment_id_seq OWNED BY NONE;
+    END IF;
+END $$;
+
+-- 分區表的主鍵一定要包含分區的欄位，所以是 (id, 時間)；id 還是由序號產生，不會重複
+-- comment_time 要拿來分區，不能是 NULL
+CREATE TABLE IF NOT EXISTS comment (
+	comment_id int NOT NULL DEFAULT nextval('comment_comment_id_seq'),
+	post_id int NOT NULL,
+	user_id int NOT NULL,
+	rating int NOT NULL CHECK (rating >= 0 and rating <= 5),
+	comment_str text NOT NULL,
+	comment_time timestamp NOT NULL DEFAULT current_timestamp,
+	primary key (comment_id, comment_time),
+	foreign key (user_id) references users on delete cascade,
+	foreign key (post_id) references post on delete cascade
+) PARTITION BY RANGE (comment_time);
+
+CREATE TABLE IF NOT EXISTS trade (
+	trade_id int NOT NULL DEFAULT nextval('trade_trade_id_seq'),
+	user_id int NOT NULL,
+	item_id int NOT NULL,
+	quantity int NOT NULL CHECK (quantity > 0),
+	trade_time timestamp NOT NULL,
+	primary key (trade_id, trade_time),
+	foreign key (user_id) references users on delete cascade,
+	foreign key (item_id) references item on delete cascade
+) PARTITION BY RANGE (trade_time);
+
+ALTER SEQUENCE trade_trade_id_seq OWNED BY trade.trade_id;
+ALTER SEQUENCE comment_comment_id_seq OWNED BY comment.comment_id;
+
+-- 還沒有分區的月份先放這裡，ensure_partitions() 會再搬到那個月的分區
+CREATE TABLE IF NOT EXISTS trade_default PARTITION OF trade DEFAULT;
+CREATE TABLE IF NOT EXISTS comment_default PARTITION OF comment DEFAULT;
+
+-- comment：一篇貼文的評價、某人有沒有評過這篇；user_id 給刪帳號的 cascade 用
+CREATE INDEX IF NOT EXISTS comment_post_user_idx ON comment (post_id, user_id);
+CREATE INDEX IF NOT EXISTS comment_user_id_idx ON comment (user_id);
+-- trade：個人頁面的索取紀錄；item_id 給刪貼文的 cascade 用
+CREATE INDEX IF NOT EXISTS trade_user_time_idx ON trade (user_id, trade_time DESC);
+CREATE INDEX IF NOT EXISTS trade_item_id_idx ON trade (item_id);
+
+-- 建某個月的分區（名字像 trade_y2025m01），已經有了就回傳 false
+-- default 分區裡已經有那個月的資料的話不能直接建，要先搬出來：另外建一張表、搬過去再掛上去
+-- 直接對分區 DELETE / INSERT，掛在 trade / comment 上的 trigger（扣庫存、評價）不會跑
+CREATE OR REPLACE FUNCTION create_month_partition(p_table text, p_column text, p_month date) RETURNS boolean AS $$
+DECLARE
+    month_start date := date_trunc('month', p_month)::date;
+    month_end date := (date_trunc('month', p_month) + interval '1 month')::date;
+    part text := p_table || to_char(p_month, '"_y"YYYY"m"MM');
+    has_rows boolean;
+BEGIN
+    IF to_regclass(part) IS NOT NULL THEN
+        RETURN false;
+    END IF;
+
+    -- 搬的時候不能有新的資料寫進 default 分區
+    EXECUTE format('LOCK TABLE %I IN EXCLUSIVE MODE', p_table || '_default');
+    EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I WHERE %I >= $1 AND %I < $2)', p_table || '_default', p_column, p_column)
+    INTO has_rows USING month_start, month_end;
+
+    IF NOT has_rows THEN
+        EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)', part, p_table, month_start, month_end);
+    ELSE
+        EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', part, p_table);
+        EXECUTE format('WITH moved AS (DELETE FROM %I WHERE %I >= $1 AND %I < $2 RETURNING *) INSERT INTO %I SELECT * FROM moved',
+                       p_table || '_default', p_column, p_column, part)
+        USING month_start, month_end;
+        EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', p_table, part, month_start, month_end);
+    END IF;
+    RETURN true;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 確保 trade / comment 從這個月到 p_months_ahead 個月後都有分區，
+-- default 分區裡有資料的月份也建起來（把資料搬過去），回傳這次建了幾個分區
+-- app 背景會定時呼叫（PARTITION_CHECK_INTERVAL），也可以用 flask --app app partitions ensure
+CREATE OR REPLACE FUNCTION ensure_partitions(p_months_ahead int DEFAULT 3) RETURNS int AS $$
+DECLARE
+    t record;
+    m date;
+    created int := 0;
+BEGIN
+    -- 好幾個 worker 同時呼叫的話排隊，不然會搶著建同一個分區
+    PERFORM pg_advisory_xact_lock(hashtext('ensure_partitions'));
+
+    FOR t IN SELECT * FROM (VALUES ('trade', 'trade_time'), ('comment', 'comment_time')) AS v(tbl, col) LOOP
+        FOR m IN
+            SELECT generate_series(date_trunc('month', current_date),
+                                   date_trunc('month', current_date) + make_interval(months => p_months_ahead),
+                                   interval '1 month')::date
+        LOOP
+            IF create_month_partition(t.tbl, t.col, m) THEN
+                created := created + 1;
+            END IF;
+        END LOOP;
+
+        FOR m IN EXECUTE format('SELECT DISTINCT date_trunc(''month'', %I)::date FROM %I', t.col, t.tbl || '_default') LOOP
+            IF create_month_partition(t.tbl, t.col, m) THEN
+                created := created + 1;
+            END IF;
+        END LOOP;
+    END LOOP;
+
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 封存前把分區拆下來，回傳裡面有幾筆
+-- comment 的分區拆下來之前，先把裡面的評價加到 archived_reputation
+-- （拆下來不會跑 comment 的 DELETE trigger，user_reputation 的數字不會變，封存之後評價還是一樣）
+CREATE OR REPLACE FUNCTION detach_partition(p_table text, p_partition text) RETURNS bigint AS $$
+DECLARE
+    n bigint;
+BEGIN
+    -- 先鎖住，算評價到拆下來中間不能有人刪掉裡面的 comment（刪貼文的 cascade）
+    EXECUTE format('LOCK TABLE %I IN ACCESS EXCLUSIVE MODE', p_table);
+
+    IF p_table = 'comment' THEN
+        EXECUTE format($q$
+            INSERT INTO archived_reputation AS r (user_id, rating_sum, rating_count)
+            SELECT p.user_id, SUM(c.rating), COUNT(*)
+            FROM %I c JOIN post p ON p.post_id = c.post_id
+            GROUP BY p.user_id
+            ON CONFLICT (user_id) DO UPDATE
+            SET rating_sum = r.rating_sum + EXCLUDED.rating_sum,
+                rating_count = r.rating_count + EXCLUDED.rating_count
+        $q$, p_partition);
+    END IF;
+
+    EXECUTE format('SELECT COUNT(*) FROM %I', p_partition) INTO n;
+    EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', p_table, p_partition);
+    RETURN n;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 舊的資料搬過來：先建好舊資料用到的月份，直接寫進各自的分區
+-- 新的表上還沒有 trigger，搬的時候不會再扣一次庫存、加一次評價
+DO $$
+BEGIN
+    IF to_regclass('trade_unpartitioned') IS NOT NULL THEN
+        PERFORM create_month_partition('trade', 'trade_time', m)
+        FROM (SELECT DISTINCT date_trunc('month', trade_time)::date AS m FROM trade_unpartitioned) s;
+        INSERT INTO trade (trade_id, user_id, item_id, quantity, trade_time)
+        SELECT trade_id, user_id, item_id, quantity, trade_time FROM trade_unpartitioned;
+        DROP TABLE trade_unpartitioned;
+    END IF;
+    IF to_regclass('comment_unpartitioned') IS NOT NULL THEN
+        PERFORM create_month_partition('comment', 'comment_time', m)
+        FROM (SELECT DISTINCT date_trunc('month', COALESCE(comment_time, current_timestamp))::date AS m FROM comment_unpartitioned) s;
+        INSERT INTO comment (comment_id, post_id, user_id, rating, comment_str, comment_time)
+        SELECT comment_id, post_id, user_id, rating, comment_str, COALESCE(comment_time, current_timestamp) FROM comment_unpartitioned;
+        DROP TABLE comment_unpartitioned;
+    END IF;
+END $$;
+
+SELECT ensure_partitions(3);
+
+-- trigger 都綁在上層的 trade / comment，寫進哪個分區都會跑
+DROP TRIGGER IF EXISTS trade_inventory_trigger ON trade;
+CREATE TRIGGER trade_inventory_trigger
+AFTER INSERT ON trade
+REFERENCING NEW TABLE AS new_trades
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_inventory_batch();
+
+DROP TRIGGER IF EXISTS comment_reputation_insert_trigger ON comment;
+CREATE TRIGGER comment_reputation_insert_trigger
+AFTER INSERT ON comment
+REFERENCING NEW TABLE AS new_comments
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_user_reputation();
+
+DROP TRIGGER IF EXISTS comment_reputation_delete_trigger ON comment;
+CREATE TRIGGER comment_reputation_delete_trigger
+AFTER DELETE ON comment
+REFERENCING OLD TABLE AS old_comments
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_user_reputation();
+
+DROP TRIGGER IF EXISTS trade_cache_notify_trigger ON trade;
+CREATE TRIGGER trade_cache_notify_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON trade
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_cache_change();
+
+DROP TRIGGER IF EXISTS comment_cache_notify_trigger ON comment;
+CREATE TRIGGER comment_cache_notify_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON comment
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_cache_change();
+
+-- 檢查 user_reputation 有沒有跟 comment 對不起來（flask reputation check 用）
+-- 封存掉的評價在 archived_reputation，也要算進去
+CREATE OR REPLACE FUNCTION reputation_drift()
+RETURNS TABLE (user_id int, counted_sum bigint, actual_sum bigint, counted_count bigint, actual_count bigint) AS $$
+    WITH actual AS (
+        SELECT s.user_id, SUM(s.rating_sum)::bigint AS rating_sum, SUM(s.rating_count)::bigint AS rating_count
+        FROM (
+            SELECT p.user_id, SUM(c.rating) AS rating_sum, COUNT(*) AS rating_count
+            FROM comment c JOIN post p ON p.post_id = c.post_id
+            GROUP BY p.user_id
+            UNION ALL
+            SELECT user_id, rating_sum, rating_count FROM archived_reputation
+        ) s
+        GROUP BY s.user_id
+    )
+    SELECT COALESCE(r.user_id, a.user_id), COALESCE(r.rating_sum, 0), COALESCE(a.rating_sum, 0),
+           COALESCE(r.rating_count, 0)::bigint, COALESCE(a.rating_count, 0)
+    FROM user_reputation r FULL JOIN actual a ON a.user_id = r.user_id
+    WHERE (COALESCE(r.rating_sum, 0), COALESCE(r.rating_count, 0)) IS DISTINCT FROM (COALESCE(a.rating_sum, 0), COALESCE(a.rating_count, 0))
+    ORDER BY 1;
+$$ LANGUAGE sql STABLE;
+
+-- 從 comment（加上封存掉的）重算所有人的評價，回傳修正了幾個人
+CREATE OR REPLACE FUNCTION rebuild_user_reputation(OUT fixed_users int) AS $$
+BEGIN
+    LOCK TABLE comment IN SHARE MODE;
+    LOCK TABLE archived_reputation IN SHARE MODE;
+    LOCK TABLE user_reputation IN EXCLUSIVE MODE;
+
+    SELECT COUNT(*) INTO fixed_users FROM reputation_drift();
+
+    DELETE FROM user_reputation;
+    INSERT INTO user_reputation (user_id, rating_sum, rating_count)
+    SELECT s.user_id, SUM(s.rating_sum), SUM(s.rating_count)
+    FROM (
+        SELECT p.user_id, SUM(c.rating) AS rating_sum, COUNT(*) AS rating_count
+        FROM comment c JOIN post p ON p.post_id = c.post_id
+        GROUP BY p.user_id
+        UNION ALL
+        SELECT user_id, rating_sum, rating_count FROM archived_reputation
+    ) s
+    GROUP BY s.user_id;
+END;
+$$ LANGUAGE plpgsql;
+
+COMMIT;
@@ -0,0 +1,276 @@
+-- 011: 首頁的 feed 表
+-- 首頁兩種模式每次都要 item / post / location / categories / users 五張表 JOIN，貼文模式還要在 Python 重新分組
+-- 這裡先把 JOIN 好的結果存起來：browse_item_feed 一個還有庫存的物品一列，browse_post_feed 一篇進行中的貼文一列
+-- （物品整理成 jsonb 陣列），item / post / users / location / categories 的 trigger 會跟著更新
+-- 搜尋還是照原本的 JOIN 算相關度，只有沒搜尋的首頁（含分類篩選）讀 feed
+-- psql -d <DB_NAME> -f migrations/011_browse_feed.sql
+
+BEGIN;
+
+-- feed 的內容就是這兩個 view，trigger、flask feed check / rebuild 都是拿 feed 跟 view 比
+-- 物品模式：還有庫存、沒被標成過期的物品（過了期限還沒標到的，查詢時再用 expiration_date 擋）
+CREATE OR REPLACE VIEW browse_item_source AS
+SELECT i.item_id, i.post_id, i.category_id, c.name AS category_name,
+       i.item_name, i.quantity, i.expiration_date,
+       p.description, p.available,
+       l.location_name, l.city, l.district, l.street, l.number,
+       p.user_id AS owner_id, u.name AS owner_name
+FROM item i
+LEFT JOIN post p ON i.post_id = p.post_id
+LEFT JOIN location l ON i.location_id = l.location_id
+LEFT JOIN categories c ON i.category_id = c.category_id
+LEFT JOIN users u ON p.user_id = u.user_id
+WHERE i.quantity > 0 AND NOT i.expired;
+
+-- 貼文模式：進行中的貼文，底下全部的物品（包括被拿完、過期的，頁面上會顯示「無法索取」）照分類、item_id 排好
+CREATE OR REPLACE VIEW browse_post_source AS
+SELECT p.post_id, p.description, p.user_id AS owner_id, u.name AS owner_name,
+       array_agg(DISTINCT i.category_id ORDER BY i.category_id) AS category_ids,
+       jsonb_agg(jsonb_build_object(
+           'item_id', i.item_id, 'item_name', i.item_name, 'quantity', i.quantity,
+           'expired', i.expired, 'expiration_date', i.expiration_date,
+           'category_id', i.category_id, 'category_name', c.name
+       ) ORDER BY i.category_id, i.item_id) AS items
+FROM post p
+JOIN item i ON i.post_id = p.post_id
+LEFT JOIN categories c ON i.category_id = c.category_id
+LEFT JOIN users u ON p.user_id = u.user_id
+WHERE p.available
+GROUP BY p.post_id, u.name;
+
+-- 欄位順序要跟上面的 view 一樣（INSERT ... SELECT * 跟檢查都是照順序對）
+CREATE TABLE IF NOT EXISTS browse_item_feed (
+	item_id int NOT NULL,
+	post_id int NOT NULL,
+	category_id int NOT NULL,
+	category_name varchar(50),
+	item_name text NOT NULL,
+	quantity int NOT NULL,
+	expiration_date timestamp NOT NULL,
+	description text,
+	available boolean,
+	location_name varchar(50),
+	city varchar(50),
+	district varchar(50),
+	street varchar(100),
+	number varchar(20),
+	owner_id int,
+	owner_name varchar(50),
+	PRIMARY KEY (item_id)
+);
+
+CREATE TABLE IF NOT EXISTS browse_post_feed (
+	post_id int NOT NULL,
+	description text NOT NULL,
+	owner_id int NOT NULL,
+	owner_name varchar(50),
+	category_ids int[] NOT NULL,
+	items jsonb NOT NULL,
+	PRIMARY KEY (post_id)
+);
+
+-- 物品模式的排序 / 分頁順序，有分類篩選時用第二個；貼文模式照 post_id 倒著排用主鍵，分類篩選用 GIN
+CREATE INDEX IF NOT EXISTS browse_item_feed_order_idx ON browse_item_feed (quantity DESC, post_id DESC, category_id, item_id);
+CREATE INDEX IF NOT EXISTS browse_item_feed_category_idx ON browse_item_feed (category_id, quantity DESC, post_id DESC, item_id);
+CREATE INDEX IF NOT EXISTS browse_post_feed_category_idx ON browse_post_feed USING gin (category_ids);
+
+-- 重算這些 post（跟 p_item_ids 這些物品）在 feed 裡的列；沒給 p_item_ids 就是這些 post 底下還有庫存的物品
+-- 先照 post_id 順序鎖住 post：同一篇的物品同時被索取時，後面的人要等前面的 commit 完才重算，
+-- 不然可能拿到舊的數字蓋回去（索取本來就會更新 post 上的庫存計數，一樣要等這把鎖）
+CREATE OR REPLACE FUNCTION refresh_browse_feed(p_post_ids int[], p_item_ids int[] DEFAULT NULL) RETURNS void AS $$
+BEGIN
+    IF cardinality(p_post_ids) IS NULL AND cardinality(p_item_ids) IS NULL THEN
+        RETURN;
+    END IF;
+
+    PERFORM 1 FROM post WHERE post_id = ANY(p_post_ids) ORDER BY post_id FOR NO KEY UPDATE;
+
+    IF p_item_ids IS NULL THEN
+        SELECT array_agg(item_id) INTO p_item_ids
+        FROM item WHERE post_id = ANY(p_post_ids) AND quantity > 0 AND NOT expired;
+    END IF;
+
+    DELETE FROM browse_item_feed WHERE item_id = ANY(p_item_ids);
+    INSERT INTO browse_item_feed SELECT * FROM browse_item_source WHERE item_id = ANY(p_item_ids);
+
+    DELETE FROM browse_post_feed WHERE post_id = ANY(p_post_ids);
+    INSERT INTO browse_post_feed SELECT * FROM browse_post_source WHERE post_id = ANY(p_post_ids);
+END;
+$$ LANGUAGE plpgsql;
+
+-- item 新增 / 修改 / 刪除（索取扣庫存、過期下架、刪貼文的 cascade 都會走到這裡）
+-- trade 不用另外綁：索取時 trade 的 trigger 會去改 item，就會走到這裡
+CREATE OR REPLACE FUNCTION browse_feed_item_changed() RETURNS TRIGGER AS $$
+DECLARE
+    post_ids int[];
+    item_ids int[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(DISTINCT post_id), array_agg(item_id) INTO post_ids, item_ids FROM new_items;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(DISTINCT post_id), array_agg(item_id) INTO post_ids, item_ids FROM old_items;
+    ELSE
+        SELECT array_agg(DISTINCT post_id), array_agg(DISTINCT item_id) INTO post_ids, item_ids
+        FROM (SELECT post_id, item_id FROM new_items UNION ALL SELECT post_id, item_id FROM old_items) s;
+    END IF;
+
+    PERFORM refresh_browse_feed(post_ids, COALESCE(item_ids, '{}'));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- post 修改：每次索取 post 上的庫存計數都會變，那些 feed 用不到，只看 feed 裡有的欄位
+-- 刪除不用另外處理，底下的 item 被 cascade 刪掉時會走上面那個
+CREATE OR REPLACE FUNCTION browse_feed_post_changed() RETURNS TRIGGER AS $$
+DECLARE
+    post_ids int[];
+BEGIN
+    SELECT array_agg(n.post_id) INTO post_ids
+    FROM new_posts n JOIN old_posts o ON o.post_id = n.post_id
+    WHERE (n.description, n.user_id, n.available) IS DISTINCT FROM (o.description, o.user_id, o.available);
+
+    PERFORM refresh_browse_feed(post_ids);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 發文者改名字
+CREATE OR REPLACE FUNCTION browse_feed_owner_changed() RETURNS TRIGGER AS $$
+DECLARE
+    post_ids int[];
+BEGIN
+    SELECT array_agg(p.post_id) INTO post_ids
+    FROM new_users n
+    JOIN old_users o ON o.user_id = n.user_id
+    JOIN post p ON p.user_id = n.user_id
+    WHERE n.name IS DISTINCT FROM o.name;
+
+    PERFORM refresh_browse_feed(post_ids);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 地點改了：只有物品模式有顯示地點
+CREATE OR REPLACE FUNCTION browse_feed_location_changed() RETURNS TRIGGER AS $$
+DECLARE
+    post_ids int[];
+    item_ids int[];
+BEGIN
+    SELECT array_agg(DISTINCT i.post_id), array_agg(i.item_id) INTO post_ids, item_ids
+    FROM new_locations n
+    JOIN old_locations o ON o.location_id = n.location_id
+    JOIN item i ON i.location_id = n.location_id
+    WHERE (n.location_name, n.city, n.district, n.street, n.number)
+          IS DISTINCT FROM (o.location_name, o.city, o.district, o.street, o.number)
+      AND i.quantity > 0 AND NOT i.expired;
+
+    PERFORM refresh_browse_feed(post_ids, COALESCE(item_ids, '{}'));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 分類改名字：有這個分類物品的貼文都要重算（貼文模式的物品裡也有分類名稱）
+CREATE OR REPLACE FUNCTION browse_feed_category_changed() RETURNS TRIGGER AS $$
+DECLARE
+    post_ids int[];
+BEGIN
+    SELECT array_agg(DISTINCT i.post_id) INTO post_ids
+    FROM new_categories n
+    JOIN old_categories o ON o.category_id = n.category_id
+    JOIN item i ON i.category_id = n.category_id
+    WHERE n.name IS DISTINCT FROM o.name;
+
+    PERFORM refresh_browse_feed(post_ids);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS item_feed_insert_trigger ON item;
+CREATE TRIGGER item_feed_insert_trigger
+AFTER INSERT ON item
+REFERENCING NEW TABLE AS new_items
+FOR EACH STATEMENT
+EXECUTE FUNCTION browse_feed_item_changed();
+
+DROP TRIGGER IF EXISTS item_feed_update_trigger ON item;
+CREATE TRIGGER item_feed_update_trigger
+AFTER UPDATE ON item
+REFERENCING OLD TABLE AS old_items NEW TABLE AS new_items
+FOR EACH STATEMENT
+EXECUTE FUNCTION browse_feed_item_changed();
+
+DROP TRIGGER IF EXISTS item_feed_delete_trigger ON item;
+CREATE TRIGGER item_feed_delete_trigger
+AFTER DELETE ON item
+REFERENCING OLD TABLE AS old_items
+FOR EACH STATEMENT
+EXECUTE FUNCTION browse_feed_item_changed();
+
+DROP TRIGGER IF EXISTS post_feed_update_trigger ON post;
+CREATE TRIGGER post_feed_update_trigger
+AFTER UPDATE ON post
+REFERENCING OLD TABLE AS old_posts NEW TABLE AS new_posts
+FOR EACH STATEMENT
+EXECUTE FUNCTION browse_feed_post_changed();
+
+DROP TRIGGER IF EXISTS users_feed_update_trigger ON users;
+CREATE TRIGGER users_feed_update_trigger
+AFTER UPDATE ON users
+REFERENCING OLD TABLE AS old_users NEW TABLE AS new_users
+FOR EACH STATEMENT
+EXECUTE FUNCTION browse_feed_owner_changed();
+
+DROP TRIGGER IF EXISTS location_feed_update_trigger ON location;
+CREATE TRIGGER location_feed_update_trigger
+AFTER UPDATE ON location
+REFERENCING OLD TABLE AS old_locations NEW TABLE AS new_locations
+FOR EACH STATEMENT
+EXECUTE FUNCTION browse_feed_location_changed();
+
+DROP TRIGGER IF EXISTS categories_feed_update_trigger ON categories;
+CREATE TRIGGER categories_feed_update_trigger
+AFTER UPDATE ON categories
+REFERENCING OLD TABLE AS old_categories NEW TABLE AS new_categories
+FOR EACH STATEMENT
+EXECUTE FUNCTION browse_feed_category_changed();
+
+-- 檢查 feed 有沒有跟 view 對不起來（flask feed check 用）
+-- missing：view 有、feed 沒有；extra：feed 有、view 沒有；stale：兩邊都有但內容不一樣
+CREATE OR REPLACE FUNCTION browse_feed_drift()
+RETURNS TABLE (kind text, id int, problem text) AS $$
+    SELECT 'item', COALESCE(s.item_id, f.item_id),
+           CASE WHEN f.item_id IS NULL THEN 'missing' WHEN s.item_id IS NULL THEN 'extra' ELSE 'stale' END
+    FROM browse_item_source s FULL JOIN browse_item_feed f ON f.item_id = s.item_id
+    WHERE f.item_id IS NULL OR s.item_id IS NULL OR to_jsonb(s) <> to_jsonb(f)
+    UNION ALL
+    SELECT 'post', COALESCE(s.post_id, f.post_id),
+           CASE WHEN f.post_id IS NULL THEN 'missing' WHEN s.post_id IS NULL THEN 'extra' ELSE 'stale' END
+    FROM browse_post_source s FULL JOIN browse_post_feed f ON f.post_id = s.post_id
+    WHERE f.post_id IS NULL OR s.post_id IS NULL OR to_jsonb(s) <> to_jsonb(f)
+    ORDER BY 1, 2;
+$$ LANGUAGE sql STABLE;
+
+-- 從 view 重算整個 feed，回傳修正了幾個物品、幾篇貼文
+-- 過程中會鎖住相關的表不讓別人寫（讀不影響），資料很多的話請挑沒人用的時候跑
+CREATE OR REPLACE FUNCTION rebuild_browse_feed(OUT fixed_items int, OUT fixed_posts int) AS $$
+BEGIN
+    LOCK TABLE item, post, users, location, categories IN SHARE MODE;
+    LOCK TABLE browse_item_feed, browse_post_feed IN EXCLUSIVE MODE;
+
+    SELECT COUNT(*) FILTER (WHERE kind = 'item'), COUNT(*) FILTER (WHERE kind = 'post')
+    INTO fixed_items, fixed_posts
+    FROM browse_feed_drift();
+
+    DELETE FROM browse_item_feed;
+    INSERT INTO browse_item_feed SELECT * FROM browse_item_source;
+    DELETE FROM browse_post_feed;
+    INSERT INTO browse_post_feed SELECT * FROM browse_post_source;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT * FROM rebuild_browse_feed();
+
+COMMIT;
+
+ANALYZE browse_item_feed;
+ANALYZE browse_post_feed;
@@ -0,0 +1,94 @@
+-- 012: 找附近的物品
+-- location 加上經緯度（刊登時用瀏覽器定位或自己填，不用 geocoding），首頁物品模式可以照距離找半徑內還有庫存的物品
+-- 這台 Postgres 沒有 cube / earthdistance / PostGIS，改用格子：經緯度每 0.01 度（大約 1 公里）一格，
+-- 格子編號存在 browse_item_feed.geo_cell 上用一般的 B-tree；找附近 = 半徑涵蓋的每一排格子各掃一段範圍，再算真正的距離
+-- 舊的地點沒有經緯度，不會出現在附近的結果裡，重新刊登時填上就有了
+-- psql -d <DB_NAME> -f migrations/012_location_coordinates.sql
+
+BEGIN;
+
+ALTER TABLE location ADD COLUMN IF NOT EXISTS lat double precision;
+ALTER TABLE location ADD COLUMN IF NOT EXISTS lon double precision;
+ALTER TABLE location DROP CONSTRAINT IF EXISTS location_coordinates_check;
+ALTER TABLE location ADD CONSTRAINT location_coordinates_check
+    CHECK ((lat IS NULL) = (lon IS NULL) AND lat BETWEEN -90 AND 90 AND lon BETWEEN -180 AND 180);
+
+-- 格子編號：緯度那一排 * 36000 + 經度那一格，同一排的格子編號是連續的（北極、180 度算在前一格）
+-- 這三個 function 都寫成可以被 planner 展開的樣子（geo_cell_ranges 不能是 STRICT、裡面不能用 least 之類遇到 NULL 不回 NULL 的），
+-- 不然每一列都要真的呼叫一次 function，找附近會慢很多
+CREATE OR REPLACE FUNCTION geo_cell(p_lat double precision, p_lon double precision) RETURNS bigint AS $$
+    SELECT (floor((p_lat + 90) * 100)::bigint - (p_lat >= 90)::int) * 36000
+         + floor((p_lon + 180) * 100)::bigint - (p_lon >= 180)::int
+$$ LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE;
+
+-- 半徑 p_radius_km 的圓蓋到的格子，一排一個範圍 (lo, hi)
+-- 經度的寬度照離赤道比較遠的那一邊算，寧可多掃一點；跨過 ±180 度的不處理（台灣用不到）
+CREATE OR REPLACE FUNCTION geo_cell_ranges(p_lat double precision, p_lon double precision, p_radius_km double precision)
+RETURNS TABLE (lo bigint, hi bigint) AS $$
+    SELECT r * 36000 + floor((greatest(p_lon - s.dlon, -180) + 180) * 100)::bigint,
+           r * 36000 + least(floor((least(p_lon + s.dlon, 180) + 180) * 100)::bigint, 35999)
+    FROM (
+        SELECT p_radius_km / 111.195 AS dlat,
+               least(p_radius_km / (111.195 * cos(radians(least(abs(p_lat) + p_radius_km / 111.195, 89.9)))), 180) AS dlon
+    ) s,
+    generate_series(floor((greatest(p_lat - s.dlat, -90) + 90) * 100)::bigint,
+                    least(floor((least(p_lat + s.dlat, 90) + 90) * 100)::bigint, 17999)) AS r
+$$ LANGUAGE sql IMMUTABLE PARALLEL SAFE ROWS 20;
+
+-- 兩點之間的距離（公里，haversine）：2R * asin(sqrt(a))
+-- 寫成 atan2(sqrt(a), sqrt(1 - a))，對蹠點附近捨入誤差讓 a 稍微大於 1 也不會出錯；要是單一個運算式才展開得了
+CREATE OR REPLACE FUNCTION geo_distance_km(p_lat1 double precision, p_lon1 double precision,
+                                           p_lat2 double precision, p_lon2 double precision) RETURNS double precision AS $$
+    SELECT 2 * 6371.0088 * atan2(
+        sqrt(sin(radians(p_lat2 - p_lat1) / 2) ^ 2
+             + cos(radians(p_lat1)) * cos(radians(p_lat2)) * sin(radians(p_lon2 - p_lon1) / 2) ^ 2),
+        sqrt(abs(1 - sin(radians(p_lat2 - p_lat1) / 2) ^ 2
+                   - cos(radians(p_lat1)) * cos(radians(p_lat2)) * sin(radians(p_lon2 - p_lon1) / 2) ^ 2)))
+$$ LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE;
+
+-- 物品模式的 feed 多放經緯度跟格子（加在最後面，欄位順序才會跟 view 一樣）
+CREATE OR REPLACE VIEW browse_item_source AS
+SELECT i.item_id, i.post_id, i.category_id, c.name AS category_name,
+       i.item_name, i.quantity, i.expiration_date,
+       p.description, p.available,
+       l.location_name, l.city, l.district, l.street, l.number,
+       p.user_id AS owner_id, u.name AS owner_name,
+       l.lat, l.lon, geo_cell(l.lat, l.lon) AS geo_cell
+FROM item i
+LEFT JOIN post p ON i.post_id = p.post_id
+LEFT JOIN location l ON i.location_id = l.location_id
+LEFT JOIN categories c ON i.category_id = c.category_id
+LEFT JOIN users u ON p.user_id = u.user_id
+WHERE i.quantity > 0 AND NOT i.expired;
+
+ALTER TABLE browse_item_feed ADD COLUMN IF NOT EXISTS lat double precision;
+ALTER TABLE browse_item_feed ADD COLUMN IF NOT EXISTS lon double precision;
+ALTER TABLE browse_item_feed ADD COLUMN IF NOT EXISTS geo_cell bigint;
+
+-- 找附近用：照格子掃，距離跟篩選要的欄位都在 index 裡（只讀 index），算完距離排好之後只回表拿那一頁
+CREATE INDEX IF NOT EXISTS browse_item_feed_geo_idx ON browse_item_feed (geo_cell)
+    INCLUDE (lat, lon, expiration_date, category_id, item_id)
+    WHERE geo_cell IS NOT NULL;
+
+-- 地點改了（包括改經緯度）：物品模式的 feed 要重算
+CREATE OR REPLACE FUNCTION browse_feed_location_changed() RETURNS TRIGGER AS $$
+DECLARE
+    post_ids int[];
+    item_ids int[];
+BEGIN
+    SELECT array_agg(DISTINCT i.post_id), array_agg(i.item_id) INTO post_ids, item_ids
+    FROM new_locations n
+    JOIN old_locations o ON o.location_id = n.location_id
+    JOIN item i ON i.location_id = n.location_id
+    WHERE (n.location_name, n.city, n.district, n.street, n.number, n.lat, n.lon)
+          IS DISTINCT FROM (o.location_name, o.city, o.district, o.street, o.number, o.lat, o.lon)
+      AND i.quantity > 0 AND NOT i.expired;
+
+    PERFORM refresh_browse_feed(post_ids, COALESCE(item_ids, '{}'));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+COMMIT;
+
+ANALYZE location;
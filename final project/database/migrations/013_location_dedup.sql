@@ -0,0 +1,54 @@
+-- 013: 一樣的地址只存一筆 location
+-- 之前每刊登一篇就新增一筆地點，預設的 新竹市/東區/大學路/1001號 每篇都多一筆，location 跟著貼文一直長
+-- 這裡加上正規化過的地址 address_key（unique），刊登時用 INSERT ... ON CONFLICT 拿已經有的那一筆；
+-- 已經重複的先合併：同一個地址留一筆（有座標的優先，再來是最早的），item.location_id 改指過去，其他的刪掉
+-- 合併的時候會鎖住 location 不讓別人新增（刊登會等一下），item 很多的話請挑沒人用的時候跑
+-- psql -d <DB_NAME> -f migrations/013_location_dedup.sql
+
+BEGIN;
+
+-- 比對地址用的 key：每一欄 NFKC（全形數字、全形空白換成半形）、拿掉所有空白、英文轉小寫、「臺」當成「台」，
+-- 再用 \x1f 接起來（欄位裡不會有這個字元，「大學路」+「1號」跟「大學」+「路1號」才不會變成一樣）
+-- generated column 跟 ON CONFLICT 都要用，所以一定要是 IMMUTABLE
+CREATE OR REPLACE FUNCTION normalize_address(p_location_name text, p_city text, p_district text,
+                                             p_street text, p_number text) RETURNS text AS $$
+    SELECT lower(translate(
+        regexp_replace(normalize(p_location_name, NFKC), '\s+', '', 'g') || E'\x1f' ||
+        regexp_replace(normalize(p_city, NFKC), '\s+', '', 'g') || E'\x1f' ||
+        regexp_replace(normalize(p_district, NFKC), '\s+', '', 'g') || E'\x1f' ||
+        regexp_replace(normalize(p_street, NFKC), '\s+', '', 'g') || E'\x1f' ||
+        regexp_replace(normalize(p_number, NFKC), '\s+', '', 'g'),
+        '臺', '台'))
+$$ LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE;
+
+ALTER TABLE location ADD COLUMN IF NOT EXISTS address_key text
+    GENERATED ALWAYS AS (normalize_address(location_name, city, district, street, number)) STORED;
+
+LOCK TABLE location IN SHARE ROW EXCLUSIVE MODE;
+
+-- 每一筆要合併到哪一筆
+CREATE TEMP TABLE location_merge ON COMMIT DROP AS
+SELECT location_id, keep_id
+FROM (
+    SELECT location_id,
+           first_value(location_id) OVER (PARTITION BY address_key ORDER BY lat IS NULL, location_id) AS keep_id
+    FROM location
+) m
+WHERE location_id <> keep_id;
+
+UPDATE item i
+SET location_id = m.keep_id
+FROM location_merge m
+WHERE i.location_id = m.location_id;
+
+DELETE FROM location l
+USING location_merge m
+WHERE l.location_id = m.location_id;
+
+ALTER TABLE location DROP CONSTRAINT IF EXISTS location_address_key_key;
+ALTER TABLE location ADD CONSTRAINT location_address_key_key UNIQUE (address_key);
+
+COMMIT;
+
+ANALYZE location;
+ANALYZE item;
@@ -0,0 +1,164 @@
+-- 014: 刪貼文、刪帳號改成先藏起來，背景再一批一批刪
+-- 原本 DELETE FROM users 會在同一個 transaction 裡 cascade 刪掉他所有的 trade、comment、item、post，
+-- 索取過幾萬次的帳號要刪很久，這段時間鎖著的列別人都要等；刪一篇很多人索取過的貼文也一樣
+-- 現在按刪除只做這些（很快）：
+--   post / users 標上 deleted_at、貼文結案、還有庫存的物品標成 expired（首頁、庫存計數、索取都已經會排除，不用再改）
+--   刪帳號的話 account、phone 直接刪，不能再登入，帳號名稱跟手機號碼可以給別人用
+--   在 purge_job 記一筆
+-- 真正刪資料由 purge_step() 一次刪一小批，app 的背景 thread（giveaway_app/purge_worker.py）跟 flask purge run 呼叫
+-- 做到哪一步記在 purge_job，跟刪掉的資料在同一個 transaction commit，中途當掉的話下次從那一步接著刪
+-- psql -d <DB_NAME> -f migrations/014_soft_delete.sql
+
+BEGIN;
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at timestamp;
+ALTER TABLE post ADD COLUMN IF NOT EXISTS deleted_at timestamp;
+
+-- 還沒刪完的：user 要刪他的評價、索取紀錄、貼文（含別人在上面的評價、索取）、最後是 users 那列；post 只刪那一篇
+-- step 是現在做到哪一步，deleted_rows 是目前總共刪了幾列
+CREATE TABLE IF NOT EXISTS purge_job (
+	job_id serial,
+	kind varchar(10) NOT NULL CHECK (kind IN ('user', 'post')),
+	target_id int NOT NULL,
+	step varchar(20) NOT NULL,
+	deleted_rows bigint NOT NULL DEFAULT 0,
+	requested_at timestamp NOT NULL DEFAULT current_timestamp,
+	updated_at timestamp NOT NULL DEFAULT current_timestamp,
+	finished_at timestamp,
+	PRIMARY KEY (job_id),
+	UNIQUE (kind, target_id)
+);
+CREATE INDEX IF NOT EXISTS purge_job_pending_idx ON purge_job (job_id) WHERE finished_at IS NULL;
+
+-- 每一種要照什麼順序刪：先刪最多的 trade / comment，item、post 刪的時候就不用再 cascade
+CREATE OR REPLACE FUNCTION purge_steps(p_kind text) RETURNS text[] AS $$
+    SELECT CASE p_kind
+        WHEN 'user' THEN ARRAY['user_comments', 'user_trades', 'comments', 'trades', 'items', 'posts', 'user', 'done']
+        ELSE ARRAY['comments', 'trades', 'items', 'posts', 'done']
+    END
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION soft_delete_post(p_post_id int) RETURNS void AS $$
+BEGIN
+    UPDATE post SET deleted_at = NOW(), available = false
+    WHERE post_id = p_post_id AND deleted_at IS NULL;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    UPDATE item SET expired = true
+    WHERE post_id = p_post_id AND quantity > 0 AND NOT expired;
+
+    INSERT INTO purge_job (kind, target_id, step)
+    VALUES ('post', p_post_id, (purge_steps('post'))[1])
+    ON CONFLICT (kind, target_id) DO NOTHING;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION soft_delete_user(p_user_id int) RETURNS void AS $$
+BEGIN
+    UPDATE users SET deleted_at = NOW()
+    WHERE user_id = p_user_id AND deleted_at IS NULL;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    DELETE FROM account WHERE user_id = p_user_id;
+    DELETE FROM phone WHERE user_id = p_user_id;
+
+    UPDATE post SET deleted_at = NOW(), available = false
+    WHERE user_id = p_user_id AND deleted_at IS NULL;
+    UPDATE item SET expired = true
+    WHERE post_id IN (SELECT post_id FROM post WHERE user_id = p_user_id) AND quantity > 0 AND NOT expired;
+
+    -- 他自己先刪的貼文已經有 post 的 job 了，這裡的 posts 那一步會一起刪，兩個 job 誰先做到都可以
+    INSERT INTO purge_job (kind, target_id, step)
+    VALUES ('user', p_user_id, (purge_steps('user'))[1])
+    ON CONFLICT (kind, target_id) DO NOTHING;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 拿最舊一個還沒刪完的 job，刪現在那一步的一批（最多 p_limit 列），回傳做了哪個 job、刪了幾列、做完了沒
+-- 這一步不到一批就換下一步，一批都沒刪到就接著做下一步，所以每次呼叫都會有進度
+-- 沒有要刪的就不回傳任何列；SKIP LOCKED：好幾個 worker 同時跑會各自拿不同的 job
+-- trade / comment 是分區表，一次刪一批要用 (id, 時間) 對回去
+CREATE OR REPLACE FUNCTION purge_step(p_limit int)
+RETURNS TABLE (job_id int, kind text, target_id int, step text, deleted int, done boolean) AS $$
+#variable_conflict use_column
+DECLARE
+    job purge_job%ROWTYPE;
+    steps text[];
+    post_ids int[];
+    n int;
+    total int := 0;
+BEGIN
+    SELECT * INTO job
+    FROM purge_job j
+    WHERE j.finished_at IS NULL
+    ORDER BY j.job_id
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    steps := purge_steps(job.kind);
+    IF job.kind = 'user' THEN
+        SELECT array_agg(p.post_id) INTO post_ids FROM post p WHERE p.user_id = job.target_id;
+    ELSE
+        SELECT array_agg(p.post_id) INTO post_ids FROM post p WHERE p.post_id = job.target_id;
+    END IF;
+    post_ids := COALESCE(post_ids, '{}');
+
+    WHILE job.step <> 'done' LOOP
+        IF job.step = 'user_comments' THEN
+            DELETE FROM comment
+            WHERE (comment_id, comment_time) IN (
+                SELECT c.comment_id, c.comment_time FROM comment c WHERE c.user_id = job.target_id LIMIT p_limit);
+        ELSIF job.step = 'user_trades' THEN
+            DELETE FROM trade
+            WHERE (trade_id, trade_time) IN (
+                SELECT t.trade_id, t.trade_time FROM trade t WHERE t.user_id = job.target_id LIMIT p_limit);
+        ELSIF job.step = 'comments' THEN
+            DELETE FROM comment
+            WHERE (comment_id, comment_time) IN (
+                SELECT c.comment_id, c.comment_time FROM comment c WHERE c.post_id = ANY(post_ids) LIMIT p_limit);
+        ELSIF job.step = 'trades' THEN
+            DELETE FROM trade
+            WHERE (trade_id, trade_time) IN (
+                SELECT t.trade_id, t.trade_time
+                FROM trade t
+                WHERE t.item_id IN (SELECT i.item_id FROM item i WHERE i.post_id = ANY(post_ids))
+                LIMIT p_limit);
+        ELSIF job.step = 'items' THEN
+            DELETE FROM item
+            WHERE item_id IN (SELECT i.item_id FROM item i WHERE i.post_id = ANY(post_ids) LIMIT p_limit);
+        ELSIF job.step = 'posts' THEN
+            DELETE FROM post
+            WHERE post_id IN (SELECT p.post_id FROM post p WHERE p.post_id = ANY(post_ids) LIMIT p_limit);
+        ELSIF job.step = 'user' THEN
+            -- 中間又有新的資料（舊的 session 還在刊登之類的）也會在這裡 cascade 掉
+            DELETE FROM users WHERE user_id = job.target_id;
+        END IF;
+        GET DIAGNOSTICS n = ROW_COUNT;
+        total := total + n;
+
+        IF n >= p_limit THEN
+            EXIT;
+        END IF;
+        job.step := steps[array_position(steps, job.step::text) + 1];
+        EXIT WHEN n > 0;
+    END LOOP;
+
+    UPDATE purge_job j
+    SET step = job.step,
+        deleted_rows = j.deleted_rows + total,
+        updated_at = NOW(),
+        finished_at = CASE WHEN job.step = 'done' THEN NOW() END
+    WHERE j.job_id = job.job_id;
+
+    RETURN QUERY SELECT job.job_id, job.kind::text, job.target_id, job.step::text, total, job.step = 'done';
+END;
+$$ LANGUAGE plpgsql;
+
+COMMIT;
@@ -1,7 +1,91 @@
+-- 全文搜尋用的斷詞
+-- 中文沒有空白可以斷詞，所以中日文字切成「單字 + 相鄰兩字 (bigram)」，英文數字就照單字切
+-- 例如 '微積分課本' -> 微, 微積, 積, 積分, 分, 分課, 課, 課本, 本
+CREATE OR REPLACE FUNCTION cjk_tsvector(txt text) RETURNS tsvector AS $$
+DECLARE
+    run text;
+    lexemes text[] := '{}';
+    pos int := 0;
+    n int;
+BEGIN
+    FOR run IN
+        SELECT m[1]
+        FROM regexp_matches(lower(normalize(COALESCE(txt, ''), NFKC)), '([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff]+|[a-z0-9]+)', 'g') AS m
+    LOOP
+        IF run ~ '^[a-z0-9]' THEN
+            pos := pos + 1;
+            lexemes := lexemes || format('''%s'':%s', run, LEAST(pos, 16383));
+        ELSE
+            n := char_length(run);
+            FOR k IN 1..n LOOP
+                pos := pos + 1;
+                lexemes := lexemes || format('''%s'':%s', substr(run, k, 1), LEAST(pos, 16383));
+                IF k < n THEN
+                    lexemes := lexemes || format('''%s'':%s', substr(run, k, 2), LEAST(pos, 16383));
+                END IF;
+            END LOOP;
+        END IF;
+    END LOOP;
+
+    RETURN array_to_string(lexemes, ' ')::tsvector;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE PARALLEL SAFE;
+
+-- 搜尋字串轉成 tsquery：中文連續的 bigram 用 <-> 接起來（等於要求整段字連在一起出現），
+-- 英文單字用前綴比對，不同段之間用 & 連接；完全沒有可搜尋的字就回傳 NULL
+CREATE OR REPLACE FUNCTION cjk_tsquery(txt text) RETURNS tsquery AS $$
+DECLARE
+    run text;
+    parts text[] := '{}';
+    grams text[];
+    n int;
+BEGIN
+    FOR run IN
+        SELECT m[1]
+        FROM regexp_matches(lower(normalize(COALESCE(txt, ''), NFKC)), '([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff]+|[a-z0-9]+)', 'g') AS m
+    LOOP
+        IF run ~ '^[a-z0-9]' THEN
+            parts := parts || format('''%s'':*', run);
+        ELSE
+            n := char_length(run);
+            IF n = 1 THEN
+                parts := parts || format('''%s''', run);
+            ELSE
+                grams := '{}';
+                FOR k IN 1..n - 1 LOOP
+                    grams := grams || format('''%s''', substr(run, k, 2));
+                END LOOP;
+                parts := parts || ('(' || array_to_string(grams, ' <-> ') || ')');
+            END IF;
+        END IF;
+    END LOOP;
+
+    IF cardinality(parts) = 0 THEN
+        RETURN NULL;
+    END IF;
+    RETURN array_to_string(parts, ' & ')::tsquery;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE PARALLEL SAFE;
+
+-- 比對地址用的 key：每一欄 NFKC（全形數字、全形空白換成半形）、拿掉所有空白、英文轉小寫、「臺」當成「台」，
+-- 再用 \x1f 接起來（欄位裡不會有這個字元，「大學路」+「1號」跟「大學」+「路1號」才不會變成一樣）
+-- generated column 跟 ON CONFLICT 都要用，所以一定要是 IMMUTABLE
+CREATE OR REPLACE FUNCTION normalize_address(p_location_name text, p_city text, p_district text,
+                                             p_street text, p_number text) RETURNS text AS $$
+    SELECT lower(translate(
+        regexp_replace(normalize(p_location_name, NFKC), '\s+', '', 'g') || E'\x1f' ||
+        regexp_replace(normalize(p_city, NFKC), '\s+', '', 'g') || E'\x1f' ||
+        regexp_replace(normalize(p_district, NFKC), '\s+', '', 'g') || E'\x1f' ||
+        regexp_replace(normalize(p_street, NFKC), '\s+', '', 'g') || E'\x1f' ||
+        regexp_replace(normalize(p_number, NFKC), '\s+', '', 'g'),
+        '臺', '台'))
+$$ LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE;
+
 CREATE TABLE IF NOT EXISTS users (
 	user_id serial,
 	name varchar(50) NOT NULL,
 	organization varchar,
+	deleted_at timestamp,   -- 刪帳號時先標起來，背景再慢慢刪（migrations/014）
 	primary key (user_id)
 );
 
@@ -25,7 +109,15 @@ CREATE TABLE IF NOT EXISTS location (
 	district varchar(50) NOT NULL,
 	street varchar(100) NOT NULL,
 	number varchar(20) NOT NULL,
-	primary key (location_id)
+	lat double precision,
+	lon double precision,
+	address_key text GENERATED ALWAYS AS (normalize_address(location_name, city, district, street, number)) STORED,
+	primary key (location_id),
+	-- 座標可以不填，要填就兩個一起填（刊登時用瀏覽器定位或自己填，找附近的物品用）
+	constraint location_coordinates_check
+		check ((lat IS NULL) = (lon IS NULL) AND lat BETWEEN -90 AND 90 AND lon BETWEEN -180 AND 180),
+	-- 一樣的地址只存一筆，刊登時 ON CONFLICT (address_key) 拿已經有的那一筆（migrations/013）
+	constraint location_address_key_key unique (address_key)
 );
 
 CREATE TABLE IF NOT EXISTS post (
@@ -34,21 +126,30 @@ CREATE TABLE IF NOT EXISTS post (
 	description TEXT NOT NULL,
 	post_time timestamp DEFAULT current_timestamp,
 	available boolean DEFAULT true,
+	remaining_quantity int NOT NULL DEFAULT 0,   -- 還沒被拿走的物品總數量，item 的 trigger 維護
+	remaining_items int NOT NULL DEFAULT 0,      -- 還有庫存的物品有幾樣，歸 0 就結案
+	search_tsv tsvector GENERATED ALWAYS AS (cjk_tsvector(description)) STORED,
+	deleted_at timestamp,   -- 刪貼文時先標起來（會一起結案），背景再慢慢刪
 	primary key (post_id),
 	foreign key (user_id) references users on delete cascade
 );
 
+-- trade / comment 照時間分區，一個月一個（migrations/010），分區由 ensure_partitions() 建
+-- 分區表的主鍵一定要包含分區的欄位，所以是 (id, 時間)；id 還是由序號產生，不會重複
 CREATE TABLE IF NOT EXISTS comment (
 	comment_id serial,
 	post_id int NOT NULL,
 	user_id int NOT NULL,
 	rating int NOT NULL CHECK (rating >= 0 and rating <= 5),
 	comment_str text NOT NULL,
-	comment_time timestamp DEFAULT current_timestamp,
-	primary key (comment_id),
+	comment_time timestamp NOT NULL DEFAULT current_timestamp,
+	primary key (comment_id, comment_time),
 	foreign key (user_id) references users on delete cascade,
 	foreign key (post_id) references post on delete cascade
-);
+) PARTITION BY RANGE (comment_time);
+
+-- 還沒有分區的月份先放這裡，ensure_partitions() 會再搬到那個月的分區
+CREATE TABLE IF NOT EXISTS comment_default PARTITION OF comment DEFAULT;
 
 CREATE TABLE IF NOT EXISTS item (
 	item_id serial,
@@ -58,6 +159,8 @@ CREATE TABLE IF NOT EXISTS item (
 	item_name text NOT NULL,
 	expiration_date timestamp NOT NULL,
 	quantity int NOT NULL CHECK (quantity >= 0),
+	expired boolean NOT NULL DEFAULT false,   -- expire_items() 標的，只標還有庫存的
+	search_tsv tsvector GENERATED ALWAYS AS (cjk_tsvector(item_name)) STORED,
 	primary key (item_id),
 	foreign key (category_id) references categories,
 	foreign key (post_id) references post on delete cascade,
@@ -70,9 +173,44 @@ CREATE TABLE IF NOT EXISTS trade (
 	item_id int NOT NULL,
 	quantity int NOT NULL CHECK (quantity > 0),
 	trade_time timestamp NOT NULL,
-	primary key (trade_id),
+	primary key (trade_id, trade_time),
 	foreign key (user_id) references users on delete cascade,
 	foreign key (item_id) references item on delete cascade
+) PARTITION BY RANGE (trade_time);
+
+CREATE TABLE IF NOT EXISTS trade_default PARTITION OF trade DEFAULT;
+
+-- 每個分類還剩多少東西，首頁的總數直接從這裡加
+-- 同一個分類拆成 16 個 shard (item_id % 16)，不然同分類的索取都要搶同一列
+CREATE TABLE IF NOT EXISTS category_stock (
+	category_id int NOT NULL,
+	shard smallint NOT NULL,
+	remaining_quantity bigint NOT NULL DEFAULT 0,
+	remaining_items int NOT NULL DEFAULT 0,
+	PRIMARY KEY (category_id, shard),
+	FOREIGN KEY (category_id) references categories on delete cascade
+);
+
+-- 每個使用者收到的評價（評在他貼文上的 comment），comment 的 trigger 維護
+-- 個人頁面、首頁發文者旁邊的分數直接讀這裡，不用每次 JOIN post、comment 再 AVG
+CREATE TABLE IF NOT EXISTS user_reputation (
+	user_id int NOT NULL,
+	rating_sum bigint NOT NULL DEFAULT 0,
+	rating_count int NOT NULL DEFAULT 0,
+	avg_rating numeric GENERATED ALWAYS AS (rating_sum::numeric / NULLIF(rating_count, 0)) STORED,
+	updated_at timestamp NOT NULL DEFAULT current_timestamp,
+	PRIMARY KEY (user_id),
+	FOREIGN KEY (user_id) references users on delete cascade
+);
+
+-- 已經封存（從 comment 拆走）的評價，user_reputation 的數字還是有算進去
+-- reputation_drift / rebuild_user_reputation 要加上這裡才對得起來
+CREATE TABLE IF NOT EXISTS archived_reputation (
+	user_id int NOT NULL,
+	rating_sum bigint NOT NULL DEFAULT 0,
+	rating_count int NOT NULL DEFAULT 0,
+	PRIMARY KEY (user_id),
+	FOREIGN KEY (user_id) references users on delete cascade
 );
 
 CREATE TABLE IF NOT EXISTS account (
@@ -84,6 +222,145 @@ CREATE TABLE IF NOT EXISTS account (
 	FOREIGN KEY (user_id) references users on delete cascade
 );
 
+-- 還沒刪完的：user 要刪他的評價、索取紀錄、貼文（含別人在上面的評價、索取）、最後是 users 那列；post 只刪那一篇
+-- step 是現在做到哪一步，deleted_rows 是目前總共刪了幾列
+CREATE TABLE IF NOT EXISTS purge_job (
+	job_id serial,
+	kind varchar(10) NOT NULL CHECK (kind IN ('user', 'post')),
+	target_id int NOT NULL,
+	step varchar(20) NOT NULL,
+	deleted_rows bigint NOT NULL DEFAULT 0,
+	requested_at timestamp NOT NULL DEFAULT current_timestamp,
+	updated_at timestamp NOT NULL DEFAULT current_timestamp,
+	finished_at timestamp,
+	PRIMARY KEY (job_id),
+	UNIQUE (kind, target_id)
+);
+CREATE INDEX IF NOT EXISTS purge_job_pending_idx ON purge_job (job_id) WHERE finished_at IS NULL;
+
+-- 常用查詢的 index（主鍵跟 username 以外的）
+-- item：trigger 跟每個 join 都用 post_id 找；partial index 只放還有庫存的，比較小
+CREATE INDEX IF NOT EXISTS item_post_id_idx ON item (post_id);
+CREATE INDEX IF NOT EXISTS item_in_stock_post_idx ON item (post_id) WHERE quantity > 0;
+-- 物品模式的排序 / 分頁順序，有分類篩選時用第二個；只放沒過期、還有庫存的，舊資料再多也不會變大
+CREATE INDEX IF NOT EXISTS item_live_browse_idx ON item (quantity DESC, post_id DESC, category_id, item_id) WHERE quantity > 0 AND NOT expired;
+CREATE INDEX IF NOT EXISTS item_live_category_browse_idx ON item (category_id, quantity DESC, post_id DESC, item_id) WHERE quantity > 0 AND NOT expired;
+-- expire_items() 找下一批要過期的
+CREATE INDEX IF NOT EXISTS item_expiring_idx ON item (expiration_date) WHERE quantity > 0 AND NOT expired;
+CREATE INDEX IF NOT EXISTS item_location_id_idx ON item (location_id);
+-- post：個人頁面照時間列出自己的貼文；貼文模式只看還在進行中的
+CREATE INDEX IF NOT EXISTS post_user_time_idx ON post (user_id, post_time DESC);
+CREATE INDEX IF NOT EXISTS post_available_idx ON post (post_id DESC) WHERE available;
+-- comment：一篇貼文的評價、某人有沒有評過這篇；user_id 給刪帳號的 cascade 用
+CREATE INDEX IF NOT EXISTS comment_post_user_idx ON comment (post_id, user_id);
+CREATE INDEX IF NOT EXISTS comment_user_id_idx ON comment (user_id);
+-- trade：個人頁面的索取紀錄；item_id 給刪貼文的 cascade 用
+CREATE INDEX IF NOT EXISTS trade_user_time_idx ON trade (user_id, trade_time DESC);
+CREATE INDEX IF NOT EXISTS trade_item_id_idx ON trade (item_id);
+CREATE INDEX IF NOT EXISTS phone_user_id_idx ON phone (user_id);
+
+-- 搜尋用的 GIN index
+CREATE INDEX IF NOT EXISTS item_search_idx ON item USING gin (search_tsv);
+CREATE INDEX IF NOT EXISTS post_search_idx ON post USING gin (search_tsv);
+
+-- 建某個月的分區（名字像 trade_y2025m01），已經有了就回傳 false
+-- default 分區裡已經有那個月的資料的話不能直接建，要先搬出來：另外建一張表、搬過去再掛上去
+-- 直接對分區 DELETE / INSERT，掛在 trade / comment 上的 trigger（扣庫存、評價）不會跑
+CREATE OR REPLACE FUNCTION create_month_partition(p_table text, p_column text, p_month date) RETURNS boolean AS $$
+DECLARE
+    month_start date := date_trunc('month', p_month)::date;
+    month_end date := (date_trunc('month', p_month) + interval '1 month')::date;
+    part text := p_table || to_char(p_month, '"_y"YYYY"m"MM');
+    has_rows boolean;
+BEGIN
+    IF to_regclass(part) IS NOT NULL THEN
+        RETURN false;
+    END IF;
+
+    -- 搬的時候不能有新的資料寫進 default 分區
+    EXECUTE format('LOCK TABLE %I IN EXCLUSIVE MODE', p_table || '_default');
+    EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I WHERE %I >= $1 AND %I < $2)', p_table || '_default', p_column, p_column)
+    INTO has_rows USING month_start, month_end;
+
+    IF NOT has_rows THEN
+        EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)', part, p_table, month_start, month_end);
+    ELSE
+        EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', part, p_table);
+        EXECUTE format('WITH moved AS (DELETE FROM %I WHERE %I >= $1 AND %I < $2 RETURNING *) INSERT INTO %I SELECT * FROM moved',
+                       p_table || '_default', p_column, p_column, part)
+        USING month_start, month_end;
+        EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', p_table, part, month_start, month_end);
+    END IF;
+    RETURN true;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 確保 trade / comment 從這個月到 p_months_ahead 個月後都有分區，
+-- default 分區裡有資料的月份也建起來（把資料搬過去），回傳這次建了幾個分區
+-- app 背景會定時呼叫（PARTITION_CHECK_INTERVAL），也可以用 flask --app app partitions ensure
+CREATE OR REPLACE FUNCTION ensure_partitions(p_months_ahead int DEFAULT 3) RETURNS int AS $$
+DECLARE
+    t record;
+    m date;
+    created int := 0;
+BEGIN
+    -- 好幾個 worker 同時呼叫的話排隊，不然會搶著建同一個分區
+    PERFORM pg_advisory_xact_lock(hashtext('ensure_partitions'));
+
+    FOR t IN SELECT * FROM (VALUES ('trade', 'trade_time'), ('comment', 'comment_time')) AS v(tbl, col) LOOP
+        FOR m IN
+            SELECT generate_series(date_trunc('month', current_date),
+                                   date_trunc('month', current_date) + make_interval(months => p_months_ahead),
+                                   interval '1 month')::date
+        LOOP
+            IF create_month_partition(t.tbl, t.col, m) THEN
+                created := created + 1;
+            END IF;
+        END LOOP;
+
+        FOR m IN EXECUTE format('SELECT DISTINCT date_trunc(''month'', %I)::date FROM %I', t.col, t.tbl || '_default') LOOP
+            IF create_month_partition(t.tbl, t.col, m) THEN
+                created := created + 1;
+            END IF;
+        END LOOP;
+    END LOOP;
+
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 封存前把分區拆下來，回傳裡面有幾筆
+-- comment 的分區拆下來之前，先把裡面的評價加到 archived_reputation
+-- （拆下來不會跑 comment 的 DELETE trigger，user_reputation 的數字不會變，封存之後評價還是一樣）
+CREATE OR REPLACE FUNCTION detach_partition(p_table text, p_partition text) RETURNS bigint AS $$
+DECLARE
+    n bigint;
+BEGIN
+    -- 先鎖住，算評價到拆下來中間不能有人刪掉裡面的 comment（刪貼文的 cascade）
+    EXECUTE format('LOCK TABLE %I IN ACCESS EXCLUSIVE MODE', p_table);
+
+    IF p_table = 'comment' THEN
+        EXECUTE format($q$
+            INSERT INTO archived_reputation AS r (user_id, rating_sum, rating_count)
+            SELECT p.user_id, SUM(c.rating), COUNT(*)
+            FROM %I c JOIN post p ON p.post_id = c.post_id
+            GROUP BY p.user_id
+            ON CONFLICT (user_id) DO UPDATE
+            SET rating_sum = r.rating_sum + EXCLUDED.rating_sum,
+                rating_count = r.rating_count + EXCLUDED.rating_count
+        $q$, p_partition);
+    END IF;
+
+    EXECUTE format('SELECT COUNT(*) FROM %I', p_partition) INTO n;
+    EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', p_table, p_partition);
+    RETURN n;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT ensure_partitions(3);
+
+-- 舊版的 trigger function：每一筆 trade 都查一次 post、扣一次庫存、數一次 post 剩幾個物品
+-- 已經換成下面 statement-level 的版本，留著給 tools/compare_inventory_triggers.py 對照用
 CREATE OR REPLACE FUNCTION update_inventory() RETURNS TRIGGER AS $$
 DECLARE
     target_post_id INT;
@@ -114,8 +391,915 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
+-- 扣庫存：一個 INSERT 不管塞幾筆 trade 只跑一次
+-- new_trades 是這次 INSERT 進來的所有 trade，同一個 item 的數量先加總再一次扣，
+-- 結案的判斷在 item 的 trigger 裡，每篇 post 只看一次計數，結果跟舊版一列一列做一樣
+CREATE OR REPLACE FUNCTION update_inventory_batch() RETURNS TRIGGER AS $$
+BEGIN
+    -- 照 item_id 順序先鎖，跟 claim_items() 一樣，避免兩個大量匯入互相 deadlock
+    PERFORM 1 FROM item WHERE item_id IN (SELECT item_id FROM new_trades) ORDER BY item_id FOR UPDATE;
+
+    -- post 的庫存計數、available 會由 item 的 trigger (update_stock_counters) 跟著更新
+    UPDATE item i
+    SET quantity = i.quantity - t.quantity
+    FROM (SELECT item_id, SUM(quantity) AS quantity FROM new_trades GROUP BY item_id) t
+    WHERE i.item_id = t.item_id;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
 -- 綁定 Trigger
-CREATE TRIGGER trade_insert_trigger
+CREATE TRIGGER trade_inventory_trigger
 AFTER INSERT ON trade
+REFERENCING NEW TABLE AS new_trades
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_inventory_batch();
+
+-- 庫存計數：item 新增 / 修改 / 刪除時，跟著調整 post 跟 category_stock 上的數字
+-- 這樣判斷 post 還有沒有東西、首頁的總數都不用再去 COUNT / SUM 整張 item
+-- INSERT / UPDATE / DELETE 各綁一個 statement-level trigger，共用這個 function
+-- 過期的物品 (expired) 不算庫存：標成過期就跟被拿完一樣，從計數裡扣掉
+CREATE OR REPLACE FUNCTION update_stock_counters() RETURNS TRIGGER AS $$
+DECLARE
+    post_ids int[];
+    category_ids int[];
+    shards int[];
+    quantities int[];
+    item_counts int[];
+BEGIN
+    -- 先把這次動到的 item 換成「加多少、減多少」：新的列算正的，舊的列算負的
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(post_id), array_agg(category_id), array_agg(item_id % 16),
+               array_agg(CASE WHEN expired THEN 0 ELSE quantity END), array_agg((quantity > 0 AND NOT expired)::int)
+        INTO post_ids, category_ids, shards, quantities, item_counts
+        FROM new_items;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(post_id), array_agg(category_id), array_agg(item_id % 16),
+               array_agg(CASE WHEN expired THEN 0 ELSE -quantity END), array_agg(-(quantity > 0 AND NOT expired)::int)
+        INTO post_ids, category_ids, shards, quantities, item_counts
+        FROM old_items;
+    ELSE
+        SELECT array_agg(d.post_id), array_agg(d.category_id), array_agg(d.item_id % 16),
+               array_agg(d.quantity), array_agg(d.items)
+        INTO post_ids, category_ids, shards, quantities, item_counts
+        FROM (
+            SELECT post_id, category_id, item_id, CASE WHEN expired THEN 0 ELSE quantity END AS quantity,
+                   (quantity > 0 AND NOT expired)::int AS items
+            FROM new_items
+            UNION ALL
+            SELECT post_id, category_id, item_id, CASE WHEN expired THEN 0 ELSE -quantity END,
+                   -(quantity > 0 AND NOT expired)::int
+            FROM old_items
+        ) d;
+    END IF;
+
+    IF post_ids IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    -- 照 post_id 順序先鎖，同時有好幾個 transaction 在改同一批 post 也不會 deadlock
+    PERFORM 1 FROM post WHERE post_id = ANY(post_ids) ORDER BY post_id FOR UPDATE;
+
+    -- 物品數量都歸 0（或都過期）了 -> post available = false（跟以前一樣，不會自己變回 true）
+    UPDATE post p
+    SET remaining_quantity = p.remaining_quantity + d.quantity,
+        remaining_items = p.remaining_items + d.items,
+        available = p.available AND p.remaining_items + d.items > 0
+    FROM (
+        SELECT d.post_id, SUM(d.quantity) AS quantity, SUM(d.items) AS items
+        FROM unnest(post_ids, quantities, item_counts) AS d(post_id, quantity, items)
+        GROUP BY d.post_id
+    ) d
+    WHERE p.post_id = d.post_id
+    AND (d.quantity <> 0 OR d.items <> 0);
+
+    INSERT INTO category_stock AS cs (category_id, shard, remaining_quantity, remaining_items)
+    SELECT d.category_id, d.shard, SUM(d.quantity), SUM(d.items)
+    FROM unnest(category_ids, shards, quantities, item_counts) AS d(category_id, shard, quantity, items)
+    GROUP BY d.category_id, d.shard
+    HAVING SUM(d.quantity) <> 0 OR SUM(d.items) <> 0
+    ORDER BY d.category_id, d.shard
+    ON CONFLICT (category_id, shard) DO UPDATE
+    SET remaining_quantity = cs.remaining_quantity + EXCLUDED.remaining_quantity,
+        remaining_items = cs.remaining_items + EXCLUDED.remaining_items;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER item_stock_insert_trigger
+AFTER INSERT ON item
+REFERENCING NEW TABLE AS new_items
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_stock_counters();
+
+CREATE TRIGGER item_stock_update_trigger
+AFTER UPDATE ON item
+REFERENCING OLD TABLE AS old_items NEW TABLE AS new_items
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_stock_counters();
+
+CREATE TRIGGER item_stock_delete_trigger
+AFTER DELETE ON item
+REFERENCING OLD TABLE AS old_items
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_stock_counters();
+
+-- 檢查計數有沒有跟 item 對不起來，回傳對不起來的 post / 分類（flask stock check 用）
+CREATE OR REPLACE FUNCTION stock_counter_drift()
+RETURNS TABLE (kind text, id int, counted_quantity bigint, actual_quantity bigint,
+               counted_items bigint, actual_items bigint) AS $$
+    WITH actual_post AS (
+        SELECT post_id, COALESCE(SUM(quantity) FILTER (WHERE NOT expired), 0) AS quantity,
+               COUNT(*) FILTER (WHERE quantity > 0 AND NOT expired) AS items
+        FROM item GROUP BY post_id
+    ), actual_category AS (
+        SELECT category_id, COALESCE(SUM(quantity) FILTER (WHERE NOT expired), 0) AS quantity,
+               COUNT(*) FILTER (WHERE quantity > 0 AND NOT expired) AS items
+        FROM item GROUP BY category_id
+    ), counted_category AS (
+        SELECT category_id, SUM(remaining_quantity) AS quantity, SUM(remaining_items) AS items
+        FROM category_stock GROUP BY category_id
+    )
+    SELECT 'post', p.post_id, p.remaining_quantity::bigint, COALESCE(a.quantity, 0),
+           p.remaining_items::bigint, COALESCE(a.items, 0)
+    FROM post p LEFT JOIN actual_post a ON a.post_id = p.post_id
+    WHERE (p.remaining_quantity, p.remaining_items) IS DISTINCT FROM (COALESCE(a.quantity, 0), COALESCE(a.items, 0))
+    UNION ALL
+    SELECT 'category', COALESCE(c.category_id, a.category_id), COALESCE(c.quantity, 0), COALESCE(a.quantity, 0),
+           COALESCE(c.items, 0), COALESCE(a.items, 0)
+    FROM counted_category c FULL JOIN actual_category a ON a.category_id = c.category_id
+    WHERE (COALESCE(c.quantity, 0), COALESCE(c.items, 0)) IS DISTINCT FROM (COALESCE(a.quantity, 0), COALESCE(a.items, 0))
+    ORDER BY 1, 2;
+$$ LANGUAGE sql STABLE;
+
+-- 從 item 重算所有計數，回傳修正了幾篇 post、幾個分類
+-- 過程中會鎖住 item 不讓別人寫（讀不影響），資料很多的話請挑沒人用的時候跑
+CREATE OR REPLACE FUNCTION rebuild_stock_counters(OUT fixed_posts int, OUT fixed_categories int) AS $$
+BEGIN
+    LOCK TABLE item IN SHARE MODE;
+    LOCK TABLE category_stock IN EXCLUSIVE MODE;
+
+    SELECT COUNT(*) FILTER (WHERE kind = 'category') INTO fixed_categories FROM stock_counter_drift();
+
+    UPDATE post p
+    SET remaining_quantity = COALESCE(a.quantity, 0),
+        remaining_items = COALESCE(a.items, 0)
+    FROM post p2
+    LEFT JOIN (
+        SELECT post_id, COALESCE(SUM(quantity) FILTER (WHERE NOT expired), 0) AS quantity,
+               COUNT(*) FILTER (WHERE quantity > 0 AND NOT expired) AS items
+        FROM item GROUP BY post_id
+    ) a ON a.post_id = p2.post_id
+    WHERE p.post_id = p2.post_id
+    AND (p.remaining_quantity, p.remaining_items) IS DISTINCT FROM (COALESCE(a.quantity, 0), COALESCE(a.items, 0));
+    GET DIAGNOSTICS fixed_posts = ROW_COUNT;
+
+    DELETE FROM category_stock;
+    INSERT INTO category_stock (category_id, shard, remaining_quantity, remaining_items)
+    SELECT category_id, item_id % 16, COALESCE(SUM(quantity) FILTER (WHERE NOT expired), 0),
+           COUNT(*) FILTER (WHERE quantity > 0 AND NOT expired)
+    FROM item
+    GROUP BY category_id, item_id % 16;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 過期下架：過了 expiration_date 還有庫存的物品標成 expired，一次最多 p_limit 筆，回傳標了幾筆
+-- 扣計數、全部過期的 post 結案都交給 item 的 trigger (update_stock_counters)
+-- SKIP LOCKED：正在被索取的先跳過下一輪再標，好幾個 worker 同時跑也不會互等
+-- app 的背景 thread（giveaway_app/expiry_sweeper.py）跟 flask stock expire 都是呼叫這個
+-- 沒有要標的就直接回傳 0，不跑 UPDATE：item 的 statement trigger 連 0 列都會 NOTIFY，每輪空掃都會清掉所有快取
+CREATE OR REPLACE FUNCTION expire_items(p_limit int) RETURNS int AS $$
+DECLARE
+    due int[];
+    n int;
+BEGIN
+    SELECT array_agg(d.item_id) INTO due
+    FROM (
+        SELECT item_id
+        FROM item
+        WHERE quantity > 0 AND NOT expired AND expiration_date <= NOW()
+        ORDER BY expiration_date
+        LIMIT p_limit
+        FOR UPDATE SKIP LOCKED
+    ) d;
+    IF due IS NULL THEN
+        RETURN 0;
+    END IF;
+
+    UPDATE item SET expired = true WHERE item_id = ANY(due);
+    GET DIAGNOSTICS n = ROW_COUNT;
+    RETURN n;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 評價計數：comment 新增 / 刪除時調整發文者的 user_reputation
+-- 整篇 post 被刪掉的時候，post 的 BEFORE DELETE trigger 會先把那篇的評價一次扣掉；
+-- 之後 cascade 刪 comment 時 post 已經不在了，JOIN 不到就不會重複扣
+CREATE OR REPLACE FUNCTION update_user_reputation() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO user_reputation AS r (user_id, rating_sum, rating_count)
+        SELECT p.user_id, SUM(c.rating), COUNT(*)
+        FROM new_comments c JOIN post p ON p.post_id = c.post_id
+        GROUP BY p.user_id
+        ORDER BY p.user_id
+        ON CONFLICT (user_id) DO UPDATE
+        SET rating_sum = r.rating_sum + EXCLUDED.rating_sum,
+            rating_count = r.rating_count + EXCLUDED.rating_count,
+            updated_at = current_timestamp;
+    ELSE
+        -- 只用 UPDATE：發文者可能正在被刪除，不能再 INSERT 一列回去
+        UPDATE user_reputation r
+        SET rating_sum = r.rating_sum - d.rating_sum,
+            rating_count = r.rating_count - d.rating_count,
+            updated_at = current_timestamp
+        FROM (
+            SELECT p.user_id, SUM(c.rating) AS rating_sum, COUNT(*) AS rating_count
+            FROM old_comments c JOIN post p ON p.post_id = c.post_id
+            GROUP BY p.user_id
+        ) d
+        WHERE r.user_id = d.user_id
+        AND EXISTS (SELECT 1 FROM users u WHERE u.user_id = r.user_id);
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER comment_reputation_insert_trigger
+AFTER INSERT ON comment
+REFERENCING NEW TABLE AS new_comments
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_user_reputation();
+
+CREATE TRIGGER comment_reputation_delete_trigger
+AFTER DELETE ON comment
+REFERENCING OLD TABLE AS old_comments
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_user_reputation();
+
+CREATE OR REPLACE FUNCTION remove_post_reputation() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE user_reputation r
+    SET rating_sum = r.rating_sum - d.rating_sum,
+        rating_count = r.rating_count - d.rating_count,
+        updated_at = current_timestamp
+    FROM (
+        SELECT SUM(rating) AS rating_sum, COUNT(*) AS rating_count
+        FROM comment
+        WHERE post_id = OLD.post_id
+    ) d
+    WHERE r.user_id = OLD.user_id
+    AND d.rating_count > 0
+    -- 整個使用者被刪掉時 users 那列已經不在了，user_reputation 等一下也會 cascade 刪掉，不用扣
+    -- （硬要 UPDATE 的話，同一個 transaction 裡第二次改到這列會觸發 FK 檢查而失敗）
+    AND EXISTS (SELECT 1 FROM users u WHERE u.user_id = r.user_id);
+
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER post_reputation_delete_trigger
+BEFORE DELETE ON post
 FOR EACH ROW
-EXECUTE FUNCTION update_inventory();
\ No newline at end of file
+EXECUTE FUNCTION remove_post_reputation();
+
+-- 檢查 user_reputation 有沒有跟 comment 對不起來（flask reputation check 用）
+-- 封存掉的評價在 archived_reputation，也要算進去
+CREATE OR REPLACE FUNCTION reputation_drift()
+RETURNS TABLE (user_id int, counted_sum bigint, actual_sum bigint, counted_count bigint, actual_count bigint) AS $$
+    WITH actual AS (
+        SELECT s.user_id, SUM(s.rating_sum)::bigint AS rating_sum, SUM(s.rating_count)::bigint AS rating_count
+        FROM (
+            SELECT p.user_id, SUM(c.rating) AS rating_sum, COUNT(*) AS rating_count
+            FROM comment c JOIN post p ON p.post_id = c.post_id
+            GROUP BY p.user_id
+            UNION ALL
+            SELECT user_id, rating_sum, rating_count FROM archived_reputation
+        ) s
+        GROUP BY s.user_id
+    )
+    SELECT COALESCE(r.user_id, a.user_id), COALESCE(r.rating_sum, 0), COALESCE(a.rating_sum, 0),
+           COALESCE(r.rating_count, 0)::bigint, COALESCE(a.rating_count, 0)
+    FROM user_reputation r FULL JOIN actual a ON a.user_id = r.user_id
+    WHERE (COALESCE(r.rating_sum, 0), COALESCE(r.rating_count, 0)) IS DISTINCT FROM (COALESCE(a.rating_sum, 0), COALESCE(a.rating_count, 0))
+    ORDER BY 1;
+$$ LANGUAGE sql STABLE;
+
+-- 從 comment（加上封存掉的）重算所有人的評價，回傳修正了幾個人
+CREATE OR REPLACE FUNCTION rebuild_user_reputation(OUT fixed_users int) AS $$
+BEGIN
+    LOCK TABLE comment IN SHARE MODE;
+    LOCK TABLE archived_reputation IN SHARE MODE;
+    LOCK TABLE user_reputation IN EXCLUSIVE MODE;
+
+    SELECT COUNT(*) INTO fixed_users FROM reputation_drift();
+
+    DELETE FROM user_reputation;
+    INSERT INTO user_reputation (user_id, rating_sum, rating_count)
+    SELECT s.user_id, SUM(s.rating_sum), SUM(s.rating_count)
+    FROM (
+        SELECT p.user_id, SUM(c.rating) AS rating_sum, COUNT(*) AS rating_count
+        FROM comment c JOIN post p ON p.post_id = c.post_id
+        GROUP BY p.user_id
+        UNION ALL
+        SELECT user_id, rating_sum, rating_count FROM archived_reputation
+    ) s
+    GROUP BY s.user_id;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 找附近的物品（migrations/012）：沒有 cube / earthdistance / PostGIS 也能用的格子
+-- 經緯度每 0.01 度（大約 1 公里）一格，格子編號存在 browse_item_feed.geo_cell 上用一般的 B-tree；
+-- 找附近 = 半徑涵蓋的每一排格子各掃一段範圍，再算真正的距離
+-- 格子編號：緯度那一排 * 36000 + 經度那一格，同一排的格子編號是連續的（北極、180 度算在前一格）
+-- 這三個 function 都寫成可以被 planner 展開的樣子（geo_cell_ranges 不能是 STRICT、裡面不能用 least 之類遇到 NULL 不回 NULL 的），
+-- 不然每一列都要真的呼叫一次 function，找附近會慢很多
+CREATE OR REPLACE FUNCTION geo_cell(p_lat double precision, p_lon double precision) RETURNS bigint AS $$
+    SELECT (floor((p_lat + 90) * 100)::bigint - (p_lat >= 90)::int) * 36000
+         + floor((p_lon + 180) * 100)::bigint - (p_lon >= 180)::int
+$$ LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE;
+
+-- 半徑 p_radius_km 的圓蓋到的格子，一排一個範圍 (lo, hi)
+-- 經度的寬度照離赤道比較遠的那一邊算，寧可多掃一點；跨過 ±180 度的不處理（台灣用不到）
+CREATE OR REPLACE FUNCTION geo_cell_ranges(p_lat double precision, p_lon double precision, p_radius_km double precision)
+RETURNS TABLE (lo bigint, hi bigint) AS $$
+    SELECT r * 36000 + floor((greatest(p_lon - s.dlon, -180) + 180) * 100)::bigint,
+           r * 36000 + least(floor((least(p_lon + s.dlon, 180) + 180) * 100)::bigint, 35999)
+    FROM (
+        SELECT p_radius_km / 111.195 AS dlat,
+               least(p_radius_km / (111.195 * cos(radians(least(abs(p_lat) + p_radius_km / 111.195, 89.9)))), 180) AS dlon
+    ) s,
+    generate_series(floor((greatest(p_lat - s.dlat, -90) + 90) * 100)::bigint,
+                    least(floor((least(p_lat + s.dlat, 90) + 90) * 100)::bigint, 17999)) AS r
+$$ LANGUAGE sql IMMUTABLE PARALLEL SAFE ROWS 20;
+
+-- 兩點之間的距離（公里，haversine）：2R * asin(sqrt(a))
+-- 寫成 atan2(sqrt(a), sqrt(1 - a))，對蹠點附近捨入誤差讓 a 稍微大於 1 也不會出錯；要是單一個運算式才展開得了
+CREATE OR REPLACE FUNCTION geo_distance_km(p_lat1 double precision, p_lon1 double precision,
+                                           p_lat2 double precision, p_lon2 double precision) RETURNS double precision AS $$
+    SELECT 2 * 6371.0088 * atan2(
+        sqrt(sin(radians(p_lat2 - p_lat1) / 2) ^ 2
+             + cos(radians(p_lat1)) * cos(radians(p_lat2)) * sin(radians(p_lon2 - p_lon1) / 2) ^ 2),
+        sqrt(abs(1 - sin(radians(p_lat2 - p_lat1) / 2) ^ 2
+                   - cos(radians(p_lat1)) * cos(radians(p_lat2)) * sin(radians(p_lon2 - p_lon1) / 2) ^ 2)))
+$$ LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE;
+
+-- 首頁的 feed 表（migrations/011）：首頁不用每次五張表 JOIN，貼文模式也不用在 Python 重新分組
+-- browse_item_feed 一個還有庫存的物品一列，browse_post_feed 一篇進行中的貼文一列（物品整理成 jsonb 陣列）
+-- 搜尋還是照原本的 JOIN 算相關度，只有沒搜尋的首頁（含分類篩選）讀 feed
+-- feed 的內容就是這兩個 view，trigger、flask feed check / rebuild 都是拿 feed 跟 view 比
+-- 物品模式：還有庫存、沒被標成過期的物品（過了期限還沒標到的，查詢時再用 expiration_date 擋）
+CREATE OR REPLACE VIEW browse_item_source AS
+SELECT i.item_id, i.post_id, i.category_id, c.name AS category_name,
+       i.item_name, i.quantity, i.expiration_date,
+       p.description, p.available,
+       l.location_name, l.city, l.district, l.street, l.number,
+       p.user_id AS owner_id, u.name AS owner_name,
+       l.lat, l.lon, geo_cell(l.lat, l.lon) AS geo_cell
+FROM item i
+LEFT JOIN post p ON i.post_id = p.post_id
+LEFT JOIN location l ON i.location_id = l.location_id
+LEFT JOIN categories c ON i.category_id = c.category_id
+LEFT JOIN users u ON p.user_id = u.user_id
+WHERE i.quantity > 0 AND NOT i.expired;
+
+-- 貼文模式：進行中的貼文，底下全部的物品（包括被拿完、過期的，頁面上會顯示「無法索取」）照分類、item_id 排好
+CREATE OR REPLACE VIEW browse_post_source AS
+SELECT p.post_id, p.description, p.user_id AS owner_id, u.name AS owner_name,
+       array_agg(DISTINCT i.category_id ORDER BY i.category_id) AS category_ids,
+       jsonb_agg(jsonb_build_object(
+           'item_id', i.item_id, 'item_name', i.item_name, 'quantity', i.quantity,
+           'expired', i.expired, 'expiration_date', i.expiration_date,
+           'category_id', i.category_id, 'category_name', c.name
+       ) ORDER BY i.category_id, i.item_id) AS items
+FROM post p
+JOIN item i ON i.post_id = p.post_id
+LEFT JOIN categories c ON i.category_id = c.category_id
+LEFT JOIN users u ON p.user_id = u.user_id
+WHERE p.available
+GROUP BY p.post_id, u.name;
+
+-- 欄位順序要跟上面的 view 一樣（INSERT ... SELECT * 跟檢查都是照順序對）
+CREATE TABLE IF NOT EXISTS browse_item_feed (
+	item_id int NOT NULL,
+	post_id int NOT NULL,
+	category_id int NOT NULL,
+	category_name varchar(50),
+	item_name text NOT NULL,
+	quantity int NOT NULL,
+	expiration_date timestamp NOT NULL,
+	description text,
+	available boolean,
+	location_name varchar(50),
+	city varchar(50),
+	district varchar(50),
+	street varchar(100),
+	number varchar(20),
+	owner_id int,
+	owner_name varchar(50),
+	lat double precision,
+	lon double precision,
+	geo_cell bigint,
+	PRIMARY KEY (item_id)
+);
+
+CREATE TABLE IF NOT EXISTS browse_post_feed (
+	post_id int NOT NULL,
+	description text NOT NULL,
+	owner_id int NOT NULL,
+	owner_name varchar(50),
+	category_ids int[] NOT NULL,
+	items jsonb NOT NULL,
+	PRIMARY KEY (post_id)
+);
+
+-- 物品模式的排序 / 分頁順序，有分類篩選時用第二個；貼文模式照 post_id 倒著排用主鍵，分類篩選用 GIN
+CREATE INDEX IF NOT EXISTS browse_item_feed_order_idx ON browse_item_feed (quantity DESC, post_id DESC, category_id, item_id);
+CREATE INDEX IF NOT EXISTS browse_item_feed_category_idx ON browse_item_feed (category_id, quantity DESC, post_id DESC, item_id);
+CREATE INDEX IF NOT EXISTS browse_post_feed_category_idx ON browse_post_feed USING gin (category_ids);
+-- 找附近用：照格子掃，距離跟篩選要的欄位都在 index 裡（只讀 index），算完距離排好之後只回表拿那一頁
+CREATE INDEX IF NOT EXISTS browse_item_feed_geo_idx ON browse_item_feed (geo_cell)
+    INCLUDE (lat, lon, expiration_date, category_id, item_id)
+    WHERE geo_cell IS NOT NULL;
+
+-- 重算這些 post（跟 p_item_ids 這些物品）在 feed 裡的列；沒給 p_item_ids 就是這些 post 底下還有庫存的物品
+-- 先照 post_id 順序鎖住 post：同一篇的物品同時被索取時，後面的人要等前面的 commit 完才重算，
+-- 不然可能拿到舊的數字蓋回去（索取本來就會更新 post 上的庫存計數，一樣要等這把鎖）
+CREATE OR REPLACE FUNCTION refresh_browse_feed(p_post_ids int[], p_item_ids int[] DEFAULT NULL) RETURNS void AS $$
+BEGIN
+    IF cardinality(p_post_ids) IS NULL AND cardinality(p_item_ids) IS NULL THEN
+        RETURN;
+    END IF;
+
+    PERFORM 1 FROM post WHERE post_id = ANY(p_post_ids) ORDER BY post_id FOR NO KEY UPDATE;
+
+    IF p_item_ids IS NULL THEN
+        SELECT array_agg(item_id) INTO p_item_ids
+        FROM item WHERE post_id = ANY(p_post_ids) AND quantity > 0 AND NOT expired;
+    END IF;
+
+    DELETE FROM browse_item_feed WHERE item_id = ANY(p_item_ids);
+    INSERT INTO browse_item_feed SELECT * FROM browse_item_source WHERE item_id = ANY(p_item_ids);
+
+    DELETE FROM browse_post_feed WHERE post_id = ANY(p_post_ids);
+    INSERT INTO browse_post_feed SELECT * FROM browse_post_source WHERE post_id = ANY(p_post_ids);
+END;
+$$ LANGUAGE plpgsql;
+
+-- item 新增 / 修改 / 刪除（索取扣庫存、過期下架、刪貼文的 cascade 都會走到這裡）
+-- trade 不用另外綁：索取時 trade 的 trigger 會去改 item，就會走到這裡
+CREATE OR REPLACE FUNCTION browse_feed_item_changed() RETURNS TRIGGER AS $$
+DECLARE
+    post_ids int[];
+    item_ids int[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(DISTINCT post_id), array_agg(item_id) INTO post_ids, item_ids FROM new_items;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(DISTINCT post_id), array_agg(item_id) INTO post_ids, item_ids FROM old_items;
+    ELSE
+        SELECT array_agg(DISTINCT post_id), array_agg(DISTINCT item_id) INTO post_ids, item_ids
+        FROM (SELECT post_id, item_id FROM new_items UNION ALL SELECT post_id, item_id FROM old_items) s;
+    END IF;
+
+    PERFORM refresh_browse_feed(post_ids, COALESCE(item_ids, '{}'));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- post 修改：每次索取 post 上的庫存計數都會變，那些 feed 用不到，只看 feed 裡有的欄位
+-- 刪除不用另外處理，底下的 item 被 cascade 刪掉時會走上面那個
+CREATE OR REPLACE FUNCTION browse_feed_post_changed() RETURNS TRIGGER AS $$
+DECLARE
+    post_ids int[];
+BEGIN
+    SELECT array_agg(n.post_id) INTO post_ids
+    FROM new_posts n JOIN old_posts o ON o.post_id = n.post_id
+    WHERE (n.description, n.user_id, n.available) IS DISTINCT FROM (o.description, o.user_id, o.available);
+
+    PERFORM refresh_browse_feed(post_ids);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 發文者改名字
+CREATE OR REPLACE FUNCTION browse_feed_owner_changed() RETURNS TRIGGER AS $$
+DECLARE
+    post_ids int[];
+BEGIN
+    SELECT array_agg(p.post_id) INTO post_ids
+    FROM new_users n
+    JOIN old_users o ON o.user_id = n.user_id
+    JOIN post p ON p.user_id = n.user_id
+    WHERE n.name IS DISTINCT FROM o.name;
+
+    PERFORM refresh_browse_feed(post_ids);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 地點改了（包括改經緯度）：只有物品模式有顯示地點
+CREATE OR REPLACE FUNCTION browse_feed_location_changed() RETURNS TRIGGER AS $$
+DECLARE
+    post_ids int[];
+    item_ids int[];
+BEGIN
+    SELECT array_agg(DISTINCT i.post_id), array_agg(i.item_id) INTO post_ids, item_ids
+    FROM new_locations n
+    JOIN old_locations o ON o.location_id = n.location_id
+    JOIN item i ON i.location_id = n.location_id
+    WHERE (n.location_name, n.city, n.district, n.street, n.number, n.lat, n.lon)
+          IS DISTINCT FROM (o.location_name, o.city, o.district, o.street, o.number, o.lat, o.lon)
+      AND i.quantity > 0 AND NOT i.expired;
+
+    PERFORM refresh_browse_feed(post_ids, COALESCE(item_ids, '{}'));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 分類改名字：有這個分類物品的貼文都要重算（貼文模式的物品裡也有分類名稱）
+CREATE OR REPLACE FUNCTION browse_feed_category_changed() RETURNS TRIGGER AS $$
+DECLARE
+    post_ids int[];
+BEGIN
+    SELECT array_agg(DISTINCT i.post_id) INTO post_ids
+    FROM new_categories n
+    JOIN old_categories o ON o.category_id = n.category_id
+    JOIN item i ON i.category_id = n.category_id
+    WHERE n.name IS DISTINCT FROM o.name;
+
+    PERFORM refresh_browse_feed(post_ids);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER item_feed_insert_trigger
+AFTER INSERT ON item
+REFERENCING NEW TABLE AS new_items
+FOR EACH STATEMENT
+EXECUTE FUNCTION browse_feed_item_changed();
+
+CREATE TRIGGER item_feed_update_trigger
+AFTER UPDATE ON item
+REFERENCING OLD TABLE AS old_items NEW TABLE AS new_items
+FOR EACH STATEMENT
+EXECUTE FUNCTION browse_feed_item_changed();
+
+CREATE TRIGGER item_feed_delete_trigger
+AFTER DELETE ON item
+REFERENCING OLD TABLE AS old_items
+FOR EACH STATEMENT
+EXECUTE FUNCTION browse_feed_item_changed();
+
+CREATE TRIGGER post_feed_update_trigger
+AFTER UPDATE ON post
+REFERENCING OLD TABLE AS old_posts NEW TABLE AS new_posts
+FOR EACH STATEMENT
+EXECUTE FUNCTION browse_feed_post_changed();
+
+CREATE TRIGGER users_feed_update_trigger
+AFTER UPDATE ON users
+REFERENCING OLD TABLE AS old_users NEW TABLE AS new_users
+FOR EACH STATEMENT
+EXECUTE FUNCTION browse_feed_owner_changed();
+
+CREATE TRIGGER location_feed_update_trigger
+AFTER UPDATE ON location
+REFERENCING OLD TABLE AS old_locations NEW TABLE AS new_locations
+FOR EACH STATEMENT
+EXECUTE FUNCTION browse_feed_location_changed();
+
+CREATE TRIGGER categories_feed_update_trigger
+AFTER UPDATE ON categories
+REFERENCING OLD TABLE AS old_categories NEW TABLE AS new_categories
+FOR EACH STATEMENT
+EXECUTE FUNCTION browse_feed_category_changed();
+
+-- 檢查 feed 有沒有跟 view 對不起來（flask feed check 用）
+-- missing：view 有、feed 沒有；extra：feed 有、view 沒有；stale：兩邊都有但內容不一樣
+CREATE OR REPLACE FUNCTION browse_feed_drift()
+RETURNS TABLE (kind text, id int, problem text) AS $$
+    SELECT 'item', COALESCE(s.item_id, f.item_id),
+           CASE WHEN f.item_id IS NULL THEN 'missing' WHEN s.item_id IS NULL THEN 'extra' ELSE 'stale' END
+    FROM browse_item_source s FULL JOIN browse_item_feed f ON f.item_id = s.item_id
+    WHERE f.item_id IS NULL OR s.item_id IS NULL OR to_jsonb(s) <> to_jsonb(f)
+    UNION ALL
+    SELECT 'post', COALESCE(s.post_id, f.post_id),
+           CASE WHEN f.post_id IS NULL THEN 'missing' WHEN s.post_id IS NULL THEN 'extra' ELSE 'stale' END
+    FROM browse_post_source s FULL JOIN browse_post_feed f ON f.post_id = s.post_id
+    WHERE f.post_id IS NULL OR s.post_id IS NULL OR to_jsonb(s) <> to_jsonb(f)
+    ORDER BY 1, 2;
+$$ LANGUAGE sql STABLE;
+
+-- 從 view 重算整個 feed，回傳修正了幾個物品、幾篇貼文
+-- 過程中會鎖住相關的表不讓別人寫（讀不影響），資料很多的話請挑沒人用的時候跑
+CREATE OR REPLACE FUNCTION rebuild_browse_feed(OUT fixed_items int, OUT fixed_posts int) AS $$
+BEGIN
+    LOCK TABLE item, post, users, location, categories IN SHARE MODE;
+    LOCK TABLE browse_item_feed, browse_post_feed IN EXCLUSIVE MODE;
+
+    SELECT COUNT(*) FILTER (WHERE kind = 'item'), COUNT(*) FILTER (WHERE kind = 'post')
+    INTO fixed_items, fixed_posts
+    FROM browse_feed_drift();
+
+    DELETE FROM browse_item_feed;
+    INSERT INTO browse_item_feed SELECT * FROM browse_item_source;
+    DELETE FROM browse_post_feed;
+    INSERT INTO browse_post_feed SELECT * FROM browse_post_source;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 索取：檢查 + 扣庫存 + 寫 trade 一次做完，app 只要呼叫一次
+-- 先用 FOR UPDATE 鎖住 item 那一列，同時搶同一個東西的人會排隊，輪到的時候看到的就是最新的庫存，
+-- 不會超賣，也不用靠 CHECK (quantity >= 0) 失敗再 rollback
+-- 回傳的 status：ok / invalid_quantity / not_found / own_item / unavailable / expired / insufficient
+-- 過期但 expire_items() 還沒標到的也算 expired
+CREATE OR REPLACE FUNCTION claim_item(p_user_id int, p_item_id int, p_quantity int)
+RETURNS TABLE (status text, item_name text, remaining int) AS $$
+#variable_conflict use_column
+DECLARE
+    target record;
+BEGIN
+    IF p_quantity IS NULL OR p_quantity <= 0 THEN
+        RETURN QUERY SELECT 'invalid_quantity'::text, NULL::text, NULL::int;
+        RETURN;
+    END IF;
+
+    SELECT i.item_name, i.quantity, p.user_id AS owner_id, p.available,
+           i.expired OR i.expiration_date <= NOW() AS expired
+    INTO target
+    FROM item i JOIN post p ON p.post_id = i.post_id
+    WHERE i.item_id = p_item_id
+    FOR UPDATE OF i;
+
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'not_found'::text, NULL::text, NULL::int;
+    ELSIF target.owner_id = p_user_id THEN
+        RETURN QUERY SELECT 'own_item'::text, target.item_name, target.quantity;
+    ELSIF target.expired THEN
+        RETURN QUERY SELECT 'expired'::text, target.item_name, target.quantity;
+    ELSIF target.quantity = 0 OR NOT target.available THEN
+        RETURN QUERY SELECT 'unavailable'::text, target.item_name, target.quantity;
+    ELSIF target.quantity < p_quantity THEN
+        RETURN QUERY SELECT 'insufficient'::text, target.item_name, target.quantity;
+    ELSE
+        -- 扣庫存、更新 post.available 交給 trade 的 trigger
+        INSERT INTO trade (user_id, item_id, quantity, trade_time)
+        VALUES (p_user_id, p_item_id, p_quantity, NOW());
+        RETURN QUERY SELECT 'ok'::text, target.item_name, target.quantity - p_quantity;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 批次索取：一次拿好幾個物品，全部成功才算數，有一個不行就都不拿
+-- 每個物品回傳一列，status 跟 claim_item() 一樣；只要有一列不是 ok，整批都沒有寫入
+-- 同一個 item 出現好幾次會把數量加起來
+CREATE OR REPLACE FUNCTION claim_items(p_user_id int, p_item_ids int[], p_quantities int[])
+RETURNS TABLE (item_id int, status text, item_name text, remaining int) AS $$
+#variable_conflict use_column
+DECLARE
+    req record;
+    failed boolean := false;
+    ok_ids int[] := '{}';
+    ok_quantities int[] := '{}';
+BEGIN
+    IF cardinality(p_item_ids) IS DISTINCT FROM cardinality(p_quantities) THEN
+        RAISE EXCEPTION 'claim_items: item_ids 跟 quantities 長度不一樣';
+    END IF;
+
+    -- 照 item_id 的順序上鎖，兩個人同時批次索取重疊的物品也不會 deadlock
+    FOR req IN
+        WITH wanted AS (
+            SELECT w.item_id,
+                   SUM(w.quantity)::int AS quantity,
+                   bool_or(w.quantity IS NULL OR w.quantity <= 0) AS bad_quantity
+            FROM unnest(p_item_ids, p_quantities) AS w(item_id, quantity)
+            GROUP BY w.item_id
+        ), locked AS (
+            SELECT i.item_id, i.item_name, i.quantity, p.user_id AS owner_id, p.available,
+                   i.expired OR i.expiration_date <= NOW() AS expired
+            FROM item i JOIN post p ON p.post_id = i.post_id
+            WHERE i.item_id IN (SELECT w.item_id FROM wanted w)
+            ORDER BY i.item_id
+            FOR UPDATE OF i
+        )
+        SELECT w.item_id, w.quantity AS want, w.bad_quantity,
+               l.item_id IS NOT NULL AS found, l.item_name, l.quantity, l.owner_id, l.available, l.expired
+        FROM wanted w LEFT JOIN locked l ON l.item_id = w.item_id
+        ORDER BY w.item_id
+    LOOP
+        item_id := req.item_id;
+        item_name := req.item_name;
+        remaining := req.quantity;
+
+        IF req.bad_quantity THEN
+            status := 'invalid_quantity';
+        ELSIF NOT req.found THEN
+            status := 'not_found';
+        ELSIF req.owner_id = p_user_id THEN
+            status := 'own_item';
+        ELSIF req.expired THEN
+            status := 'expired';
+        ELSIF req.quantity = 0 OR NOT req.available THEN
+            status := 'unavailable';
+        ELSIF req.quantity < req.want THEN
+            status := 'insufficient';
+        ELSE
+            status := 'ok';
+            remaining := req.quantity - req.want;
+            ok_ids := ok_ids || req.item_id;
+            ok_quantities := ok_quantities || req.want;
+        END IF;
+
+        failed := failed OR status <> 'ok';
+        RETURN NEXT;
+    END LOOP;
+
+    IF failed OR cardinality(ok_ids) = 0 THEN
+        RETURN;
+    END IF;
+
+    -- 一句 INSERT 寫完，trade 的 trigger 會一次扣庫存，每篇 post 也只檢查一次
+    INSERT INTO trade (user_id, item_id, quantity, trade_time)
+    SELECT p_user_id, t.item_id, t.quantity, NOW()
+    FROM unnest(ok_ids, ok_quantities) AS t(item_id, quantity);
+END;
+$$ LANGUAGE plpgsql;
+
+-- 快取作廢通知：這些表有變動就 NOTIFY giveaway_cache，內容是表格名稱
+-- 每個 app worker 都有一個背景 thread 在 LISTEN（giveaway_app/cache_listener.py），收到就清掉相關的快取
+-- 同一個 transaction 裡同樣的通知只會送一次，一次改很多列也只有一則
+CREATE OR REPLACE FUNCTION notify_cache_change() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('giveaway_cache', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER categories_cache_notify_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON categories
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_cache_change();
+
+CREATE TRIGGER users_cache_notify_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON users
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_cache_change();
+
+CREATE TRIGGER post_cache_notify_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON post
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_cache_change();
+
+CREATE TRIGGER item_cache_notify_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON item
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_cache_change();
+
+CREATE TRIGGER trade_cache_notify_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON trade
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_cache_change();
+
+CREATE TRIGGER comment_cache_notify_trigger
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON comment
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_cache_change();
+
+-- 刪貼文、刪帳號（migrations/014）：按刪除只把 post / users 標上 deleted_at、貼文結案、還有庫存的物品標成 expired，
+-- 首頁、庫存計數、索取本來就會排除，馬上就看不到；刪帳號的話 account、phone 直接刪（不能再登入）
+-- 真正刪資料由 purge_step() 一次刪一小批，app 的背景 thread（giveaway_app/purge_worker.py）跟 flask purge run 呼叫
+-- 做到哪一步記在 purge_job，跟刪掉的資料在同一個 transaction commit，中途當掉的話下次從那一步接著刪
+-- 每一種要照什麼順序刪：先刪最多的 trade / comment，item、post 刪的時候就不用再 cascade
+CREATE OR REPLACE FUNCTION purge_steps(p_kind text) RETURNS text[] AS $$
+    SELECT CASE p_kind
+        WHEN 'user' THEN ARRAY['user_comments', 'user_trades', 'comments', 'trades', 'items', 'posts', 'user', 'done']
+        ELSE ARRAY['comments', 'trades', 'items', 'posts', 'done']
+    END
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION soft_delete_post(p_post_id int) RETURNS void AS $$
+BEGIN
+    UPDATE post SET deleted_at = NOW(), available = false
+    WHERE post_id = p_post_id AND deleted_at IS NULL;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    UPDATE item SET expired = true
+    WHERE post_id = p_post_id AND quantity > 0 AND NOT expired;
+
+    INSERT INTO purge_job (kind, target_id, step)
+    VALUES ('post', p_post_id, (purge_steps('post'))[1])
+    ON CONFLICT (kind, target_id) DO NOTHING;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION soft_delete_user(p_user_id int) RETURNS void AS $$
+BEGIN
+    UPDATE users SET deleted_at = NOW()
+    WHERE user_id = p_user_id AND deleted_at IS NULL;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    DELETE FROM account WHERE user_id = p_user_id;
+    DELETE FROM phone WHERE user_id = p_user_id;
+
+    UPDATE post SET deleted_at = NOW(), available = false
+    WHERE user_id = p_user_id AND deleted_at IS NULL;
+    UPDATE item SET expired = true
+    WHERE post_id IN (SELECT post_id FROM post WHERE user_id = p_user_id) AND quantity > 0 AND NOT expired;
+
+    -- 他自己先刪的貼文已經有 post 的 job 了，這裡的 posts 那一步會一起刪，兩個 job 誰先做到都可以
+    INSERT INTO purge_job (kind, target_id, step)
+    VALUES ('user', p_user_id, (purge_steps('user'))[1])
+    ON CONFLICT (kind, target_id) DO NOTHING;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 拿最舊一個還沒刪完的 job，刪現在那一步的一批（最多 p_limit 列），回傳做了哪個 job、刪了幾列、做完了沒
+-- 這一步不到一批就換下一步，一批都沒刪到就接著做下一步，所以每次呼叫都會有進度
+-- 沒有要刪的就不回傳任何列；SKIP LOCKED：好幾個 worker 同時跑會各自拿不同的 job
+-- trade / comment 是分區表，一次刪一批要用 (id, 時間) 對回去
+CREATE OR REPLACE FUNCTION purge_step(p_limit int)
+RETURNS TABLE (job_id int, kind text, target_id int, step text, deleted int, done boolean) AS $$
+#variable_conflict use_column
+DECLARE
+    job purge_job%ROWTYPE;
+    steps text[];
+    post_ids int[];
+    n int;
+    total int := 0;
+BEGIN
+    SELECT * INTO job
+    FROM purge_job j
+    WHERE j.finished_at IS NULL
+    ORDER BY j.job_id
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    steps := purge_steps(job.kind);
+    IF job.kind = 'user' THEN
+        SELECT array_agg(p.post_id) INTO post_ids FROM post p WHERE p.user_id = job.target_id;
+    ELSE
+        SELECT array_agg(p.post_id) INTO post_ids FROM post p WHERE p.post_id = job.target_id;
+    END IF;
+    post_ids := COALESCE(post_ids, '{}');
+
+    WHILE job.step <> 'done' LOOP
+        IF job.step = 'user_comments' THEN
+            DELETE FROM comment
+            WHERE (comment_id, comment_time) IN (
+                SELECT c.comment_id, c.comment_time FROM comment c WHERE c.user_id = job.target_id LIMIT p_limit);
+        ELSIF job.step = 'user_trades' THEN
+            DELETE FROM trade
+            WHERE (trade_id, trade_time) IN (
+                SELECT t.trade_id, t.trade_time FROM trade t WHERE t.user_id = job.target_id LIMIT p_limit);
+        ELSIF job.step = 'comments' THEN
+            DELETE FROM comment
+            WHERE (comment_id, comment_time) IN (
+                SELECT c.comment_id, c.comment_time FROM comment c WHERE c.post_id = ANY(post_ids) LIMIT p_limit);
+        ELSIF job.step = 'trades' THEN
+            DELETE FROM trade
+            WHERE (trade_id, trade_time) IN (
+                SELECT t.trade_id, t.trade_time
+                FROM trade t
+                WHERE t.item_id IN (SELECT i.item_id FROM item i WHERE i.post_id = ANY(post_ids))
+                LIMIT p_limit);
+        ELSIF job.step = 'items' THEN
+            DELETE FROM item
+            WHERE item_id IN (SELECT i.item_id FROM item i WHERE i.post_id = ANY(post_ids) LIMIT p_limit);
+        ELSIF job.step = 'posts' THEN
+            DELETE FROM post
+            WHERE post_id IN (SELECT p.post_id FROM post p WHERE p.post_id = ANY(post_ids) LIMIT p_limit);
+        ELSIF job.step = 'user' THEN
+            -- 中間又有新的資料（舊的 session 還在刊登之類的）也會在這裡 cascade 掉
+            DELETE FROM users WHERE user_id = job.target_id;
+        END IF;
+        GET DIAGNOSTICS n = ROW_COUNT;
+        total := total + n;
+
+        IF n >= p_limit THEN
+            EXIT;
+        END IF;
+        job.step := steps[array_position(steps, job.step::text) + 1];
+        EXIT WHEN n > 0;
+    END LOOP;
+
+    UPDATE purge_job j
+    SET step = job.step,
+        deleted_rows = j.deleted_rows + total,
+        updated_at = NOW(),
+        finished_at = CASE WHEN job.step = 'done' THEN NOW() END
+    WHERE j.job_id = job.job_id;
+
+    RETURN QUERY SELECT job.job_id, job.kind::text, job.target_id, job.step::text, total, job.step = 'done';
+END;
+$$ LANGUAGE plpgsql;
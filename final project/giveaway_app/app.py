@@ -1,10 +1,27 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import Flask, render_template, stream_template, request, redirect, url_for, session, flash, get_flashed_messages, g, jsonify, abort
+from flask.cli import AppGroup
 import psycopg2
 import psycopg2.extras
+import click
 import os
+import time
+import re
+import unicodedata
 from dotenv import load_dotenv
 
+from db_pool import ConnectionPool, PoolTimeout
+from response_cache import ResponseCache
+from cache_listener import CacheInvalidationListener
+from query_stats import QueryStats
+from password_hasher import PasswordHasher, HasherBusy
+from lastlogin_buffer import LastLoginBuffer
+from expiry_sweeper import ExpirySweeper
+from purge_worker import PurgeWorker
+from partitions import PartitionMaintainer, PARTITIONED_TABLES, archive_partitions, list_partitions, months_before
+import bulk_items
+import geo
+from pagination import encode_cursor, decode_cursor, keyset_condition, order_by_sql, paginate
+
 load_dotenv()
 
 app = Flask(__name__)
@@ -17,16 +34,636 @@ DB_USER = "postgres"  # 使用者帳號，預設應該都是 postgres
 DB_PASS = os.getenv("DB_PASSWORD")   # 設定的密碼，寫在 .env 裡面
 DB_PORT = "5432"
 
+# 連線池設定，一樣可以寫在 .env 裡面，沒寫就用預設值
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+DB_POOL_IDLE_TIMEOUT = float(os.getenv("DB_POOL_IDLE_TIMEOUT", 300))   # 多餘的閒置連線幾秒後關掉
+DB_POOL_WAIT_TIMEOUT = float(os.getenv("DB_POOL_WAIT_TIMEOUT", 5))     # 池子滿了最多等幾秒
+DB_POOL_HEALTH_CHECK = float(os.getenv("DB_POOL_HEALTH_CHECK", 30))    # 閒置超過幾秒，借出前先檢查
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN") # 看監控數據用，沒設定的話只有本機可以看
+
+# 首頁的快取，0 就是不開
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 512))      # 最多存幾頁
+RESPONSE_CACHE_MAX_MB = float(os.getenv("RESPONSE_CACHE_MAX_MB", 64))  # 最多用多少記憶體
+CACHE_TTL = float(os.getenv("CACHE_TTL", 60))                          # 快取最多留幾秒，收不到通知時的保險
+CACHE_LISTEN = os.getenv("CACHE_LISTEN", "1") != "0"                   # 要不要 LISTEN 別的 worker 的變動通知
+FACETS_CACHE_SIZE = int(os.getenv("FACETS_CACHE_SIZE", 256))           # 側邊欄每個分類的數量，最多存幾個搜尋字
+
+# SQL 計時：每個 request 的查詢次數、時間放在 Server-Timing header，每個 route 的統計在 /admin/stats
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 200))   # 超過幾毫秒的 SQL 記到 log（參數不會印出來），0 就不記
+
+# 密碼 hash 丟到另外的 process 算，不會卡住處理 request 的 thread
+# 改了 PASSWORD_HASH_METHOD 之後，舊的密碼會在那個人下次登入成功時自動換成新的設定
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt")        # werkzeug 的格式，例如 scrypt:65536:8:1、pbkdf2:sha256:600000
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 2))        # 開幾個 process 算，0 就在 request 裡直接算
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", 32))           # 最多幾個在排隊，再多就回「系統忙碌中」
+PASSWORD_HASH_TIMEOUT = float(os.getenv("PASSWORD_HASH_TIMEOUT", 10))     # 最多等幾秒
+
+# 登入時間先記在記憶體，背景每幾秒一次寫回 account.lastlogin，登入不用等 commit
+LASTLOGIN_FLUSH_INTERVAL = float(os.getenv("LASTLOGIN_FLUSH_INTERVAL", 5))   # 幾秒寫一次
+LASTLOGIN_BUFFER_SIZE = int(os.getenv("LASTLOGIN_BUFFER_SIZE", 10000))       # 最多累積幾個人沒寫
+
+# 過期的物品由背景 thread 定時下架（migrations/009），首頁跟索取另外也會直接排除過期的
+EXPIRY_SWEEP_INTERVAL = float(os.getenv("EXPIRY_SWEEP_INTERVAL", 60))   # 幾秒掃一次，0 就不在 app 裡掃（改用 flask stock expire 排程）
+EXPIRY_SWEEP_BATCH = int(os.getenv("EXPIRY_SWEEP_BATCH", 500))         # 一批最多標幾筆
+
+# 刪貼文、刪帳號先藏起來，背景再一批一批真的刪掉（migrations/014）
+PURGE_INTERVAL = float(os.getenv("PURGE_INTERVAL", 10))   # 幾秒檢查一次有沒有要刪的，0 就不在 app 裡刪（改用 flask purge run 排程）
+PURGE_BATCH = int(os.getenv("PURGE_BATCH", 500))           # 一批最多刪幾列
+
+# trade / comment 照月份分區（migrations/010），背景先把之後幾個月的分區建好
+# 太舊的月份用 flask --app app partitions archive 拆下來存成 .csv.gz 再刪掉（可以用 cron 排程）
+PARTITION_CHECK_INTERVAL = float(os.getenv("PARTITION_CHECK_INTERVAL", 3600))   # 幾秒檢查一次，0 就不在 app 裡檢查（改用 flask partitions ensure 排程）
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", 3))           # 先建好之後幾個月的分區
+PARTITION_RETENTION_MONTHS = int(os.getenv("PARTITION_RETENTION_MONTHS", 24))  # 封存時保留最近幾個月
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive'))   # 封存的檔案放哪裡
+
+query_stats = QueryStats(slow_query_ms=SLOW_QUERY_MS)
+
+password_hasher = PasswordHasher(
+    method=PASSWORD_HASH_METHOD,
+    workers=PASSWORD_HASH_WORKERS,
+    max_pending=PASSWORD_HASH_QUEUE,
+    timeout=PASSWORD_HASH_TIMEOUT
+)
+
+db_pool = ConnectionPool(
+    minconn=DB_POOL_MIN,
+    maxconn=DB_POOL_MAX,
+    idle_timeout=DB_POOL_IDLE_TIMEOUT,
+    wait_timeout=DB_POOL_WAIT_TIMEOUT,
+    health_check_after=DB_POOL_HEALTH_CHECK,
+    host=DB_HOST,
+    database=DB_NAME,
+    user=DB_USER,
+    password=DB_PASS,
+    port=DB_PORT,
+    connection_factory=query_stats.connection_factory
+)
+
+lastlogin_buffer = LastLoginBuffer(
+    db_pool.connection,
+    interval=LASTLOGIN_FLUSH_INTERVAL,
+    max_pending=LASTLOGIN_BUFFER_SIZE
+)
+
+@app.before_request
+def start_query_stats():
+    query_stats.start_request()
+
+@app.after_request
+def add_server_timing(response):
+    # 沒對到 route 的 (404) 都算在一起，不然亂打網址會一直長出新的 key
+    route = f'{request.method} {request.url_rule.rule}' if request.url_rule else 'unmatched'
+    record = query_stats.finish_request(route)
+    if record is not None:
+        response.headers['Server-Timing'] = query_stats.server_timing(record)
+    return response
+
+response_cache = ResponseCache(
+    max_entries=RESPONSE_CACHE_SIZE,
+    max_bytes=int(RESPONSE_CACHE_MAX_MB * 1024 * 1024),
+    ttl=CACHE_TTL
+)
+categories_cache = ResponseCache(max_entries=1, ttl=CACHE_TTL)   # 分類清單，首頁跟刊登頁都要
+facets_cache = ResponseCache(max_entries=FACETS_CACHE_SIZE, ttl=CACHE_TTL)   # 每個分類有幾樣物品、幾篇貼文，key 是搜尋字
+
+def catalog_changed():
+    # 會影響首頁內容的寫入（庫存、貼文、發文者名稱、評價）成功之後呼叫，首頁快取全部作廢
+    # 別的 worker 會透過資料庫的 NOTIFY 知道，這裡先把自己的清掉，馬上看得到自己改的東西
+    response_cache.bump()
+    facets_cache.bump()
+
+# 哪張表有變動要清掉哪些快取（schema.sql 的 notify_cache_change 會送表格名稱過來）
+CACHE_DEPENDENCIES = {
+    'categories': [response_cache, categories_cache, facets_cache],
+    'users': [response_cache],
+    'post': [response_cache, facets_cache],
+    'item': [response_cache, facets_cache],
+    'trade': [response_cache, facets_cache],
+    'comment': [response_cache],
+}
+
+expiry_sweeper = ExpirySweeper(
+    db_pool.connection,
+    interval=EXPIRY_SWEEP_INTERVAL,
+    batch_size=EXPIRY_SWEEP_BATCH,
+    on_expired=lambda n: catalog_changed()
+)
+
+purge_worker = PurgeWorker(
+    db_pool.connection,
+    interval=PURGE_INTERVAL,
+    batch_size=PURGE_BATCH,
+    on_purged=lambda n: catalog_changed()
+)
+
+partition_maintainer = PartitionMaintainer(
+    db_pool.connection,
+    interval=PARTITION_CHECK_INTERVAL,
+    months_ahead=PARTITION_MONTHS_AHEAD
+)
+
+def invalidate_caches(table):
+    for cache in CACHE_DEPENDENCIES.get(table, []):
+        cache.bump()
+
+def reset_caches():
+    response_cache.bump()
+    categories_cache.bump()
+    facets_cache.bump()
+
+cache_listener = CacheInvalidationListener(
+    'giveaway_cache', invalidate_caches, reset_caches,
+    host=DB_HOST,
+    database=DB_NAME,
+    user=DB_USER,
+    password=DB_PASS,
+    port=DB_PORT
+)
+
+@app.before_request
+def start_cache_listener():
+    # 第一個 request 進來才開始聽，import app 的工具程式、flask 指令不會多開一條連線
+    if CACHE_LISTEN and not cache_listener.started:
+        cache_listener.start()
+    if EXPIRY_SWEEP_INTERVAL > 0 and not expiry_sweeper.started:
+        expiry_sweeper.start()
+    if PURGE_INTERVAL > 0 and not purge_worker.started:
+        purge_worker.start()
+    if PARTITION_CHECK_INTERVAL > 0 and not partition_maintainer.started:
+        partition_maintainer.start()
+
+def load_categories(cur):
+    version = categories_cache.version
+    categories = categories_cache.get('all')
+    if categories is None:
+        cur.execute("SELECT * FROM categories ORDER BY category_id ASC")
+        categories = [dict(row) for row in cur.fetchall()]
+        categories_cache.put('all', categories, version, size=len(categories))
+    return categories
+
 def get_db_connection():
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        database=DB_NAME,
-        user=DB_USER,
-        password=DB_PASS,
-        port=DB_PORT
-    )
+    # 從連線池借一條連線，conn.close() 就是還回去
+    # 就算 route 忘了 close，request 結束時 teardown 也會幫忙還
+    start = time.perf_counter()
+    conn = db_pool.connection()
+    query_stats.record_acquire(time.perf_counter() - start)
+    g.setdefault('db_conns', []).append(conn)
     return conn
 
+@app.teardown_appcontext
+def release_db_connections(exc):
+    for conn in g.pop('db_conns', []):
+        conn.close()
+
+@app.errorhandler(PoolTimeout)
+@app.errorhandler(HasherBusy)
+def handle_pool_timeout(e):
+    return render_template('busy.html'), 503
+
+def require_admin():
+    token = request.headers.get('X-Admin-Token') or request.args.get('token')
+    if ADMIN_TOKEN:
+        if token != ADMIN_TOKEN:
+            abort(403)
+    elif request.remote_addr not in ('127.0.0.1', '::1'):
+        abort(403)
+
+@app.route('/admin/stats')
+def admin_stats():
+    require_admin()
+    return jsonify({
+        'db_pool': db_pool.stats(),
+        'response_cache': response_cache.stats(),
+        'categories_cache': categories_cache.stats(),
+        'facets_cache': facets_cache.stats(),
+        'cache_listener': cache_listener.stats(),
+        'queries': query_stats.stats(),
+        'password_hasher': password_hasher.stats(),
+        'lastlogin_buffer': lastlogin_buffer.stats(),
+        'expiry_sweeper': expiry_sweeper.stats(),
+        'purge_worker': purge_worker.stats(),
+        'partitions': partition_maintainer.stats()
+    })
+
+# 維護用的指令，在 giveaway_app 資料夾下執行：flask --app app stock check
+stock_cli = AppGroup('stock', help='庫存計數 (post.remaining_*, category_stock) 的檢查跟重算')
+
+@stock_cli.command('check', help='列出跟 item 對不起來的庫存計數')
+def stock_check():
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM stock_counter_drift()")
+        rows = cur.fetchall()
+        cur.close()
+
+    if not rows:
+        click.echo('庫存計數都正確')
+        return
+    for kind, target_id, counted_qty, actual_qty, counted_items, actual_items in rows[:50]:
+        click.echo(f'{kind} {target_id}: 數量 {counted_qty} (實際 {actual_qty})，物品 {counted_items} 樣 (實際 {actual_items})')
+    if len(rows) > 50:
+        click.echo(f'... 還有 {len(rows) - 50} 筆')
+    click.echo(f'共 {len(rows)} 筆對不起來，可以用 flask --app app stock rebuild 重算')
+    raise SystemExit(1)
+
+@stock_cli.command('rebuild', help='從 item 重算所有庫存計數')
+def stock_rebuild():
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT fixed_posts, fixed_categories FROM rebuild_stock_counters()")
+        fixed_posts, fixed_categories = cur.fetchone()
+        conn.commit()
+        cur.close()
+    click.echo(f'重算完成，修正了 {fixed_posts} 篇貼文、{fixed_categories} 個分類')
+
+@stock_cli.command('expire', help='把過期還有庫存的物品下架（跟 app 背景做的一樣，可以用 cron 排程）')
+@click.option('--max-batches', type=int, default=None, help=f'最多標幾批（一批 EXPIRY_SWEEP_BATCH={EXPIRY_SWEEP_BATCH} 筆），沒給就標到沒有為止')
+def stock_expire(max_batches):
+    n = expiry_sweeper.sweep(max_batches)
+    click.echo(f'下架了 {n} 樣過期的物品')
+
+app.cli.add_command(stock_cli)
+
+reputation_cli = AppGroup('reputation', help='使用者評價 (user_reputation) 的檢查跟重算')
+
+@reputation_cli.command('check', help='列出跟 comment 對不起來的評價')
+def reputation_check():
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM reputation_drift()")
+        rows = cur.fetchall()
+        cur.close()
+
+    if not rows:
+        click.echo('評價都正確')
+        return
+    for user_id, counted_sum, actual_sum, counted_count, actual_count in rows[:50]:
+        click.echo(f'user {user_id}: 總分 {counted_sum} (實際 {actual_sum})，{counted_count} 則 (實際 {actual_count})')
+    if len(rows) > 50:
+        click.echo(f'... 還有 {len(rows) - 50} 筆')
+    click.echo(f'共 {len(rows)} 筆對不起來，可以用 flask --app app reputation rebuild 重算')
+    raise SystemExit(1)
+
+@reputation_cli.command('rebuild', help='從 comment 重算所有人的評價')
+def reputation_rebuild():
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT fixed_users FROM rebuild_user_reputation()")
+        fixed_users = cur.fetchone()[0]
+        conn.commit()
+        cur.close()
+    click.echo(f'重算完成，修正了 {fixed_users} 個使用者')
+
+app.cli.add_command(reputation_cli)
+
+feed_cli = AppGroup('feed', help='首頁的 feed 表 (browse_item_feed / browse_post_feed) 的檢查跟重建')
+
+@feed_cli.command('check', help='列出跟 item / post 的 JOIN 對不起來的 feed 列')
+def feed_check():
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM browse_feed_drift()")
+        rows = cur.fetchall()
+        cur.close()
+
+    if not rows:
+        click.echo('首頁的 feed 都正確')
+        return
+    for kind, target_id, problem in rows[:50]:
+        click.echo(f'{kind} {target_id}: {problem}')
+    if len(rows) > 50:
+        click.echo(f'... 還有 {len(rows) - 50} 筆')
+    click.echo(f'共 {len(rows)} 筆對不起來，可以用 flask --app app feed rebuild 重建')
+    raise SystemExit(1)
+
+@feed_cli.command('rebuild', help='從 item / post 重建整個 feed')
+def feed_rebuild():
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT fixed_items, fixed_posts FROM rebuild_browse_feed()")
+        fixed_items, fixed_posts = cur.fetchone()
+        conn.commit()
+        cur.close()
+    click.echo(f'重建完成，修正了 {fixed_items} 個物品、{fixed_posts} 篇貼文')
+
+app.cli.add_command(feed_cli)
+
+partitions_cli = AppGroup('partitions', help='trade / comment 的月份分區')
+
+@partitions_cli.command('ensure', help='建好之後幾個月的分區，default 分區裡的資料搬到各自的月份（跟 app 背景做的一樣）')
+@click.option('--months-ahead', type=int, default=PARTITION_MONTHS_AHEAD, show_default=True, help='先建好之後幾個月')
+def partitions_ensure(months_ahead):
+    partition_maintainer.months_ahead = months_ahead
+    n = partition_maintainer.ensure()
+    click.echo(f'建了 {n} 個分區')
+
+@partitions_cli.command('list', help='列出每個分區的範圍跟大小')
+def partitions_list():
+    with db_pool.connection() as conn:
+        for table in PARTITIONED_TABLES:
+            click.echo(f'{table}:')
+            for name, bound, rows, size in list_partitions(conn, table):
+                click.echo(f'  {name:<20} {bound:<70} 約 {max(rows, 0)} 筆，{size / 1024 / 1024:.1f} MB')
+
+@partitions_cli.command('archive', help='把太舊的月份拆下來，存成 gzip 的 CSV 後刪掉（評價的分數會保留）')
+@click.option('--older-than-months', type=click.IntRange(min=1), default=PARTITION_RETENTION_MONTHS, show_default=True, help='保留最近幾個月（含這個月）')
+@click.option('--table', type=click.Choice(list(PARTITIONED_TABLES)), multiple=True, help='只封存這張表，沒給就兩張都做')
+@click.option('--dir', 'directory', default=ARCHIVE_DIR, show_default=True, help='檔案放哪裡')
+def partitions_archive(older_than_months, table, directory):
+    before = months_before(datetime.now().date(), older_than_months - 1)
+    for t in table or PARTITIONED_TABLES:
+        done = archive_partitions(db_pool.connection, t, before, directory)
+        for name, n, path in done:
+            click.echo(f'{name}: {n} 筆 -> {path}')
+        click.echo(f'{t}: 封存了 {len(done)} 個分區（{before} 以前的）')
+
+app.cli.add_command(partitions_cli)
+
+purge_cli = AppGroup('purge', help='刪掉的貼文、帳號 (purge_job) 在背景真的刪資料的進度')
+
+@purge_cli.command('status', help='列出還沒刪完的貼文、帳號，做到哪一步、刪了幾列')
+def purge_status():
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT job_id, kind, target_id, step, deleted_rows, requested_at, updated_at,
+                   array_position(purge_steps(kind), step::text), cardinality(purge_steps(kind)) - 1
+            FROM purge_job
+            WHERE finished_at IS NULL
+            ORDER BY job_id
+        """)
+        rows = cur.fetchall()
+        cur.execute("SELECT COUNT(*) FROM purge_job WHERE finished_at IS NOT NULL")
+        finished = cur.fetchone()[0]
+        cur.close()
+
+    for job_id, kind, target_id, step, deleted, requested_at, updated_at, n, steps in rows:
+        click.echo(f'#{job_id} {kind} {target_id}: 第 {n}/{steps} 步 ({step})，已經刪了 {deleted} 列，'
+                   f'{requested_at:%Y-%m-%d %H:%M:%S} 按刪除，最後一批在 {updated_at:%Y-%m-%d %H:%M:%S}')
+    click.echo(f'還有 {len(rows)} 個沒刪完，{finished} 個已經刪完')
+
+@purge_cli.command('run', help='把還沒刪完的接著刪完（跟 app 背景做的一樣，中斷過的會從那一步接著刪）')
+@click.option('--max-batches', type=int, default=None, help=f'最多刪幾批（一批 PURGE_BATCH={PURGE_BATCH} 列），沒給就刪到沒有為止')
+def purge_run(max_batches):
+    steps = {}
+    def progress(job_id, kind, target_id, step, deleted, done):
+        if done:
+            click.echo(f'#{job_id} {kind} {target_id} 刪完了')
+        elif steps.get(job_id) != step:
+            click.echo(f'#{job_id} {kind} {target_id}: {step}')
+        steps[job_id] = step
+
+    n = purge_worker.purge(max_batches, progress=progress)
+    click.echo(f'總共刪了 {n} 列')
+
+app.cli.add_command(purge_cli)
+
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", 24))   # 首頁一頁顯示幾筆
+MAX_PAGE_SIZE = 100
+# 物品模式找附近（網址帶 lat / lon，migrations/012）：預設找幾公里內、最多可以找多遠
+NEAR_DEFAULT_RADIUS_KM = float(os.getenv("NEAR_DEFAULT_RADIUS_KM", 3))
+NEAR_MAX_RADIUS_KM = float(os.getenv("NEAR_MAX_RADIUS_KM", 20))
+NEAR_FIRST_RING_KM = 0.5   # 先找多近，不夠一頁再加倍
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", 200))   # 物品模式一次列出全部 (stream=1) 時，每次從資料庫拿幾筆
+
+# 物品模式的排序：跟原本的 ORDER BY 一樣，最後補 item_id 讓順序固定
+ITEM_SORT_KEYS = [('i.quantity', 'DESC'), ('i.post_id', 'DESC'), ('i.category_id', 'ASC'), ('i.item_id', 'ASC')]
+POST_SORT_KEYS = [('s.post_id', 'DESC')]
+# 讀 feed 表的時候一樣的順序，cursor 也一樣，換來換去網址不會壞
+FEED_ITEM_SORT_KEYS = [('f.quantity', 'DESC'), ('f.post_id', 'DESC'), ('f.category_id', 'ASC'), ('f.item_id', 'ASC')]
+FEED_POST_SORT_KEYS = [('f.post_id', 'DESC')]
+# 找附近的時候由近到遠
+NEAR_SORT_KEYS = [('s.distance', 'ASC'), ('s.item_id', 'ASC')]
+# cursor 裡每個值的型別（decode_cursor 檢查用，型別不對的網址當作沒帶 cursor）；搜尋的相關度排在最前面，是 'number'
+ITEM_CURSOR_TYPES = ['int', 'int', 'int', 'int']
+POST_CURSOR_TYPES = ['int']
+NEAR_CURSOR_TYPES = ['number', 'int']
+
+# 搜尋字裡面有沒有全文搜尋可以用的字（跟 schema.sql 的 cjk_tsquery 切字規則一樣）
+SEARCHABLE_RE = re.compile(r'[a-z0-9\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff]')
+
+fulltext_ready = None   # 資料庫有沒有跑過 migrations/001_fulltext_search.sql，第一次搜尋時檢查
+
+def use_fulltext(cur, search_query):
+    global fulltext_ready
+    if fulltext_ready is None:
+        cur.execute("SELECT to_regprocedure('cjk_tsquery(text)') IS NOT NULL")
+        fulltext_ready = cur.fetchone()[0]
+        if not fulltext_ready:
+            print("找不到全文搜尋的函式，搜尋改用 ILIKE（請執行 database/migrations/001_fulltext_search.sql）")
+    return fulltext_ready and SEARCHABLE_RE.search(unicodedata.normalize('NFKC', search_query).lower()) is not None
+
+stock_counters_ready = None   # 資料庫有沒有跑過 migrations/006_stock_counters.sql
+
+def use_stock_counters(cur):
+    global stock_counters_ready
+    if stock_counters_ready is None:
+        cur.execute("SELECT to_regclass('category_stock') IS NOT NULL")
+        stock_counters_ready = cur.fetchone()[0]
+    return stock_counters_ready
+
+browse_feed_ready = None   # 資料庫有沒有跑過 migrations/011_browse_feed.sql
+
+def use_browse_feed(cur, category_filter, search_query):
+    # 沒有搜尋的首頁（含分類篩選）直接讀 feed 表，不用五張表 JOIN
+    # 搜尋要算相關度，還是照原本的 JOIN 走全文搜尋
+    global browse_feed_ready
+    if search_query or (category_filter and not category_filter.isdigit()):
+        return False
+    if browse_feed_ready is None:
+        cur.execute("SELECT to_regclass('browse_item_feed') IS NOT NULL")
+        browse_feed_ready = cur.fetchone()[0]
+        if not browse_feed_ready:
+            print("找不到首頁的 feed 表，首頁改用 JOIN（請執行 database/migrations/011_browse_feed.sql）")
+    return browse_feed_ready
+
+def near_items(cur, near, radius, filter_sql, filter_params, page_sql, page_params, cursor, backward, per_page):
+    # 找附近的一頁（多抓一筆給 paginate 判斷有沒有下一頁），由近到遠
+    # 先找 0.5 公里內，不夠一頁再把半徑加倍，一直到 radius：人多的地方只要算最近那幾格的距離
+    # 往回翻要的是 cursor 前面、離 cursor 最近的那幾筆，一定都在 cursor 的距離以內，直接找到那裡
+    # LATERAL + OFFSET 0 是故意的：讓每一排格子各自用 browse_item_feed_geo_idx 掃一段，planner 才不會改成整個 index 掃過去
+    lat, lon = near
+    sql = f"""
+        SELECT f.item_id, f.item_name, f.quantity, f.expiration_date, f.post_id,
+               f.category_name as name, f.category_id,
+               f.description, f.available,
+               f.location_name, f.city, f.district, f.street, f.number,
+               f.owner_name as user_name, f.owner_id as user_id,
+               r.avg_rating as owner_rating, r.rating_count as owner_rating_count,
+               0 AS rank, s.distance
+        FROM (
+            SELECT s.item_id, s.distance
+            FROM geo_cell_ranges(%s, %s, %s) g
+            CROSS JOIN LATERAL (
+                SELECT f.item_id, geo_distance_km(%s, %s, f.lat, f.lon) AS distance
+                FROM browse_item_feed f
+                WHERE f.geo_cell BETWEEN g.lo AND g.hi AND f.expiration_date > NOW() {filter_sql}
+                OFFSET 0
+            ) s
+            WHERE s.distance <= %s {page_sql}
+            ORDER BY {order_by_sql(NEAR_SORT_KEYS, backward)}
+            LIMIT %s
+        ) s
+        JOIN browse_item_feed f ON f.item_id = s.item_id
+        LEFT JOIN user_reputation r ON f.owner_id = r.user_id
+        ORDER BY {order_by_sql(NEAR_SORT_KEYS, backward)}
+    """
+    if backward:
+        rings = [min(cursor[0], radius)]
+    else:
+        rings, ring = [], NEAR_FIRST_RING_KM
+        while ring < radius:
+            if not cursor or ring > cursor[0]:
+                rings.append(ring)
+            ring *= 2
+        rings.append(radius)
+
+    for ring in rings:
+        cur.execute(sql, (lat, lon, ring, lat, lon, *filter_params, ring, *page_params, per_page + 1))
+        rows = cur.fetchall()
+        if len(rows) > per_page:
+            break
+    return rows
+
+def build_browse_filters(cur, category_filter, search_query):
+    # 回傳 (join_sql, filter_sql, query_params, item_rank_sql, post_rank_sql)
+    # query_params 的順序就是 join_sql 再 filter_sql，所以兩個要照這個順序放進 SQL 裡
+    join_sql = ""
+    filter_sql = ""
+    query_params = []
+    item_rank_sql = post_rank_sql = None
+
+    if search_query and use_fulltext(cur, search_query):
+        # 全文搜尋：走 search_tsv 上的 GIN index，物品名稱命中的權重比貼文描述高
+        join_sql = " CROSS JOIN (SELECT cjk_tsquery(%s) AS q) sq"
+        query_params.append(search_query)
+        item_rank_sql = "round((ts_rank(i.search_tsv, sq.q) * 2 + ts_rank(p.search_tsv, sq.q))::numeric, 6)"
+        post_rank_sql = """round((ts_rank(p.search_tsv, sq.q) + (
+                SELECT COALESCE(MAX(ts_rank(i.search_tsv, sq.q)), 0) * 2
+                FROM item i WHERE i.post_id = p.post_id))::numeric, 6)"""
+
+    if category_filter:
+        filter_sql += " AND c.category_id = %s"
+        query_params.append(category_filter)
+
+    if item_rank_sql:
+        filter_sql += " AND (i.search_tsv @@ sq.q OR p.search_tsv @@ sq.q)"
+    elif search_query:
+        filter_sql += " AND (i.item_name ILIKE %s OR p.description ILIKE %s)"
+        query_params.append(f'%{search_query}%')
+        query_params.append(f'%{search_query}%')
+
+    return join_sql, filter_sql, query_params, item_rank_sql, post_rank_sql
+
+def category_facets(cur, search_query):
+    # 側邊欄每個分類有幾樣物品（還剩的數量）、幾篇貼文，連同全部加起來的總數，一條 GROUPING SETS 一起算
+    # 回傳 {category_id: {'items': ..., 'posts': ...}}，key 是 None 的是全部分類（沒選分類時的總數）
+    # 換分類、翻頁用的都是同一份，照搜尋字快取，資料有變動跟首頁快取一起作廢
+    version = facets_cache.version
+    facets = facets_cache.get(search_query)
+    if facets is not None:
+        return facets
+
+    if not search_query and use_stock_counters(cur) and use_browse_feed(cur, None, search_query):
+        # 沒有搜尋：物品數直接加 category_stock，貼文數數 feed 表（一篇一列），都不用碰 item
+        # 一篇的 category_ids 不會重複，每個分類各用 feed 的 GIN index 數一次，比整張展開再 GROUP BY 快
+        cur.execute("""
+            SELECT category_id, GROUPING(category_id) = 1 AS everything,
+                   SUM(remaining_quantity)::bigint AS items, NULL::bigint AS posts
+            FROM category_stock
+            GROUP BY GROUPING SETS ((category_id), ())
+            UNION ALL
+            SELECT c.category_id, FALSE, NULL,
+                   (SELECT COUNT(*) FROM browse_post_feed f WHERE f.category_ids @> ARRAY[c.category_id])
+            FROM categories c
+            UNION ALL
+            SELECT NULL, TRUE, NULL, COUNT(*) FROM browse_post_feed
+        """)
+    else:
+        # 有搜尋：跟首頁一樣的條件（不含分類），物品數算還有庫存、沒過期的，貼文數算還開著、有物品符合的
+        # 貼文那半邊從還開著的貼文一篇一篇找（跟原本 EXISTS 的寫法一樣走 item_post_id_idx），不要整張 item 拿去 hash join
+        join_sql, filter_sql, query_params, _, _ = build_browse_filters(cur, None, search_query)
+        cur.execute(f"""
+            SELECT i.category_id, GROUPING(i.category_id) = 1 AS everything, SUM(i.quantity) AS items, NULL::bigint AS posts
+            FROM item i
+            JOIN post p ON i.post_id = p.post_id
+            LEFT JOIN categories c ON i.category_id = c.category_id
+            {join_sql}
+            WHERE i.quantity > 0 AND NOT i.expired AND i.expiration_date > NOW() {filter_sql}
+            GROUP BY GROUPING SETS ((i.category_id), ())
+            UNION ALL
+            SELECT i.category_id, GROUPING(i.category_id) = 1, NULL, COUNT(DISTINCT p.post_id)
+            FROM post p {join_sql}
+            CROSS JOIN LATERAL (
+                SELECT DISTINCT i.category_id
+                FROM item i
+                LEFT JOIN categories c ON i.category_id = c.category_id
+                WHERE i.post_id = p.post_id {filter_sql}
+            ) i
+            WHERE p.available
+            GROUP BY GROUPING SETS ((i.category_id), ())
+        """, tuple(query_params + query_params))
+
+    facets = {}
+    for row in cur.fetchall():
+        facet = facets.setdefault(None if row['everything'] else row['category_id'], {'items': 0, 'posts': 0})
+        facet['items'] += row['items'] or 0
+        facet['posts'] += row['posts'] or 0
+    facets_cache.put(search_query, facets, version, size=len(facets))
+    return facets
+
+def facet_count(facets, category_filter, kind):
+    # 目前選的分類（沒選就是全部）有幾樣物品 / 幾篇貼文
+    if not category_filter:
+        return facets[None][kind]
+    if not category_filter.isdigit():
+        return 0
+    return facets.get(int(category_filter), {}).get(kind, 0)
+
+def browse_cache_key(view_mode, category_filter, search_query, per_page, stream=False):
+    # 只快取沒登入、也沒有 flash 訊息的人看到的頁面，其他人看到的 HTML 會不一樣
+    # 一次列出全部的頁面可能很大，也不快取
+    # 找附近的每個人位置都不一樣，也不快取
+    if not response_cache.enabled or stream or 'user_id' in session or session.get('_flashes') or request.args.get('lat'):
+        return None
+    return (view_mode, category_filter, search_query, per_page,
+            request.args.get('after'), request.args.get('before'))
+
+def browse_response(html, cache_key=None, cache_version=None):
+    response = app.make_response(html)
+    if cache_key is not None:
+        response_cache.put(cache_key, html, cache_version)
+        response.headers['X-Cache'] = 'MISS'
+    return response
+
+def stream_rows(sql, params):
+    # 具名 cursor = 資料庫那邊的 server-side cursor，每次只拿 STREAM_BATCH_SIZE 筆到記憶體
+    # template 跑到 for 迴圈才開始查，頁面前半段（搜尋框、分類）不用等查詢就先送出去
+    # 連線在這裡自己借：view return 之後 teardown 就會把 g 裡的連線還掉，那時候還沒開始送
+    # 整頁送完、或是使用者中途關掉頁面，都會走到 finally 把連線還回去
+    conn = db_pool.connection()
+    try:
+        cur = conn.cursor(name='browse_stream', cursor_factory=psycopg2.extras.DictCursor)
+        cur.itersize = STREAM_BATCH_SIZE
+        cur.execute(sql, params)
+        yield from cur
+        cur.close()
+    finally:
+        conn.close()
+
+def page_links(has_prev, has_next, first_row, last_row, cursor_of):
+    # 上一頁/下一頁的網址，其他參數 (view, category, q, per_page) 原封不動帶過去
+    args = request.args.to_dict()
+    args.pop('after', None)
+    args.pop('before', None)
+
+    prev_url = url_for('index', **args, before=encode_cursor(cursor_of(first_row))) if has_prev and first_row else None
+    next_url = url_for('index', **args, after=encode_cursor(cursor_of(last_row))) if has_next and last_row else None
+    return prev_url, next_url
+
 @app.route('/')
 def index():
     # 1. 處理視圖模式
@@ -40,129 +677,295 @@ def index():
     category_filter = request.args.get('category')
     search_query = request.args.get('q', '') # 獲取關鍵字搜尋參數
 
+    per_page = max(1, min(request.args.get('per_page', PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    # 物品模式可以不分頁，一次列出全部（邊查邊送）
+    stream = view_mode == 'item' and request.args.get('stream') == '1'
+
+    # 快取裡有就直接回，不用碰資料庫
+    cache_key = browse_cache_key(view_mode, category_filter, search_query, per_page, stream)
+    cache_version = response_cache.version
+    if cache_key is not None:
+        html = response_cache.get(cache_key)
+        if html is not None:
+            response = app.make_response(html)
+            response.headers['X-Cache'] = 'HIT'
+            return response
+
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
     # 取得所有分類供側邊欄使用
-    cur.execute("SELECT * FROM categories ORDER BY category_id ASC")
-    all_categories = cur.fetchall()
+    all_categories = load_categories(cur)
 
-    if view_mode == 'item':
-        # --- [修正 1] 先處理搜尋與過濾參數 ---
-        query_params = []
-        filter_sql = ""
-        
+    feed = use_browse_feed(cur, category_filter, search_query)
+    if feed:
+        join_sql, filter_sql, query_params, item_rank_sql, post_rank_sql = "", "", [], None, None
         if category_filter:
-            filter_sql += " AND c.category_id = %s"
+            filter_sql = " AND f.category_id = %s" if view_mode == 'item' else " AND f.category_ids @> ARRAY[%s]::int[]"
             query_params.append(category_filter)
-        
-        if search_query:
-            filter_sql += " AND (i.item_name ILIKE %s OR p.description ILIKE %s)"
-            query_params.append(f'%{search_query}%')
-            query_params.append(f'%{search_query}%')
-
-        # --- [修正 2] 計算總數 (也要包含搜尋條件) ---
-        cnt_sql = f"""
-            SELECT sum(i.quantity)
-            FROM item i
-            JOIN post p ON i.post_id = p.post_id
-            LEFT JOIN categories c ON i.category_id = c.category_id
-            WHERE i.quantity > 0 {filter_sql}
-        """
-        cur.execute(cnt_sql, tuple(query_params))
-        result = cur.fetchone()
-        cnt = result[0] if result and result[0] else 0
+    else:
+        join_sql, filter_sql, query_params, item_rank_sql, post_rank_sql = \
+            build_browse_filters(cur, category_filter, search_query)
 
-        # --- [修正 3] 取得物品資料 (共用 filter_sql) ---
-        sql = f"""
-            SELECT i.item_id, i.item_name, i.quantity, i.expiration_date,
+    # 物品模式網址帶 lat / lon 就是找附近：照距離排，只找半徑內的（要讀 feed，搜尋的時候不算）
+    near, radius = None, None
+    if view_mode == 'item' and request.args.get('lat') and not search_query:
+        try:
+            near = geo.parse_coordinates(request.args.get('lat'), request.args.get('lon'))
+        except ValueError as e:
+            flash(str(e))
+        if near and not feed:
+            flash('找附近的物品要先執行 database/migrations/012_location_coordinates.sql')
+            near = None
+        radius = geo.parse_radius(request.args.get('radius'), NEAR_DEFAULT_RADIUS_KM, NEAR_MAX_RADIUS_KM)
+    stream = stream and near is None
+
+    # 側邊欄的分類數量跟這一頁上面的總數（找附近的只看半徑內，不顯示）
+    facets = None if near else category_facets(cur, search_query)
+
+    # 有全文搜尋的時候先照相關度排，再照原本的順序
+    if near:
+        sort_keys, cursor_types = NEAR_SORT_KEYS, NEAR_CURSOR_TYPES
+    elif view_mode == 'item':
+        sort_keys = FEED_ITEM_SORT_KEYS if feed else ([(item_rank_sql, 'DESC')] if item_rank_sql else []) + ITEM_SORT_KEYS
+        cursor_types = (['number'] if item_rank_sql else []) + ITEM_CURSOR_TYPES
+    else:
+        sort_keys = FEED_POST_SORT_KEYS if feed else ([('s.rank', 'DESC')] if post_rank_sql else []) + POST_SORT_KEYS
+        cursor_types = (['number'] if post_rank_sql else []) + POST_CURSOR_TYPES
+
+    # 分頁參數：after = 從這筆之後開始，before = 往回翻到這筆之前
+    after = decode_cursor(request.args.get('after'), len(sort_keys), cursor_types)
+    before = decode_cursor(request.args.get('before'), len(sort_keys), cursor_types) if not after else None
+    backward = before is not None
+    cursor = after or before
+
+    page_sql, page_params = "", []
+    if cursor:
+        page_sql, page_params = keyset_condition(sort_keys, cursor, backward)
+        page_sql = " AND " + page_sql
+
+    if view_mode == 'item':
+        # --- 總數 (也要包含搜尋條件)，直接從分類數量拿 ---
+        # 找附近的不算總數：要把整個半徑內的物品都算一次距離，就沒辦法只看最近的那幾格
+        cnt = None if near else facet_count(facets, category_filter, 'items')
+
+        # --- 取得這一頁的物品 (共用 filter_sql) ---
+        # feed 裡只有還有庫存、沒被標成過期的；過期了但背景還沒標到的，用 expiration_date 擋掉
+        if near:
+            items, has_prev, has_next = paginate(
+                near_items(cur, near, radius, filter_sql, query_params, page_sql, page_params, cursor, backward, per_page),
+                per_page, backward, cursor is not None)
+        elif feed:
+            sql = f"""
+            SELECT f.item_id, f.item_name, f.quantity, f.expiration_date, f.post_id,
+                   f.category_name as name, f.category_id,
+                   f.description, f.available,
+                   f.location_name, f.city, f.district, f.street, f.number,
+                   f.owner_name as user_name, f.owner_id as user_id,
+                   r.avg_rating as owner_rating, r.rating_count as owner_rating_count,
+                   0 AS rank
+            FROM browse_item_feed f
+            LEFT JOIN user_reputation r ON f.owner_id = r.user_id
+            WHERE f.expiration_date > NOW() {filter_sql} {page_sql}
+            ORDER BY {order_by_sql(sort_keys, backward)}
+            """
+        else:
+            # NOT i.expired 要寫出來才會用 item_live_browse_idx（只有沒過期、還有庫存的）
+            sql = f"""
+            SELECT i.item_id, i.item_name, i.quantity, i.expiration_date, i.post_id,
                    c.name, c.category_id,
                    p.description, p.available, 
                    l.location_name, l.city, l.district, l.street, l.number,
-                   u.name as user_name, u.user_id
+                   u.name as user_name, u.user_id,
+                   r.avg_rating as owner_rating, r.rating_count as owner_rating_count,
+                   {item_rank_sql or 0} AS rank
             FROM item i 
             LEFT JOIN post p ON i.post_id = p.post_id
             LEFT JOIN location l ON i.location_id = l.location_id
             LEFT JOIN categories c ON i.category_id = c.category_id
             LEFT JOIN users u ON p.user_id = u.user_id
-            WHERE i.quantity > 0 {filter_sql}
-            ORDER BY i.quantity DESC, p.post_id DESC, c.category_id ASC
+            LEFT JOIN user_reputation r ON p.user_id = r.user_id
+            {join_sql}
+            WHERE i.quantity > 0 AND NOT i.expired AND i.expiration_date > NOW() {filter_sql} {page_sql}
+            ORDER BY {order_by_sql(sort_keys, backward)}
         """
-        cur.execute(sql, tuple(query_params))
-        items = cur.fetchall()
+
+        if stream:
+            cur.close()
+            conn.close()
+            # base.html 會讀 flash 訊息，要在送出 header（session cookie）之前先從 session 拿掉
+            get_flashed_messages()
+            return stream_template('index_item.html',
+                                   view_mode='item',
+                                   items=stream_rows(sql, tuple(query_params + page_params)),
+                                   total=cnt,
+                                   categories=all_categories,
+                                   facets=facets,
+                                   current_category=category_filter,
+                                   q=search_query,
+                                   streaming=True)
+
+        if not near:
+            cur.execute(sql + " LIMIT %s", tuple(query_params + page_params + [per_page + 1]))
+            items, has_prev, has_next = paginate(cur.fetchall(), per_page, backward, cursor is not None)
 
         cur.close()
         conn.close()
 
-        return render_template('index_item.html', 
+        def item_cursor(r):
+            if near:
+                return [r['distance'], r['item_id']]
+            values = [r['quantity'], r['post_id'], r['category_id'], r['item_id']]
+            return [r['rank']] + values if item_rank_sql else values
+
+        prev_url, next_url = page_links(has_prev, has_next,
+                                        items[0] if items else None,
+                                        items[-1] if items else None,
+                                        item_cursor)
+
+        return browse_response(render_template('index_item.html', 
                                view_mode='item', 
                                items=items, 
                                total=cnt,
                                categories=all_categories,
+                               facets=facets,
                                current_category=category_filter,
-                               q=search_query) # 傳回搜尋字，讓搜尋框能顯示
+                               q=search_query, # 傳回搜尋字，讓搜尋框能顯示
+                               near=near,
+                               radius=radius,
+                               prev_url=prev_url,
+                               next_url=next_url), cache_key, cache_version)
     
     else:
-        # --- [修正 4] 貼文模式搜尋邏輯 ---
-        query_params = []
-        filter_sql = ""
+        # --- 貼文模式：分頁是以「貼文」為單位，同一篇的物品不會被切到兩頁 ---
+        if feed:
+            # feed 裡一篇一列，物品已經照分類、item_id 排好；過期的狀態要用現在的時間再算一次
+            item_filter_sql = "WHERE (it->>'category_id')::int = %s" if category_filter else ""
+
+            cur.execute(f"""
+                SELECT f.post_id, f.description, f.owner_id, f.owner_name,
+                       r.avg_rating as owner_rating, r.rating_count as owner_rating_count,
+                       (SELECT jsonb_agg(it || jsonb_build_object(
+                                   'expired', (it->>'expired')::boolean OR (it->>'expiration_date')::timestamp <= NOW()
+                               ) ORDER BY n)
+                        FROM jsonb_array_elements(f.items) WITH ORDINALITY e(it, n) {item_filter_sql}) AS items
+                FROM browse_post_feed f
+                LEFT JOIN user_reputation r ON f.owner_id = r.user_id
+                WHERE TRUE {filter_sql} {page_sql}
+                ORDER BY {order_by_sql(sort_keys, backward)}
+                LIMIT %s
+            """, tuple(query_params + query_params + page_params + [per_page + 1]))
+            rows, has_prev, has_next = paginate(cur.fetchall(), per_page, backward, cursor is not None)
+            cur.close()
+            conn.close()
 
-        if category_filter:
-            filter_sql += " AND c.category_id = %s"
-            query_params.append(category_filter)
-        
-        if search_query:
-            filter_sql += " AND (i.item_name ILIKE %s OR p.description ILIKE %s)"
-            query_params.append(f'%{search_query}%')
-            query_params.append(f'%{search_query}%')
+            posts = [{
+                'post_id': r['post_id'],
+                'description': r['description'],
+                'available': True,
+                'items': r['items'],
+                'owner_name': r['owner_name'],
+                'owner_id': r['owner_id'],
+                'owner_rating': r['owner_rating'],
+                'owner_rating_count': r['owner_rating_count']
+            } for r in rows]
+        else:
+            match_sql = f"""
+                p.available = TRUE
+                AND EXISTS (
+                    SELECT 1
+                    FROM item i
+                    LEFT JOIN categories c ON i.category_id = c.category_id
+                    WHERE i.post_id = p.post_id {filter_sql}
+                )
+            """
 
-        sql = f"""
-            SELECT i.item_id, i.item_name, i.quantity, i.expiration_date,
-                   c.name, c.category_id,
-                   p.description, p.available, p.post_id,
-                   l.location_name, l.city, l.district, l.street, l.number,
-                   u.name as user_name, u.user_id
-            FROM item i
-            LEFT JOIN post p ON i.post_id = p.post_id
-            LEFT JOIN location l ON i.location_id = l.location_id
-            LEFT JOIN categories c ON i.category_id = c.category_id
-            LEFT JOIN users u ON p.user_id = u.user_id
-            WHERE p.available = TRUE {filter_sql}
-            ORDER BY p.post_id DESC, c.category_id ASC
-        """
+            cur.execute(f"""
+                SELECT s.post_id, s.rank
+                FROM (
+                    SELECT p.post_id, {post_rank_sql or 0} AS rank
+                    FROM post p {join_sql}
+                    WHERE {match_sql}
+                ) s
+                WHERE TRUE {page_sql}
+                ORDER BY {order_by_sql(sort_keys, backward)}
+                LIMIT %s
+            """, tuple(query_params + page_params + [per_page + 1]))
+            page_posts, has_prev, has_next = paginate(cur.fetchall(), per_page, backward, cursor is not None)
+            post_ids = [r['post_id'] for r in page_posts]
+            post_rank = {r['post_id']: r['rank'] for r in page_posts}
+
+            data = []
+            if post_ids:
+                sql = f"""
+                    SELECT i.item_id, i.item_name, i.quantity, i.expiration_date,
+                           i.expired OR i.expiration_date <= NOW() AS expired,
+                           c.name, c.category_id,
+                           p.description, p.available, p.post_id,
+                           l.location_name, l.city, l.district, l.street, l.number,
+                           u.name as user_name, u.user_id,
+                           r.avg_rating as owner_rating, r.rating_count as owner_rating_count
+                    FROM item i
+                    LEFT JOIN post p ON i.post_id = p.post_id
+                    LEFT JOIN location l ON i.location_id = l.location_id
+                    LEFT JOIN categories c ON i.category_id = c.category_id
+                    LEFT JOIN users u ON p.user_id = u.user_id
+                    LEFT JOIN user_reputation r ON p.user_id = r.user_id
+                    {join_sql}
+                    WHERE TRUE {filter_sql} AND p.post_id = ANY(%s)
+                    ORDER BY p.post_id DESC, c.category_id ASC, i.item_id ASC
+                """
+                cur.execute(sql, tuple(query_params + [post_ids]))
+                data = cur.fetchall()
 
-        cur.execute(sql, tuple(query_params))
-        data = cur.fetchall()
-        cur.close()
-        conn.close()
+            cur.close()
+            conn.close()
 
-        posts_map = {}
-        for i in data:
-            p_id = i['post_id']
-            if p_id not in posts_map:
-                posts_map[p_id] = {
-                    'post_id': p_id,
-                    'description': i['description'],
-                    'available': i['available'],
-                    'items': [],
-                    'owner_name': i['user_name'],
-                    'owner_id': i['user_id']
-                }
-
-            posts_map[p_id]['items'].append({
-                'item_id': i['item_id'],
-                'item_name': i['item_name'],
-                'quantity': i['quantity'],
-                'category_name': i['name']
-            })
+            posts_map = {}
+            for i in data:
+                p_id = i['post_id']
+                if p_id not in posts_map:
+                    posts_map[p_id] = {
+                        'post_id': p_id,
+                        'description': i['description'],
+                        'available': i['available'],
+                        'items': [],
+                        'owner_name': i['user_name'],
+                        'owner_id': i['user_id'],
+                        'owner_rating': i['owner_rating'],
+                        'owner_rating_count': i['owner_rating_count']
+                    }
+
+                posts_map[p_id]['items'].append({
+                    'item_id': i['item_id'],
+                    'item_name': i['item_name'],
+                    'quantity': i['quantity'],
+                    'expired': i['expired'],
+                    'category_name': i['name']
+                })
+
+            posts = [posts_map[p_id] for p_id in post_ids if p_id in posts_map]
+
+        total = facet_count(facets, category_filter, 'posts')
+
+        def post_cursor(p):
+            return [post_rank[p['post_id']], p['post_id']] if post_rank_sql else [p['post_id']]
+
+        prev_url, next_url = page_links(has_prev, has_next,
+                                        posts[0] if posts else None,
+                                        posts[-1] if posts else None,
+                                        post_cursor)
         
-        return render_template('index_post.html', 
+        return browse_response(render_template('index_post.html', 
                                view_mode="post", 
-                               posts=list(posts_map.values()),
-                               total=len(posts_map),
+                               posts=posts,
+                               total=total,
                                categories=all_categories,
+                               facets=facets,
                                current_category=category_filter,
-                               q=search_query) # 傳回搜尋字
+                               q=search_query, # 傳回搜尋字
+                               prev_url=prev_url,
+                               next_url=next_url), cache_key, cache_version)
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -181,34 +984,60 @@ def login():
             """
             cur.execute(sql, (username_input,))
             account = cur.fetchone()
-
-            if account:
-                if check_password_hash(account['pwd'], password_input):
-                    update_sql = """
-                        UPDATE account
-                        SET lastlogin = NOW()
-                        WHERE user_id = %s;
-                    """
-                    cur.execute(update_sql, (account['user_id'],))
-                    conn.commit()
-
-                    session['user_id'] = account['user_id']
-                    session['username'] = account['name']
-                    flash('登入成功！')
-                    return redirect(url_for('index'))
-                else:
-                    flash('密碼錯誤！')
-            else:
-                flash('帳戶名稱錯誤或帳戶不存在')
         except Exception as e:
             conn.rollback()
             print(f"登入過程發生錯誤: {e}")
             flash('系統錯誤，請稍後再試')
-
+            return render_template('login.html')
         finally:
+            # 算密碼要幾十毫秒，這段時間不要佔著連線
             cur.close()
             conn.close()
 
+        if not account:
+            flash('帳戶名稱錯誤或帳戶不存在')
+            return render_template('login.html')
+
+        if not password_hasher.verify(account['pwd'], password_input):
+            flash('密碼錯誤！')
+            return render_template('login.html')
+
+        # 舊密碼是用以前的設定 (PASSWORD_HASH_METHOD) 算的，趁現在有明碼重算一次
+        # 算 hash 的 process 剛好很忙就先不換，密碼是對的，登入不能因為這個失敗
+        new_hash = None
+        if password_hasher.needs_rehash(account['pwd']):
+            try:
+                new_hash = password_hasher.hash(password_input)
+            except HasherBusy:
+                pass
+        if new_hash is not None:
+            conn = get_db_connection()
+            cur = conn.cursor()
+            try:
+                # 只在 pwd 還是剛剛驗證的那個時才換，中間剛好改過密碼就不要蓋掉
+                update_sql = """
+                    UPDATE account
+                    SET pwd = %s
+                    WHERE user_id = %s AND pwd = %s;
+                """
+                cur.execute(update_sql, (new_hash, account['user_id'], account['pwd']))
+                conn.commit()
+            except Exception as e:
+                # 沒換成功也沒關係，下次登入再換
+                conn.rollback()
+                print(f"更新密碼 hash 失敗: {e}")
+            finally:
+                cur.close()
+                conn.close()
+
+        # lastlogin 交給 lastlogin_buffer 晚幾秒一起寫
+        lastlogin_buffer.record(account['user_id'])
+
+        session['user_id'] = account['user_id']
+        session['username'] = account['name']
+        flash('登入成功！')
+        return redirect(url_for('index'))
+
     return render_template('login.html')    
 
 @app.route('/logout')
@@ -217,6 +1046,20 @@ def logout():
     flash('成功登出')
     return redirect(url_for('index'))
 
+def claim_failure_message(result):
+    # claim_item() / claim_items() 回傳的 status 轉成給使用者看的訊息
+    if result['status'] == 'own_item':
+        return '這個是你自己的東西！'
+    if result['status'] == 'insufficient':
+        return f'庫存不夠！只有{result["remaining"]} 個！'
+    if result['status'] == 'unavailable':
+        return '這個東西已經被拿完了！'
+    if result['status'] == 'expired':
+        return '這個東西已經過期下架了！'
+    return '發生錯誤！請重新操作！'
+
+MAX_INT = 2 ** 31 - 1   # item_id、數量都是 int，超過的值 psycopg2 會送成 bigint，就對不到 claim_item() / claim_items()
+
 @app.route('/claim/<int:item_id>', methods=['POST'])
 def claim(item_id):
     if 'user_id' not in session:
@@ -225,57 +1068,245 @@ def claim(item_id):
     
     current_user_id = session['user_id']
     want_quantity = request.form.get('want_quantity', 1, type=int)
+    if not (1 <= item_id <= MAX_INT and 1 <= want_quantity <= MAX_INT):
+        flash('物品或數量不正確！')
+        return redirect(url_for('index'))
 
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
     try:
-        check_id = """
-            SELECT *
-            FROM (item i LEFT JOIN post p
-                    ON i.post_id = p.post_id)
-            WHERE i.item_id = %s AND p.user_id = %s
-        """
-        cur.execute(check_id, (item_id, current_user_id))
-        if (cur.fetchone()):
-            flash('這個是你自己的東西！')
+        # 檢查、鎖庫存、寫 trade 都在 claim_item() 裡一次做完（schema.sql）
+        cur.execute("SELECT status, item_name, remaining FROM claim_item(%s, %s, %s)",
+                    (current_user_id, item_id, want_quantity))
+        result = cur.fetchone()
+        conn.commit()
 
+        if result['status'] == 'ok':
+            catalog_changed()
+            flash(f'索取成功！你拿到了 {want_quantity} 個 {result["item_name"]} 🎉')
         else:
-            find_item = """
-                SELECT quantity, item_name
-                FROM item
-                WHERE item_id = %s;
-            """
+            flash(claim_failure_message(result))
 
-            cur.execute(find_item, (item_id,))
-            item = cur.fetchone()
+    except Exception as e:
+        conn.rollback()
+        flash(f'交易失敗：{e}')
 
-            if (item and want_quantity > 0 and item['quantity'] >= want_quantity):
-                insert_trade = """
-                    INSERT INTO trade (user_id, item_id, quantity, trade_time)
-                    VALUES (%s, %s, %s, NOW());
-                """
-                cur.execute(insert_trade, (session['user_id'], item_id, want_quantity,))
-                conn.commit()
+    finally:
+        cur.close()
+        conn.close()
 
-                flash(f'索取成功！你拿到了 {want_quantity} 個 {item["item_name"]} 🎉')
+    return redirect(url_for('index'))
 
-            elif item and item['quantity'] < want_quantity:
-                flash(f'庫存不夠！只有{item["quantity"]} 個！')
+MAX_BATCH_CLAIM = 50   # 一次最多索取幾種物品
+MAX_BULK_ITEMS = int(os.getenv("MAX_BULK_ITEMS", 1000))   # 批次上傳一次最多幾樣物品
+BULK_MAX_BYTES = 2 * 1024 * 1024                          # 批次上傳的檔案大小上限
+BULK_PAGE_SIZE = 1000                                     # execute_values 一條 INSERT 最多幾列
 
-            else:
-                flash('發生錯誤！請重新操作！')
+@app.route('/claim_batch', methods=['POST'])
+def claim_batch():
+    # 一次索取好幾個物品，全部成功才算數
+    # 表單：item_id 跟 want_quantity 各一串，數量 0 或空白的略過
+    # JSON：{"items": [{"item_id": 1, "quantity": 2}, ...]}，回傳每個物品的結果
+    as_json = request.is_json
+
+    def fail(message, code):
+        if as_json:
+            return jsonify({'ok': False, 'error': message}), code
+        flash(message)
+        return redirect(url_for('login') if code == 401 else url_for('index'))
 
+    if 'user_id' not in session:
+        return fail('請先登入！', 401)
+
+    wanted = []
+    try:
+        if as_json:
+            for entry in (request.get_json(silent=True) or {}).get('items', []):
+                wanted.append((int(entry['item_id']), int(entry.get('quantity', 1))))
+        else:
+            for item_id, quantity in zip(request.form.getlist('item_id'), request.form.getlist('want_quantity')):
+                if quantity.strip() and int(quantity) != 0:
+                    wanted.append((int(item_id), int(quantity)))
+    except (TypeError, KeyError, ValueError, AttributeError):
+        return fail('發生錯誤！請重新操作！', 400)
+
+    if not wanted:
+        return fail('請至少選一個要索取的物品！', 400)
+    if len(wanted) > MAX_BATCH_CLAIM:
+        return fail(f'一次最多只能索取 {MAX_BATCH_CLAIM} 種物品！', 400)
+    # 同一個物品出現好幾次的話 claim_items() 會先加起來，加起來也不能超過 int
+    totals = {}
+    for item_id, quantity in wanted:
+        if not (1 <= item_id <= MAX_INT and 1 <= quantity <= MAX_INT):
+            return fail('物品或數量不正確！', 400)
+        totals[item_id] = totals.get(item_id, 0) + quantity
+    if max(totals.values()) > MAX_INT:
+        return fail('物品或數量不正確！', 400)
+
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+
+    try:
+        cur.execute("SELECT item_id, status, item_name, remaining FROM claim_items(%s, %s, %s)",
+                    (session['user_id'], [i for i, _ in wanted], [q for _, q in wanted]))
+        results = cur.fetchall()
+        conn.commit()
     except Exception as e:
         conn.rollback()
-        flash(f'交易失敗：{e}')
-
+        return fail(f'交易失敗：{e}', 500)
     finally:
         cur.close()
         conn.close()
 
+    all_ok = all(r['status'] == 'ok' for r in results)
+    if all_ok:
+        catalog_changed()
+    if as_json:
+        return jsonify({'ok': all_ok, 'results': [dict(r) for r in results]}), 200 if all_ok else 409
+
+    if all_ok:
+        taken = {}
+        for item_id, quantity in wanted:
+            taken[item_id] = taken.get(item_id, 0) + quantity
+        names = {r['item_id']: r['item_name'] for r in results}
+        flash('索取成功！你拿到了 ' + '、'.join(f'{q} 個 {names[i]}' for i, q in taken.items()) + ' 🎉')
+    else:
+        for r in results:
+            if r['status'] != 'ok':
+                flash(f'{r["item_name"] or "物品"}：{claim_failure_message(r)}')
+        flash('有物品沒辦法索取，這次全部都沒有拿喔！')
+
     return redirect(url_for('index'))
 
+# 個人頁面的三個列表都是新的在前面，後面補 id 讓順序固定，分頁用
+PROFILE_LIST_SIZE = int(os.getenv("PROFILE_LIST_SIZE", 20))   # 個人頁面每個列表一次顯示幾筆
+PROFILE_SORT_KEYS = {
+    'claims': [('t.trade_time', 'DESC'), ('t.trade_id', 'DESC')],
+    'comments': [('c.comment_time', 'DESC'), ('c.comment_id', 'DESC')],
+    'posts': [('p.post_time', 'DESC'), ('p.post_id', 'DESC')],
+}
+PROFILE_CURSOR_FIELDS = {
+    'claims': ('trade_time', 'trade_id'),
+    'comments': ('comment_time', 'comment_id'),
+    'posts': ('post_time', 'post_id'),
+}
+PROFILE_TIME_FIELDS = ('trade_time', 'comment_time', 'post_time')
+PROFILE_CURSOR_TYPES = ['timestamp', 'int']   # 三個列表都是（時間, id），型別不對的 cursor 當作沒帶
+
+def profile_page_sql(name, table_sql, where_sql, select_sql, user_id, params, filter_sql=""):
+    # 某個列表的其中一頁：網址有帶 <name>_after 就從那筆之後開始，多抓一筆判斷還有沒有下一頁
+    # filter_sql 是另外要加的條件（不能有參數），例如排除已經刪除的貼文
+    sort_keys = PROFILE_SORT_KEYS[name]
+    cursor = decode_cursor(request.args.get(f'{name}_after'), len(sort_keys), PROFILE_CURSOR_TYPES)
+    page_sql = ""
+    params.append(user_id)
+    if cursor:
+        page_sql, page_params = keyset_condition(sort_keys, cursor)
+        page_sql = " AND " + page_sql
+        params.extend(page_params)
+    params.append(PROFILE_LIST_SIZE + 1)
+    return f"""
+    SELECT {select_sql}
+    FROM {table_sql}
+    WHERE {where_sql} = %s {filter_sql} {page_sql}
+    ORDER BY {order_by_sql(sort_keys)}
+    LIMIT %s
+    """
+
+def load_profile(cur, user_id, with_claims):
+    # 整個個人頁面只查一次：每個列表先在 CTE 裡分頁，再 json_agg 成一欄，跟使用者資料一起回來
+    # 原本每一列都跑一次的子查詢（我的評分、物品數）改成只對這一頁的貼文 GROUP BY 一次
+    params = []
+    ctes = []
+    if with_claims:
+        claims_sql = profile_page_sql(
+            'claims',
+            "(trade t LEFT JOIN item i ON t.item_id = i.item_id) LEFT JOIN post p ON i.post_id = p.post_id",
+            "t.user_id",
+            "t.trade_id, t.trade_time, t.quantity, i.item_name, p.description as post_title, p.post_id",
+            user_id, params, "AND p.deleted_at IS NULL")
+        ctes.append(f"claims_page AS ({claims_sql})")
+        ctes.append("""my_ratings AS (
+    SELECT DISTINCT ON (c.post_id) c.post_id, c.rating
+    FROM comment c
+    WHERE c.user_id = %s AND c.post_id IN (SELECT post_id FROM claims_page)
+      -- 評價一定在貼文之後，加上時間的下限 comment 只要看這些貼文之後的月份
+      AND c.comment_time >= COALESCE((SELECT MIN(p.post_time) FROM post p WHERE p.post_id IN (SELECT post_id FROM claims_page)), '-infinity')
+    ORDER BY c.post_id, c.comment_id
+    )""")
+        params.append(user_id)
+
+    # 已經刪除（還沒刪完）的貼文、帳號：貼文跟評價者已經刪掉帳號的評價都不列出來
+    comments_sql = profile_page_sql(
+        'comments',
+        "comment c JOIN post p ON c.post_id = p.post_id JOIN users cu ON c.user_id = cu.user_id",
+        "p.user_id",
+        "c.comment_id, c.comment_str, c.rating, c.comment_time, p.description",
+        user_id, params, "AND p.deleted_at IS NULL AND cu.deleted_at IS NULL")
+    ctes.append(f"comments_page AS ({comments_sql})")
+
+    posts_sql = profile_page_sql(
+        'posts',
+        "post p",
+        "p.user_id",
+        "p.post_id, p.description, p.post_time, p.available",
+        user_id, params, "AND p.deleted_at IS NULL")
+    ctes.append(f"posts_page AS ({posts_sql})")
+    ctes.append("""item_counts AS (
+    SELECT i.post_id, COUNT(*) as item_count
+    FROM item i
+    WHERE i.post_id IN (SELECT post_id FROM posts_page)
+    GROUP BY i.post_id
+    )""")
+
+    claims_col = """(SELECT json_agg(x ORDER BY x.trade_time DESC, x.trade_id DESC)
+             FROM (SELECT cp.*, mr.rating as my_rating
+                   FROM claims_page cp LEFT JOIN my_ratings mr ON cp.post_id = mr.post_id) x) as claims""" \
+        if with_claims else "NULL as claims"
+
+    sql = f"""
+    WITH {', '.join(ctes)}
+    SELECT u.name, u.organization, a.username,
+           COALESCE(r.avg_rating, 0) as avg_score,
+           COALESCE(r.rating_count, 0) as review_count,
+           (SELECT json_agg(json_build_object('phone_number', ph.phone_number) ORDER BY ph.phone_number)
+            FROM phone ph WHERE ph.user_id = u.user_id) as phones,
+           {claims_col},
+           (SELECT json_agg(x ORDER BY x.comment_time DESC, x.comment_id DESC)
+            FROM comments_page x) as comments,
+           (SELECT json_agg(x ORDER BY x.post_time DESC, x.post_id DESC)
+            FROM (SELECT pp.*, COALESCE(ic.item_count, 0) as item_count
+                  FROM posts_page pp LEFT JOIN item_counts ic ON pp.post_id = ic.post_id) x) as posts
+    FROM (users u LEFT JOIN account a
+            ON u.user_id = a.user_id) LEFT JOIN user_reputation r
+            ON u.user_id = r.user_id
+    WHERE u.user_id = %s AND u.deleted_at IS NULL
+    """
+    params.append(user_id)
+    cur.execute(sql, tuple(params))
+    return cur.fetchone()
+
+def profile_list(rows, name, endpoint, **view_args):
+    # json 裡的時間是字串，轉回 datetime 讓 template 照舊用 strftime
+    rows = rows or []
+    for row in rows:
+        for field in PROFILE_TIME_FIELDS:
+            if row.get(field):
+                row[field] = datetime.fromisoformat(row[field])
+
+    more = len(rows) > PROFILE_LIST_SIZE
+    rows = rows[:PROFILE_LIST_SIZE]
+
+    args = request.args.to_dict()
+    args.pop(f'{name}_after', None)
+    first_url = url_for(endpoint, **view_args, **args) if request.args.get(f'{name}_after') else None
+    next_url = None
+    if more:
+        cursor = [rows[-1][field] for field in PROFILE_CURSOR_FIELDS[name]]
+        next_url = url_for(endpoint, **view_args, **args, **{f'{name}_after': encode_cursor(cursor)})
+    return rows, first_url, next_url
+
 @app.route('/profile')
 def profile():
     if 'user_id' not in session:
@@ -284,68 +1315,24 @@ def profile():
     user_id = session['user_id']
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    
-    info_sql = """
-    SELECT u.name, u.organization, a.username,
-           COALESCE(AVG(c.rating), 0) as avg_score,
-           COUNT(c.comment_id) as review_count
-    FROM ((users u LEFT JOIN account a 
-            ON u.user_id = a.user_id) LEFT JOIN post p 
-            ON u.user_id = p.user_id) LEFT JOIN comment c 
-            ON p.post_id = c.post_id
-    WHERE u.user_id = %s
-    GROUP BY u.user_id, a.username;
-    """
-    cur.execute(info_sql, (user_id,))
-    user_info = cur.fetchone()
 
-    phone_sql = """
-    SELECT phone_number
-    FROM phone
-    WHERE user_id = %s
-    """
-    cur.execute(phone_sql, (user_id,))
-    phone = cur.fetchall()
-
-    comments_sql = """
-    SELECT c.comment_str, c.rating, c.comment_time, p.description
-    FROM (comment c LEFT JOIN post p
-            ON c.post_id = p.post_id)
-    WHERE p.user_id = %s
-    ORDER BY c.comment_time DESC
-    """
-    cur.execute(comments_sql, (user_id,))
-    past_comments = cur.fetchall()
-
-    claim_sql = """
-    SELECT t.trade_time, t.quantity, i.item_name, 
-           p.description as post_title, p.post_id,
-            (SELECT rating FROM comment c 
-             WHERE c.post_id = p.post_id AND c.user_id = %s LIMIT 1) as my_rating
-    FROM (trade t LEFT JOIN item i
-             ON t.item_id = i.item_id) LEFT JOIN post p
-             ON i.post_id = p.post_id
-    WHERE t.user_id = %s
-    ORDER BY t.trade_time DESC
-    """
-    cur.execute(claim_sql, (user_id, user_id))
-    my_claims = cur.fetchall()
-
-
-    post_sql = """
-    SELECT p.post_id,  p.description, p.post_time, p.available,
-           (SELECT COUNT(*) FROM item i WHERE i.post_id = p.post_id) as item_count
-    FROM post p
-    WHERE p.user_id = %s
-    ORDER BY p.post_time DESC
-    """
-    cur.execute(post_sql, (user_id,))
-    my_posts = cur.fetchall()
+    user_info = load_profile(cur, user_id, with_claims=True)
 
     cur.close()
     conn.close()
 
-    return render_template('profile.html', user=user_info, comments=past_comments, claims=my_claims, posts=my_posts, phones=phone)
+    if not user_info:
+        session.clear()
+        return redirect(url_for('login'))
+
+    my_claims, claims_first, claims_next = profile_list(user_info['claims'], 'claims', 'profile')
+    past_comments, comments_first, comments_next = profile_list(user_info['comments'], 'comments', 'profile')
+    my_posts, posts_first, posts_next = profile_list(user_info['posts'], 'posts', 'profile')
+
+    return render_template('profile.html', user=user_info, comments=past_comments, claims=my_claims, posts=my_posts, phones=user_info['phones'] or [],
+                           claims_first=claims_first, claims_next=claims_next,
+                           comments_first=comments_first, comments_next=comments_next,
+                           posts_first=posts_first, posts_next=posts_next)
 
 @app.route('/delete_post/<int:post_id>', methods=['POST'])
 def delete_post(post_id):
@@ -357,12 +1344,15 @@ def delete_post(post_id):
     cur = conn.cursor()
     
     try:
-        cur.execute("SELECT user_id FROM post WHERE post_id = %s", (post_id,))
+        cur.execute("SELECT user_id FROM post WHERE post_id = %s AND deleted_at IS NULL", (post_id,))
         post = cur.fetchone()
         
         if post and post[0] == session['user_id']:
-            cur.execute("DELETE FROM post WHERE post_id = %s", (post_id,))
+            # 先標成刪除（結案、物品下架，首頁馬上看不到），底下的索取紀錄、評價由背景一批一批刪（migrations/014）
+            cur.execute("SELECT soft_delete_post(%s)", (post_id,))
             conn.commit()
+            catalog_changed()
+            purge_worker.wake()
             flash('貼文已刪除！')
         else:
             flash('你沒有權限刪除此貼文！')
@@ -400,18 +1390,24 @@ def add_comment(post_id):
             SELECT comment_id
             FROM comment
             WHERE post_id = %s and user_id = %s
+              AND comment_time >= COALESCE((SELECT post_time FROM post WHERE post_id = %s), '-infinity')   -- 貼文之前的月份不用找
             """
-            cur.execute(find_comment, (post_id, user_id))
+            cur.execute(find_comment, (post_id, user_id, post_id))
             
             if cur.fetchone():
                 flash('你已經評價過這篇貼文囉！')
             else:
-                # 寫入評價
+                # 寫入評價（貼文已經刪除的話不寫）
+                cur.execute("SELECT 1 FROM post WHERE post_id = %s AND deleted_at IS NULL", (post_id,))
+                if cur.fetchone() is None:
+                    flash('找不到該貼文！')
+                    return redirect(url_for('index'))
                 cur.execute("""
                     INSERT INTO comment (post_id, user_id, rating, comment_str)
                     VALUES (%s, %s, %s, %s)
                 """, (post_id, user_id, rating, comment_str))
                 conn.commit()
+                catalog_changed()   # 首頁發文者旁邊有評價分數
                 flash('評價成功！')
 
         except Exception as e:
@@ -430,7 +1426,7 @@ def add_comment(post_id):
     post_sql = """
     SELECT description
     FROM post
-    WHERE post_id = %s
+    WHERE post_id = %s AND deleted_at IS NULL
     """
     cur.execute(post_sql, (post_id,))
     post = cur.fetchone()
@@ -465,6 +1461,7 @@ def edit_name():
                 """
                 cur.execute(update_sql, (new_name, session['user_id']))
                 conn.commit()
+                catalog_changed()   # 首頁有發文者名稱
                 flash('名字修改成功！')
                 session['username'] = new_name
                 return redirect(url_for('profile'))
@@ -485,6 +1482,10 @@ def change_pwd():
         new_pwd = request.form.get('new_pwd')
         confirm_pwd = request.form.get('confirm_pwd')
 
+        if new_pwd != confirm_pwd:
+            flash('兩次輸入的密碼不一樣！')
+            return redirect(url_for('change_pwd'))
+
         conn = get_db_connection()
         cur = conn.cursor()
 
@@ -496,6 +1497,9 @@ def change_pwd():
 
         cur.execute(pwd_sql, (session['user_id'],))
         result = cur.fetchone()
+        # 算密碼的時候先把連線還回去
+        cur.close()
+        conn.close()
 
         if not result:
             flash('帳號異常，請重新登入')
@@ -503,19 +1507,14 @@ def change_pwd():
         
         hash_pwd = result[0]
 
-        if not check_password_hash(hash_pwd, old_pwd):
+        if not password_hasher.verify(hash_pwd, old_pwd):
             flash('舊密碼錯誤！')
-            cur.close()
-            conn.close()
-            return redirect(url_for('change_pwd'))
-        
-        if new_pwd != confirm_pwd:
-            flash('兩次輸入的密碼不一樣！')
-            cur.close()
-            conn.close()
             return redirect(url_for('change_pwd'))
         
-        new_hash = generate_password_hash(new_pwd)
+        new_hash = password_hasher.hash(new_pwd)
+
+        conn = get_db_connection()
+        cur = conn.cursor()
 
         try:
             upd_sql = """
@@ -550,12 +1549,12 @@ def delete_account():
     cur = conn.cursor()
 
     try:
-        del_sql = """
-        DELETE FROM users
-        WHERE user_id = %s
-        """
-        cur.execute(del_sql, (session['user_id'],))
+        # 先標成刪除：帳號、手機號碼馬上刪掉，貼文全部結案；索取紀錄、評價、貼文由背景一批一批刪（migrations/014）
+        # 索取過很多次的帳號，原本一句 DELETE cascade 下去要鎖很久
+        cur.execute("SELECT soft_delete_user(%s)", (session['user_id'],))
         conn.commit()
+        catalog_changed()
+        purge_worker.wake()
 
         session.clear()
         flash('帳號已刪除')
@@ -592,6 +1591,9 @@ def register():
             flash('兩次密碼輸入不一樣！')
             return redirect(url_for('register'))
         
+        # 先算好，不要在開著交易的時候算
+        hash_pwd = password_hasher.hash(pwd)
+
         conn = get_db_connection()
         cur = conn.cursor()
         
@@ -626,8 +1628,6 @@ def register():
             cur.execute(register_user, (name, organization))
             new_user_id = cur.fetchone()[0]
 
-            hash_pwd = generate_password_hash(pwd)
-
             register_account = """
             INSERT INTO account (user_id, username, pwd)
             VALUES (%s, %s, %s)
@@ -663,56 +1663,23 @@ def public_profile(target_user_id):
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
-    info_sql = """
-    SELECT u.name, u.organization, a.username,
-           COALESCE(AVG(c.rating), 0) as avg_score,
-           COUNT(c.comment_id) as review_count
-    FROM ((users u LEFT JOIN account a 
-            ON u.user_id = a.user_id) LEFT JOIN post p 
-            ON u.user_id = p.user_id) LEFT JOIN comment c 
-            ON p.post_id = c.post_id
-    WHERE u.user_id = %s
-    GROUP BY u.user_id, a.username;
-    """
-    cur.execute(info_sql, (target_user_id,))
-    user_info = cur.fetchone()
+    user_info = load_profile(cur, target_user_id, with_claims=False)
+
+    cur.close()
+    conn.close()
 
     if not user_info:
         flash('找不到該使用者！')
         return redirect(url_for('index'))
 
-    post_sql = """
-    SELECT p.post_id,  p.description, p.post_time, p.available,
-           (SELECT COUNT(*) FROM item i WHERE i.post_id = p.post_id) as item_count
-    FROM post p
-    WHERE p.user_id = %s
-    ORDER BY p.post_time DESC
-    """
-    cur.execute(post_sql, (target_user_id,))
-    public_posts = cur.fetchall()
-
-    comments_sql = """
-    SELECT c.comment_str, c.rating, c.comment_time, p.description
-    FROM (comment c LEFT JOIN post p
-            ON c.post_id = p.post_id)
-    WHERE p.user_id = %s
-    ORDER BY c.comment_time DESC
-    """
-    cur.execute(comments_sql, (target_user_id,))
-    past_comments = cur.fetchall()
-
-    phone_sql = """
-    SELECT phone_number
-    FROM phone
-    WHERE user_id = %s
-    """
-    cur.execute(phone_sql, (target_user_id,))
-    phone = cur.fetchall()
+    public_posts, posts_first, posts_next = profile_list(user_info['posts'], 'posts', 'public_profile',
+                                                         target_user_id=target_user_id)
+    past_comments, comments_first, comments_next = profile_list(user_info['comments'], 'comments', 'public_profile',
+                                                                target_user_id=target_user_id)
 
-    cur.close()
-    conn.close()
-
-    return render_template('public_profile.html', user=user_info, posts=public_posts, comments=past_comments, phones=phone)
+    return render_template('public_profile.html', user=user_info, posts=public_posts, comments=past_comments, phones=user_info['phones'] or [],
+                           comments_first=comments_first, comments_next=comments_next,
+                           posts_first=posts_first, posts_next=posts_next)
 
 @app.route('/add_phone', methods=['GET', 'POST'])
 def add_phone():
@@ -763,6 +1730,65 @@ def add_phone():
 
 from datetime import datetime, timedelta # 記得在檔案最上面 import
 
+SAVED_LOCATIONS_SIZE = int(os.getenv("SAVED_LOCATIONS_SIZE", 10))   # 刊登頁「之前用過的地點」最多列幾個
+
+def saved_locations(cur, user_id):
+    # 這個人之前刊登用過的地點，最近用的排前面（一樣的地址只有一筆 location，所以不會重複）
+    cur.execute("""
+        SELECT l.location_id, l.location_name, l.city, l.district, l.street, l.number, l.lat, l.lon
+        FROM (
+            SELECT i.location_id, MAX(p.post_time) AS last_used
+            FROM post p
+            JOIN item i ON i.post_id = p.post_id
+            WHERE p.user_id = %s
+            GROUP BY i.location_id
+            ORDER BY last_used DESC
+            LIMIT %s
+        ) u
+        JOIN location l ON l.location_id = u.location_id
+        ORDER BY u.last_used DESC
+    """, (user_id, SAVED_LOCATIONS_SIZE))
+    return cur.fetchall()
+
+def insert_post_items(cur, user_id, description, items):
+    # 開一篇貼文，把 items 全部放進去；items 是 [(category_id, item_name, expiration_date, quantity, 地點)]
+    # 地點是 (location_name, city, district, street, number, lat, lon)，沒有座標的 lat / lon 是 None
+    # 地點跟物品各用一條多列 INSERT，item 上的 statement-level trigger（庫存計數）也只跑一次
+    cur.execute("""
+        INSERT INTO post (user_id, description)
+        VALUES (%s, %s) RETURNING post_id
+    """, (user_id, description))
+    post_id = cur.fetchone()[0]
+
+    # 地址一樣的（address_key，migrations/013）不會再新增，直接用已經有的那一筆；之前沒座標、這次有填的順便補上
+    # 這次裡面正規化之後一樣的地址只能 INSERT 一次（不然 ON CONFLICT 會改到同一列兩次），所以先 DISTINCT ON
+    # 新增的跟已經有的都從 RETURNING 拿 location_id，再照原本的地點對回去
+    places = list(dict.fromkeys(item[4] for item in items))
+    rows = psycopg2.extras.execute_values(cur, """
+        WITH v (location_name, city, district, street, number, lat, lon) AS (VALUES %s),
+        saved AS (
+            INSERT INTO location AS l (location_name, city, district, street, number, lat, lon)
+            SELECT DISTINCT ON (normalize_address(location_name, city, district, street, number)) *
+            FROM v
+            ORDER BY normalize_address(location_name, city, district, street, number), lat IS NULL
+            ON CONFLICT (address_key) DO UPDATE
+            SET lat = COALESCE(l.lat, EXCLUDED.lat), lon = COALESCE(l.lon, EXCLUDED.lon)
+            RETURNING location_id, address_key
+        )
+        SELECT v.*, saved.location_id
+        FROM v
+        JOIN saved ON saved.address_key = normalize_address(v.location_name, v.city, v.district, v.street, v.number)
+    """, places, template='(%s, %s, %s, %s, %s, %s::float8, %s::float8)', page_size=len(places), fetch=True)
+    location_ids = {tuple(row[:-1]): row[-1] for row in rows}
+
+    psycopg2.extras.execute_values(cur, """
+        INSERT INTO item
+        (category_id, post_id, location_id, item_name, expiration_date, quantity)
+        VALUES %s
+    """, [(cat, post_id, location_ids[place], name, expiration, qty) for cat, name, expiration, qty, place in items],
+        page_size=BULK_PAGE_SIZE)
+    return post_id
+
 @app.route('/post_item', methods=['GET', 'POST'])
 def post_item():
     if 'user_id' not in session:
@@ -787,35 +1813,26 @@ def post_item():
         quantities = request.form.getlist('quantity')
         category_ids = request.form.getlist('category_id')
 
-        if not description or not item_names:
-            flash('請填寫完整資訊！')
+        try:
+            coordinates = geo.parse_coordinates(request.form.get('lat'), request.form.get('lon')) or (None, None)
+        except ValueError as e:
+            flash(f'座標有問題：{e}')
             return redirect(url_for('post_item'))
 
-        try:
-            cur.execute("""
-                INSERT INTO post (user_id, description)
-                VALUES (%s, %s) RETURNING post_id
-            """, (session['user_id'], description))
-            new_post_id = cur.fetchone()[0]
-
-            cur.execute("""
-                INSERT INTO location (location_name, city, district, street, number)
-                VALUES (%s, %s, %s, %s, %s) RETURNING location_id
-            """, (location_name, city, district, street, number))
-            new_location_id = cur.fetchone()[0]
-
-            for i_name, i_qty, i_cat in zip(item_names, quantities, category_ids):
-                if not i_name.strip(): 
-                    continue
+        place = (location_name, city, district, street, number) + coordinates
+        items = [(i_cat, i_name, expiration_date, i_qty, place)
+                 for i_name, i_qty, i_cat in zip(item_names, quantities, category_ids)
+                 if i_name.strip()]
 
-                cur.execute("""
-                    INSERT INTO item 
-                    (category_id, post_id, location_id, item_name, expiration_date, quantity)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                """, (i_cat, new_post_id, new_location_id, i_name, expiration_date, i_qty))
+        if not description or not items:
+            flash('請填寫完整資訊！')
+            return redirect(url_for('post_item'))
 
+        try:
+            insert_post_items(cur, session['user_id'], description, items)
             conn.commit()
-            flash(f'成功刊登貼文！包含了 {len(item_names)} 樣物品。')
+            catalog_changed()
+            flash(f'成功刊登貼文！包含了 {len(items)} 樣物品。')
             return redirect(url_for('index'))
 
         except Exception as e:
@@ -826,12 +1843,95 @@ def post_item():
             cur.close()
             conn.close()
 
-    cur.execute("SELECT * FROM categories ORDER BY category_id ASC")
-    categories = cur.fetchall()
+    categories = load_categories(cur)
+    locations = saved_locations(cur, session['user_id'])
     cur.close()
     conn.close()
 
-    return render_template('post_item.html', categories=categories)
+    return render_template('post_item.html', categories=categories, saved_locations=locations)
+
+@app.route('/post_item/bulk', methods=['GET', 'POST'])
+def post_item_bulk():
+    # 一次上傳一整批物品（實驗室清倉之類的）：CSV / JSON 檔，或是直接 POST JSON
+    # 先每一列都檢查過，有任何一列有問題就全部不刊登，把每一列的錯誤列出來
+    # JSON：{"description": "...", "location_name": "...", "items": [{"name": ..., "category": ..., "quantity": ...}]}
+    as_json = request.is_json
+
+    if 'user_id' not in session:
+        if as_json:
+            return jsonify({'ok': False, 'error': '請先登入！'}), 401
+        return redirect(url_for('login'))
+
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    # 連線只在最後的 finally 關，render() 跟各個 return 都不用管
+    try:
+        categories = load_categories(cur)
+
+        def render(errors=(), error=None, code=200):
+            if as_json:
+                return jsonify({'ok': False, 'error': error,
+                                'errors': [{'line': line, 'message': msg} for line, msg in errors]}), code
+            return render_template('post_item_bulk.html', categories=categories, errors=errors, error=error,
+                                   form=request.form, max_items=MAX_BULK_ITEMS), code
+
+        if request.method == 'GET':
+            return render()
+
+        form = request.get_json(silent=True) if as_json else request.form
+        if as_json and not isinstance(form, dict):
+            return render(error='JSON 要是 {"description": ..., "items": [...]}', code=400)
+        description = (form.get('description') or '').strip()
+        defaults = {
+            'category': form.get('category_id'),
+            'expiration': form.get('expiration_date') or datetime.now() + timedelta(days=7),
+            'location': form.get('location_name'),
+            'city': form.get('city') or '新竹市',
+            'district': form.get('district') or '東區',
+            'street': form.get('street') or '大學路',
+            'number': form.get('number') or '1001號',
+            'lat': form.get('lat'),
+            'lon': form.get('lon'),
+        }
+
+        try:
+            if as_json:
+                rows = bulk_items.rows_from_json(form, MAX_BULK_ITEMS)
+            else:
+                upload = request.files.get('file')
+                if upload is None or not upload.filename:
+                    return render(error='請選擇要上傳的檔案！', code=400)
+                data = upload.read(BULK_MAX_BYTES + 1)
+                if len(data) > BULK_MAX_BYTES:
+                    return render(error=f'檔案太大了，最多 {BULK_MAX_BYTES // 1024} KB', code=400)
+                rows = bulk_items.read_rows(data, upload.filename, MAX_BULK_ITEMS)
+        except bulk_items.BulkError as e:
+            return render(error=str(e), code=400)
+
+        if not description:
+            return render(error='請填寫貼文描述！', code=400)
+        if not rows:
+            return render(error='檔案裡沒有任何物品！', code=400)
+
+        items, errors = bulk_items.validate(rows, categories, defaults)
+        if errors:
+            return render(errors=errors, error=f'有 {len(errors)} 列有問題，這次全部都沒有刊登', code=400)
+
+        try:
+            post_id = insert_post_items(cur, session['user_id'], description, items)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            return render(error=f'刊登失敗: {e}', code=500)
+
+        catalog_changed()
+        if as_json:
+            return jsonify({'ok': True, 'post_id': post_id, 'items': len(items)})
+        flash(f'成功刊登貼文！包含了 {len(items)} 樣物品。')
+        return redirect(url_for('index'))
+    finally:
+        cur.close()
+        conn.close()
 
 # 啟動伺服器
 if __name__ == '__main__':
@@ -0,0 +1,113 @@
+import threading
+import time
+
+
+class BatchWorker:
+    # 背景 thread 每 interval 秒做一輪 run_batches()：一批一批呼叫資料庫的 function，每批各自 commit，
+    # 鎖不會一次抓太多；做滿一批就馬上接著做下一批，做完或被 stop() 才停
+    # 子類別只要寫 _batch(cur, progress)：做一批，回傳 (這批做了幾筆, 還要不要接著做)
+    #
+    # connect() 要回傳一條可以 close() 的連線，app.py 傳 db_pool.connection
+    # on_done(n) 在這一輪有做到東西的時候呼叫（app.py 用來清首頁快取）
+    thread_name = 'batch-worker'
+    count_name = 'processed'   # stats() 裡總共做了幾筆的 key
+
+    def __init__(self, connect, interval, batch_size, on_done=None):
+        self.connect = connect
+        self.interval = interval
+        self.batch_size = batch_size
+        self.on_done = on_done
+
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._runs = 0
+        self._batches = 0
+        self._count = 0
+        self._failures = 0
+        self._last_error = None
+        self._last_run_at = None
+        self._last_run_ms = None
+
+    @property
+    def started(self):
+        return self._thread is not None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def wake(self):
+        # 不用等到下一輪，馬上做一次
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_batches()
+            except Exception as e:
+                with self._lock:
+                    self._failures += 1
+                    self._last_error = str(e).strip()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def _batch(self, cur, progress):
+        raise NotImplementedError
+
+    def run_batches(self, max_batches=None, progress=None):
+        # 做到沒有東西為止（或做了 max_batches 批），回傳這一輪總共做了幾筆
+        with self._run_lock:
+            start = time.perf_counter()
+            total = batches = 0
+            conn = self.connect()
+            try:
+                cur = conn.cursor()
+                while not self._stop.is_set() and (max_batches is None or batches < max_batches):
+                    n, more = self._batch(cur, progress)
+                    conn.commit()
+                    total += n
+                    batches += 1
+                    if not more:
+                        break
+                cur.close()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+                with self._lock:
+                    self._runs += 1
+                    self._batches += batches
+                    self._count += total
+                    self._last_run_at = time.time()
+                    self._last_run_ms = round((time.perf_counter() - start) * 1000, 1)
+
+            if total and self.on_done is not None:
+                self.on_done(total)
+            return total
+
+    def stats(self):
+        with self._lock:
+            return {
+                'started': self.started,
+                'interval': self.interval,
+                'batch_size': self.batch_size,
+                'runs': self._runs,
+                'batches': self._batches,
+                self.count_name: self._count,
+                'failures': self._failures,
+                'last_error': self._last_error,
+                'last_run_at': self._last_run_at,
+                'last_run_ms': self._last_run_ms,
+            }
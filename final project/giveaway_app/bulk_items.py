@@ -0,0 +1,171 @@
+import csv
+import io
+import json
+from datetime import datetime
+
+import geo
+
+# 一次上傳一整批物品（CSV 或 JSON），這裡只負責讀檔跟檢查，寫進資料庫在 app.py 的 insert_post_items()
+#
+# CSV 第一列是欄位名稱，英文或中文都可以：
+#   name,category,quantity,expiration,location
+#   螺絲起子,工具,3,2025-07-01,工程三館
+# JSON 是一個 list（或是 {"items": [...]}），每個物品用一樣的欄位名稱
+#
+# 分類可以寫 category_id 或分類名稱；分類、期限、地點空白就用表單上填的
+# 地點還可以另外給 city / district / street / number，沒給也是用預設值
+# 座標 lat / lon 跟著地點走：這一列自己填了地點，就只看這一列的座標，不會套用表單上的
+
+FIELD_ALIASES = {
+    'name': 'name', 'item_name': 'name', '名稱': 'name', '物品名稱': 'name',
+    'category': 'category', 'category_id': 'category', '分類': 'category',
+    'quantity': 'quantity', '數量': 'quantity',
+    'expiration': 'expiration', 'expiration_date': 'expiration', '期限': 'expiration', '過期時間': 'expiration',
+    'location': 'location', 'location_name': 'location', '地點': 'location', '面交地點': 'location',
+    'city': 'city', '城市': 'city',
+    'district': 'district', '區': 'district',
+    'street': 'street', '街道': 'street',
+    'number': 'number', '門牌': 'number',
+    'lat': 'lat', 'latitude': 'lat', '緯度': 'lat',
+    'lon': 'lon', 'lng': 'lon', 'longitude': 'lon', '經度': 'lon',
+}
+
+# 跟 schema.sql 的 location 欄位長度一樣
+LOCATION_LIMITS = (('location', 50), ('city', 50), ('district', 50), ('street', 100), ('number', 20))
+
+DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M:%S', '%Y/%m/%d', '%Y/%m/%d %H:%M')
+
+MAX_QUANTITY = 100000
+
+
+class BulkError(Exception):
+    # 整個檔案讀不了（格式錯、太多筆...），不是某一列的問題
+    pass
+
+
+def _decode(data):
+    # Excel 存的 CSV 常常有 BOM，或是 Big5 (cp950)
+    for encoding in ('utf-8-sig', 'cp950'):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    raise BulkError('檔案編碼看不懂，請存成 UTF-8 的 CSV')
+
+
+def _normalize(raw):
+    row = {}
+    for key, value in raw.items():
+        field = FIELD_ALIASES.get(str(key or '').strip().lower())
+        if field is not None:
+            row[field] = '' if value is None else str(value).strip()
+    return row
+
+
+def read_rows(data, filename='', max_rows=1000):
+    # 回傳 [(第幾列, {欄位: 值})]；CSV 的列號跟試算表上看到的一樣（標題是第 1 列）
+    text = _decode(data)
+    is_json = filename.lower().endswith('.json') or text.lstrip().startswith(('[', '{'))
+    if is_json:
+        try:
+            payload = json.loads(text)
+        except ValueError as e:
+            raise BulkError(f'JSON 格式錯誤：{e}')
+        return rows_from_json(payload, max_rows)
+
+    reader = csv.DictReader(io.StringIO(text))
+    if not reader.fieldnames or 'name' not in {FIELD_ALIASES.get(f.strip().lower()) for f in reader.fieldnames if f}:
+        raise BulkError('CSV 第一列要是欄位名稱，至少要有 name（物品名稱）')
+    rows = []
+    for raw in reader:
+        if not any((v or '').strip() for v in raw.values() if isinstance(v, str)):
+            continue   # 空白列
+        rows.append((reader.line_num, _normalize(raw)))
+        if len(rows) > max_rows:
+            raise BulkError(f'一次最多 {max_rows} 樣物品')
+    return rows
+
+
+def rows_from_json(payload, max_rows=1000):
+    if isinstance(payload, dict):
+        payload = payload.get('items')
+    if not isinstance(payload, list):
+        raise BulkError('JSON 要是一個物品的 list，或是 {"items": [...]}')
+    if len(payload) > max_rows:
+        raise BulkError(f'一次最多 {max_rows} 樣物品')
+    rows = []
+    for k, raw in enumerate(payload, start=1):
+        rows.append((k, _normalize(raw) if isinstance(raw, dict) else None))
+    return rows
+
+
+def parse_date(value):
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def validate(rows, categories, defaults, now=None):
+    # categories：load_categories() 的結果；defaults：表單上填的 category / expiration / location / city / district / street / number / lat / lon
+    # 回傳 (items, errors)，items 是 insert_post_items() 要的格式，errors 是 [(第幾列, 訊息)]
+    now = now or datetime.now()
+    by_id = {str(c['category_id']): c['category_id'] for c in categories}
+    by_name = {c['name'].strip().lower(): c['category_id'] for c in categories}
+
+    items, errors = [], []
+    for line, row in rows:
+        if row is None:
+            errors.append((line, '每一筆要是一個物件'))
+            continue
+        problems = []
+
+        name = row.get('name', '')
+        if not name:
+            problems.append('沒有物品名稱')
+
+        category = row.get('category') or str(defaults.get('category') or '')
+        category_id = by_id.get(category) or by_name.get(category.lower())
+        if category_id is None:
+            problems.append(f'找不到分類「{category}」' if category else '沒有分類')
+
+        quantity = row.get('quantity') or '1'
+        try:
+            quantity = int(quantity)
+            if not 1 <= quantity <= MAX_QUANTITY:
+                problems.append(f'數量要在 1 到 {MAX_QUANTITY} 之間')
+        except ValueError:
+            problems.append(f'數量「{quantity}」不是整數')
+
+        expiration = row.get('expiration') or defaults.get('expiration')
+        if isinstance(expiration, str):
+            parsed = parse_date(expiration)
+            if parsed is None:
+                problems.append(f'看不懂期限「{expiration}」，請用 2025-07-01 或 2025-07-01 18:00')
+            expiration = parsed
+        if expiration is not None and expiration <= now:
+            problems.append('期限已經過了')
+
+        location = []
+        for field, limit in LOCATION_LIMITS:
+            value = row.get(field) or defaults.get(field) or ''
+            if not value:
+                problems.append('沒有面交地點' if field == 'location' else f'沒有 {field}')
+            elif len(value) > limit:
+                problems.append(f'{field} 最多 {limit} 個字')
+            location.append(value)
+
+        coordinate_source = row if row.get('location') else {'lat': row.get('lat') or defaults.get('lat'),
+                                                               'lon': row.get('lon') or defaults.get('lon')}
+        try:
+            location.extend(geo.parse_coordinates(coordinate_source.get('lat'), coordinate_source.get('lon')) or (None, None))
+        except ValueError as e:
+            problems.append(str(e))
+
+        if problems:
+            errors.append((line, '、'.join(problems)))
+        else:
+            items.append((category_id, name, expiration, quantity, tuple(location)))
+    return items, errors
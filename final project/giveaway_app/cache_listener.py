@@ -0,0 +1,104 @@
+import select
+import threading
+import time
+
+import psycopg2
+
+
+class CacheInvalidationListener:
+    # 背景 thread 開一條自己的連線 LISTEN，收到 schema.sql 裡 trigger 發的 NOTIFY 就呼叫 on_change(表格名稱)
+    # 好幾個 worker 一起跑的時候，別的 worker 改了資料，這邊的快取才會跟著作廢
+    # 連線斷掉會自己重連（等待時間 1, 2, 4... 秒，最多 max_backoff 秒）；
+    # 斷線期間的通知一定收不到，所以斷線跟重連成功的時候都會呼叫 on_reset() 把快取全部清掉
+    def __init__(self, channel, on_change, on_reset, poll_interval=5, max_backoff=30, **connect_kwargs):
+        self.channel = channel
+        self.on_change = on_change
+        self.on_reset = on_reset
+        self.poll_interval = poll_interval   # 這麼久沒收到東西就 SELECT 1 確認連線還活著
+        self.max_backoff = max_backoff
+        self.connect_kwargs = connect_kwargs
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._conn = None
+        self.connected = False
+        self._received = 0
+        self._reconnects = 0
+        self._last_error = None
+        self._last_message_at = None
+
+    @property
+    def started(self):
+        return self._thread is not None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='cache-listener', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.poll_interval + 1)
+
+    def _run(self):
+        backoff = 1
+        while not self._stop.is_set():
+            try:
+                self._listen()
+                backoff = 1
+            except (psycopg2.Error, OSError) as e:
+                self._last_error = str(e).strip()
+            finally:
+                self._disconnect()
+            if self._stop.is_set():
+                break
+            self._reconnects += 1
+            self._stop.wait(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def _listen(self):
+        self._conn = psycopg2.connect(**self.connect_kwargs)
+        self._conn.autocommit = True
+        cur = self._conn.cursor()
+        cur.execute(f'LISTEN "{self.channel}"')
+        self.connected = True
+        self.on_reset()   # 連上之前發生的事都不知道，全部重來
+
+        while not self._stop.is_set():
+            if select.select([self._conn], [], [], self.poll_interval) == ([], [], []):
+                cur.execute('SELECT 1')
+                continue
+            self._conn.poll()
+            tables = set()
+            while self._conn.notifies:
+                tables.add(self._conn.notifies.pop(0).payload)
+            if tables:
+                self._received += len(tables)
+                self._last_message_at = time.time()
+                for table in tables:
+                    self.on_change(table)
+
+    def _disconnect(self):
+        was_connected, self.connected = self.connected, False
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except psycopg2.Error:
+                pass
+            self._conn = None
+        if was_connected:
+            self.on_reset()
+
+    def stats(self):
+        return {
+            'started': self.started,
+            'connected': self.connected,
+            'channel': self.channel,
+            'received': self._received,
+            'reconnects': self._reconnects,
+            'last_error': self._last_error,
+            'last_message_at': self._last_message_at,
+        }
@@ -0,0 +1,191 @@
+import threading
+import time
+from collections import deque
+
+import psycopg2
+
+
+class PoolTimeout(Exception):
+    # 等了 wait_timeout 秒還是拿不到連線
+    pass
+
+
+class _PooledConn:
+    # 包一層 psycopg2 的 connection，route 裡原本的 conn.close() 會變成「還給 pool」
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def raw(self):
+        return self._raw
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._pool.putconn(self._raw)
+
+
+class ConnectionPool:
+    def __init__(self, minconn=1, maxconn=10, idle_timeout=300, wait_timeout=5,
+                 health_check_after=30, **connect_kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError('連線池大小設定錯誤')
+
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.idle_timeout = idle_timeout              # 閒置超過這麼久（秒）的多餘連線會被關掉
+        self.wait_timeout = wait_timeout              # 池子滿了最多等幾秒
+        self.health_check_after = health_check_after  # 閒置超過這麼久，借出前先 SELECT 1 檢查
+        self.connect_kwargs = connect_kwargs
+
+        self._cond = threading.Condition()
+        self._idle = deque()   # (connection, 放回來的時間)
+        self._in_use = 0
+        self._waiting = 0
+        self._created = 0
+        self._recycled = 0
+        self._timeouts = 0
+        self._closed = False
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.connect_kwargs)
+        with self._cond:
+            self._created += 1
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn, idle_for):
+        if conn.closed:
+            return False
+        if idle_for < self.health_check_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn(self):
+        deadline = time.monotonic() + self.wait_timeout
+
+        with self._cond:
+            if self._closed:
+                raise PoolTimeout('連線池已關閉')
+
+            while True:
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    self._in_use += 1
+                    break
+
+                if self._in_use + len(self._idle) < self.maxconn:
+                    # 先佔位，真正連線在鎖外面做，避免擋住其他 thread
+                    conn, returned_at = None, None
+                    self._in_use += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(f'{self.wait_timeout} 秒內拿不到資料庫連線')
+
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+        try:
+            if conn is not None and not self._is_healthy(conn, time.monotonic() - returned_at):
+                self._discard(conn)
+                with self._cond:
+                    self._recycled += 1
+                conn = None
+
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        return conn
+
+    def putconn(self, conn):
+        # 沒 commit 的東西一律丟掉，下一個借到的人拿到的是乾淨的連線
+        broken = conn.closed
+        if not broken:
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+
+        with self._cond:
+            self._in_use -= 1
+
+            if broken or self._closed:
+                self._recycled += 1
+                self._cond.notify()
+                discard = [conn]
+            else:
+                now = time.monotonic()
+                self._idle.append((conn, now))
+                discard = self._reap_idle(now)
+                self._cond.notify()
+
+        for c in discard:
+            self._discard(c)
+
+    def _reap_idle(self, now):
+        # 只保留 minconn 條，剩下閒太久的收掉（最舊的在左邊）
+        discard = []
+        while (len(self._idle) + self._in_use > self.minconn
+               and self._idle and now - self._idle[0][1] > self.idle_timeout):
+            discard.append(self._idle.popleft()[0])
+        return discard
+
+    def connection(self):
+        # 給 request 以外的地方用：with db_pool.connection() as conn: ...
+        return _PooledConn(self, self.getconn())
+
+    def stats(self):
+        with self._cond:
+            return {
+                'min_size': self.minconn,
+                'max_size': self.maxconn,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+                'created': self._created,
+                'recycled': self._recycled,
+                'timeouts': self._timeouts,
+            }
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle = [c for c, _ in self._idle]
+            self._idle.clear()
+            self._cond.notify_all()
+        for c in idle:
+            self._discard(c)
@@ -0,0 +1,21 @@
+from batch_worker import BatchWorker
+
+
+class ExpirySweeper(BatchWorker):
+    # 背景定時呼叫資料庫的 expire_items()，把過期還有庫存的物品標成 expired（migrations/009）
+    # 一批最多標 batch_size 筆；好幾個 worker 都開著也沒關係，expire_items() 用 SKIP LOCKED，不會標到同一筆
+    # on_expired(n) 在有標到東西的時候呼叫
+    thread_name = 'expiry-sweeper'
+    count_name = 'expired'
+
+    def __init__(self, connect, interval=60, batch_size=500, on_expired=None):
+        super().__init__(connect, interval, batch_size, on_done=on_expired)
+
+    def _batch(self, cur, progress):
+        cur.execute("SELECT expire_items(%s)", (self.batch_size,))
+        n = cur.fetchone()[0]
+        return n, n >= self.batch_size
+
+    def sweep(self, max_batches=None):
+        # 標到沒有過期的為止（或標了 max_batches 批），回傳這次總共標了幾筆
+        return self.run_batches(max_batches)
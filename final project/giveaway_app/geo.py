@@ -0,0 +1,30 @@
+# 經緯度的小工具：刊登時的地點座標、首頁找附近的物品都用這裡檢查
+# 距離跟格子在資料庫算（migrations/012 的 geo_distance_km / geo_cell_ranges），這裡只管使用者填的值
+
+
+def parse_coordinates(lat, lon):
+    # 兩個都沒填回傳 None；只填一個、不是數字、超出範圍就 raise ValueError（訊息可以直接給使用者看）
+    lat = '' if lat is None else str(lat).strip()
+    lon = '' if lon is None else str(lon).strip()
+    if not lat and not lon:
+        return None
+    if not lat or not lon:
+        raise ValueError('緯度跟經度要一起填')
+    try:
+        lat, lon = float(lat), float(lon)
+    except ValueError:
+        raise ValueError('緯度、經度要是數字，例如 24.7869, 120.9968') from None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError('緯度要在 -90 到 90 之間，經度要在 -180 到 180 之間')
+    return round(lat, 6), round(lon, 6)
+
+
+def parse_radius(value, default, maximum):
+    # 半徑（公里），看不懂就用預設值，太大就用上限
+    try:
+        radius = float(value)
+    except (TypeError, ValueError):
+        return default
+    if radius != radius or radius <= 0:
+        return default
+    return min(radius, maximum)
@@ -0,0 +1,143 @@
+import atexit
+import threading
+import time
+
+import psycopg2
+import psycopg2.extras
+
+
+class LastLoginBuffer:
+    # 登入成功只是記一下「誰、幾點」到記憶體，背景 thread 每 interval 秒把累積的一次寫進 account.lastlogin
+    # 登入的 request 就不用自己開交易、等 commit
+    #
+    # 同一個人登入好幾次只留最後一次；最多記 max_pending 個人，滿了先叫背景 thread 馬上寫，
+    # 寫不進去（資料庫掛了）還是滿的，新的人就不記（lastlogin 差幾秒沒關係，不要讓記憶體一直長）
+    # 寫失敗的會放回去下次再試；程式結束時 (atexit) 會再寫一次
+    #
+    # 每次寫入用 connect() 借一條連線、寫完 close() 還回去（app.py 傳的是 db_pool.connection）
+    FLUSH_SQL = """
+        UPDATE account a
+        SET lastlogin = v.ts
+        FROM (VALUES %s) AS v(user_id, ts)
+        WHERE a.user_id = v.user_id
+          AND (a.lastlogin IS NULL OR a.lastlogin < v.ts)
+    """
+    # 用 epoch 秒傳進去，跟原本的 NOW() 一樣照資料庫的時區轉成 timestamp
+    TEMPLATE = '(%s, to_timestamp(%s)::timestamp)'
+
+    def __init__(self, connect, interval=5, max_pending=10000, batch_size=1000):
+        self.connect = connect
+        self.interval = interval
+        self.max_pending = max_pending
+        self.batch_size = batch_size   # 一條 UPDATE 最多幾個人
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._recorded = 0
+        self._written = 0
+        self._flushes = 0
+        self._dropped = 0
+        self._failures = 0
+        self._last_error = None
+        self._last_flush_ms = None
+
+    @property
+    def started(self):
+        return self._thread is not None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='lastlogin-flush', daemon=True)
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(self.interval + 5)
+        self.flush()
+
+    def record(self, user_id, when=None):
+        when = time.time() if when is None else when
+        with self._lock:
+            if user_id not in self._pending and len(self._pending) >= self.max_pending:
+                self._dropped += 1
+                self._wake.set()
+                return False
+            if self._pending.get(user_id, 0) < when:
+                self._pending[user_id] = when
+            self._recorded += 1
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self._wake.set()
+        self.start()
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            self.flush()
+
+    def flush(self):
+        # 回傳這次寫了幾個人；寫失敗的放回去，除非這段時間又有新的登入時間
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+
+            rows = list(batch.items())
+            start = time.perf_counter()
+            try:
+                conn = self.connect()
+                try:
+                    cur = conn.cursor()
+                    for k in range(0, len(rows), self.batch_size):
+                        psycopg2.extras.execute_values(cur, self.FLUSH_SQL, rows[k:k + self.batch_size],
+                                                       template=self.TEMPLATE, page_size=self.batch_size)
+                    conn.commit()
+                    cur.close()
+                except Exception:
+                    conn.rollback()
+                    raise
+                finally:
+                    conn.close()
+            except Exception as e:
+                with self._lock:
+                    self._failures += 1
+                    self._last_error = str(e).strip()
+                    for user_id, when in rows:
+                        if self._pending.get(user_id, 0) < when:
+                            self._pending[user_id] = when
+                return 0
+
+            with self._lock:
+                self._written += len(rows)
+                self._flushes += 1
+                self._last_flush_ms = round((time.perf_counter() - start) * 1000, 1)
+            return len(rows)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'started': self.started,
+                'interval': self.interval,
+                'pending': len(self._pending),
+                'max_pending': self.max_pending,
+                'recorded': self._recorded,
+                'written': self._written,
+                'flushes': self._flushes,
+                'dropped': self._dropped,
+                'failures': self._failures,
+                'last_error': self._last_error,
+                'last_flush_ms': self._last_flush_ms,
+            }
@@ -0,0 +1,118 @@
+import base64
+import json
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+
+# keyset (cursor) 分頁用的小工具
+# sort_keys 長這樣：[('i.quantity', 'DESC'), ('i.post_id', 'DESC'), ('i.item_id', 'ASC')]
+# cursor 就是某一列在這些欄位上的值，編碼成網址可以放的字串
+
+def encode_cursor(values):
+    raw = json.dumps(list(values), default=str, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def _cursor_value(value, kind):
+    # 檢查 cursor 裡的一個值是不是該有的型別，不是就 raise ValueError
+    # 'int'：id、數量；'number'：相關度、距離；'timestamp'：encode_cursor 存成字串的時間，轉回 datetime
+    if kind == 'timestamp':
+        if not isinstance(value, str):
+            raise ValueError(value)
+        return datetime.fromisoformat(value)
+    if kind == 'number' and isinstance(value, str):
+        # numeric 的欄位（搜尋的相關度）encode_cursor 存成字串
+        try:
+            value = Decimal(value)
+        except InvalidOperation:
+            raise ValueError(value) from None
+        if not value.is_finite():
+            raise ValueError(value)
+        return value
+    if isinstance(value, bool) or not isinstance(value, (int, float) if kind == 'number' else int):
+        raise ValueError(value)
+    if isinstance(value, int) and not -2 ** 63 <= value < 2 ** 63:
+        raise ValueError(value)
+    return value
+
+
+def decode_cursor(token, size, types=None):
+    # 壞掉或長度不對的 cursor 一律當作沒給，從第一頁開始
+    # 有給 types（每個排序欄位一個 'int' / 'number' / 'timestamp'）的話，型別不對的也當作沒給，
+    # 被改過的網址不會送到 SQL 才出錯
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    if types is not None:
+        try:
+            values = [_cursor_value(v, kind) for v, kind in zip(values, types)]
+        except ValueError:
+            return None
+    return values
+
+
+def _flip(direction):
+    return 'ASC' if direction == 'DESC' else 'DESC'
+
+
+def order_by_sql(sort_keys, backward=False):
+    return ', '.join(f'{expr} {_flip(d) if backward else d}' for expr, d in sort_keys)
+
+
+def _compare(exprs, op):
+    if len(exprs) == 1:
+        return f'{exprs[0]} {op} %s'
+    return f"({', '.join(exprs)}) {op} ({', '.join(['%s'] * len(exprs))})"
+
+
+def keyset_condition(sort_keys, values, backward=False):
+    # 產生「排在 cursor 後面（backward 就是前面）」的 WHERE 條件
+    # 同方向的欄位合成 row comparison，第一組另外加一個 <= / >= 讓 index 可以直接用
+    groups = []
+    for (expr, direction), value in zip(sort_keys, values):
+        if backward:
+            direction = _flip(direction)
+        if groups and groups[-1][0] == direction:
+            groups[-1][1].append(expr)
+            groups[-1][2].append(value)
+        else:
+            groups.append((direction, [expr], [value]))
+
+    terms, params = [], []
+    for n, (direction, exprs, vals) in enumerate(groups):
+        parts = []
+        for _, prev_exprs, prev_vals in groups[:n]:
+            parts.append(_compare(prev_exprs, '='))
+            params.extend(prev_vals)
+        parts.append(_compare(exprs, '>' if direction == 'ASC' else '<'))
+        params.extend(vals)
+        terms.append('(' + ' AND '.join(parts) + ')')
+
+    if len(groups) == 1:
+        direction, exprs, vals = groups[0]
+        if len(exprs) == 1:
+            return terms[0], params
+        # 只有一組也是 row comparison，另外加第一欄自己的 <= / >=：
+        # 照時間分區的 trade / comment 要看得到單獨的時間條件，才會跳過不用看的月份
+        lead = _compare(exprs[:1], '>=' if direction == 'ASC' else '<=')
+        return f"({lead} AND {terms[0]})", vals[:1] + params
+
+    direction, exprs, vals = groups[0]
+    lead = _compare(exprs, '>=' if direction == 'ASC' else '<=')
+    return f"({lead} AND ({' OR '.join(terms)}))", list(vals) + params
+
+
+def paginate(rows, page_size, backward, had_cursor):
+    # 查詢時多抓一筆 (LIMIT page_size + 1) 來判斷還有沒有下一頁
+    more = len(rows) > page_size
+    rows = list(rows[:page_size])
+    if backward:
+        rows.reverse()
+        return rows, more, True
+    return rows, had_cursor, more
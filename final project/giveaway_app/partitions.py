@@ -0,0 +1,203 @@
+import csv
+import datetime
+import gzip
+import os
+import re
+import threading
+import time
+
+from psycopg2 import sql
+
+# 照時間分區的表（migrations/010），分區的名字像 trade_y2025m01
+PARTITIONED_TABLES = {'trade': 'trade_time', 'comment': 'comment_time'}
+PARTITION_NAME_RE = re.compile(r'^(trade|comment)_y(\d{4})m(\d{2})$')
+
+
+def partition_month(name):
+    # 分區名字 -> 那個月的第一天；default 分區之類的回傳 None
+    m = PARTITION_NAME_RE.match(name)
+    if m is None:
+        return None
+    return datetime.date(int(m.group(2)), int(m.group(3)), 1)
+
+
+def months_before(day, months):
+    # day 那個月往前推 months 個月的第一天
+    index = day.year * 12 + day.month - 1 - months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def _archivable(name, before):
+    # 整個月都在 before 之前的分區才封存
+    month = partition_month(name)
+    return month is not None and months_before(month, -1) <= before
+
+
+def list_partitions(conn, table):
+    # 回傳 [(分區名字, 範圍, 大約幾筆, 佔多少 bytes)]，照名字排（default 在最後）
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), c.reltuples::bigint, pg_total_relation_size(c.oid)
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+        ORDER BY c.relname LIKE '%%_default', c.relname
+    """, (table,))
+    rows = cur.fetchall()
+    cur.close()
+    return rows
+
+
+def _detached_leftovers(conn, table):
+    # 上次封存到一半（拆下來了但還沒存檔、刪掉）的表
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT c.relname FROM pg_class c
+        WHERE c.relkind = 'r' AND NOT c.relispartition
+          AND c.relnamespace = 'public'::regnamespace
+          AND c.relname LIKE %s
+        ORDER BY c.relname
+    """, (table + '\\_y%',))
+    names = [name for (name,) in cur.fetchall() if partition_month(name) is not None]
+    cur.close()
+    return names
+
+
+def _dump(conn, name, path):
+    # 整張表存成 gzip 的 CSV（第一行是欄位名稱），先寫到 .tmp，寫完、筆數對過了才改名
+    tmp = path + '.tmp'
+    cur = conn.cursor()
+    with open(tmp, 'wb') as raw:
+        with gzip.GzipFile(filename=os.path.basename(path)[:-3], mode='wb', fileobj=raw) as gz:
+            cur.copy_expert(sql.SQL("COPY {} TO STDOUT WITH (FORMAT csv, HEADER)").format(sql.Identifier(name)), gz)
+        raw.flush()
+        os.fsync(raw.fileno())
+    cur.execute(sql.SQL("SELECT COUNT(*) FROM {}").format(sql.Identifier(name)))
+    expected = cur.fetchone()[0]
+    cur.close()
+
+    # 讀回來數一下，comment 的內容可能有換行，要用 csv 讀才準
+    with gzip.open(tmp, 'rt', encoding='utf-8', newline='') as f:
+        written = sum(1 for _ in csv.reader(f)) - 1
+    if written != expected:
+        os.remove(tmp)
+        raise RuntimeError(f'{name} 存檔的筆數不對：表裡 {expected} 筆，檔案 {written} 筆')
+    os.replace(tmp, path)
+    return expected
+
+
+def archive_partitions(connect, table, before, directory):
+    # 把 before 之前的月份（整個月都在 before 之前）的分區封存：
+    #   1. detach_partition() 拆下來（comment 會先把評價加到 archived_reputation），馬上 commit，不會一直鎖著
+    #   2. 存成 directory/<分區>.csv.gz
+    #   3. DROP 掉
+    # 中間失敗的話拆下來的表會留著，下次再跑（不管 before 是多少）會接著做完
+    # connect() 要回傳一條可以 close() 的連線；回傳 [(分區, 筆數, 檔案)]
+    os.makedirs(directory, exist_ok=True)
+    done = []
+    conn = connect()
+    try:
+        cur = conn.cursor()
+        # default 分區裡舊的資料先搬到各自月份的分區，才封存得到
+        cur.execute("SELECT ensure_partitions(0)")
+        conn.commit()
+
+        for name, _, _, _ in list_partitions(conn, table):
+            if _archivable(name, before):
+                cur.execute("SELECT detach_partition(%s, %s)", (table, name))
+                conn.commit()
+
+        # 拆下來的（包括上次做到一半的）都已經不在 trade / comment 裡了，不管月份一律做完
+        for name in _detached_leftovers(conn, table):
+            path = os.path.join(directory, name + '.csv.gz')
+            n = _dump(conn, name, path)
+            conn.commit()
+            cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+            conn.commit()
+            done.append((name, n, path))
+        cur.close()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return done
+
+
+class PartitionMaintainer:
+    # 背景 thread 每 interval 秒呼叫一次 ensure_partitions()，先把之後 months_ahead 個月的分區建好
+    # 沒建到的月份資料會寫進 default 分區，查詢就沒辦法只掃那個月，這裡提早建就不會發生
+    # 好幾個 worker 都開著也沒關係，ensure_partitions() 裡面會排隊
+    #
+    # connect 是借連線的 function（app.py 傳 db_pool.connection），每次檢查借一條，用完就還
+    def __init__(self, connect, interval=3600, months_ahead=3):
+        self.connect = connect
+        self.interval = interval
+        self.months_ahead = months_ahead
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._runs = 0
+        self._created = 0
+        self._failures = 0
+        self._last_error = None
+        self._last_run_at = None
+
+    @property
+    def started(self):
+        return self._thread is not None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='partition-maintainer', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.ensure()
+            except Exception as e:
+                with self._lock:
+                    self._failures += 1
+                    self._last_error = str(e).strip()
+            self._stop.wait(self.interval)
+
+    def ensure(self):
+        # 回傳這次建了幾個分區
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT ensure_partitions(%s)", (self.months_ahead,))
+            n = cur.fetchone()[0]
+            conn.commit()
+            cur.close()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        with self._lock:
+            self._runs += 1
+            self._created += n
+            self._last_run_at = time.time()
+        return n
+
+    def stats(self):
+        with self._lock:
+            return {
+                'started': self.started,
+                'interval': self.interval,
+                'months_ahead': self.months_ahead,
+                'runs': self._runs,
+                'created': self._created,
+                'failures': self._failures,
+                'last_error': self._last_error,
+                'last_run_at': self._last_run_at,
+            }
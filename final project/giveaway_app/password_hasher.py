@@ -0,0 +1,156 @@
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+
+class HasherBusy(Exception):
+    # 排隊的人太多，或是等太久還沒算完
+    pass
+
+
+def hash_prefix(method):
+    # generate_password_hash(pwd, method) 算出來的 hash，'$' 前面會是什麼（'scrypt' -> 'scrypt:32768:8:1'）
+    # 省略的參數照 werkzeug 的預設值補上，不用真的算一次 hash；看不懂的設定直接 raise ValueError
+    name, *args = method.split(':')
+    if name == 'scrypt' and len(args) in (0, 3):
+        n, r, p = map(int, args) if args else (2 ** 15, 8, 1)
+        return f'scrypt:{n}:{r}:{p}'
+    if name == 'pbkdf2' and len(args) <= 2:
+        hash_name = args[0] if args else 'sha256'
+        iterations = int(args[1]) if len(args) == 2 else DEFAULT_PBKDF2_ITERATIONS
+        return f'pbkdf2:{hash_name}:{iterations}'
+    raise ValueError(f'不支援的密碼 hash 設定: {method}')
+
+
+def _run(fn, args):
+    # 在 worker process 裡跑，順便回傳真正算 hash 花的時間（扣掉排隊）
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+class PasswordHasher:
+    # 密碼 hash 很吃 CPU（scrypt / pbkdf2 故意算很慢），直接在 request 的 thread 上算，
+    # 一堆人同時登入的時候整個 worker 都會卡住
+    # 這裡丟到另外幾個 process 去算：最多 workers 個同時算，排隊超過 max_pending 個就直接回 HasherBusy
+    #
+    # method 跟 werkzeug 的 generate_password_hash 一樣，例如 'scrypt'、'scrypt:65536:8:1'、'pbkdf2:sha256:600000'
+    # 登入成功時用 needs_rehash() 檢查舊的 hash 是不是用現在的設定算的，不是就重算一次存回去
+    # workers=0 就在呼叫的 thread 上算（工具程式、單元測試用）
+    def __init__(self, method='scrypt', workers=2, max_pending=32, timeout=10):
+        self.method = method
+        self.prefix = hash_prefix(method)
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = 0
+        self._max_pending_seen = 0
+        self._completed = 0
+        self._rejected = 0
+        self._timeouts = 0
+        self._restarts = 0
+        self._total = deque(maxlen=1000)   # 最近 1000 次：從送出到拿到結果（含排隊）
+        self._work = deque(maxlen=1000)    # 最近 1000 次：真正算 hash 的時間
+
+    def _get_executor(self):
+        # 第一次用到才開 process；用 spawn 不用 fork，app 裡已經有別的 thread 在跑
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def _call(self, fn, *args):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._rejected += 1
+                raise HasherBusy('密碼驗證排隊的人太多')
+            self._pending += 1
+            self._max_pending_seen = max(self._max_pending_seen, self._pending)
+            executor = self._get_executor() if self.workers > 0 else None
+
+        # 排隊的名額要等 process 真的算完（或被取消）才還，不是等到呼叫的人不等了
+        # 不然一直 timeout 的話 _pending 會比實際在排的少，max_pending 就擋不住了
+        start = time.perf_counter()
+        future = None
+        try:
+            if executor is None:
+                result, work = _run(fn, args)
+            else:
+                future = executor.submit(_run, fn, args)
+                future.add_done_callback(self._release)
+                result, work = future.result(timeout=self.timeout)
+        except FutureTimeout:
+            # 還在排隊的就直接取消；已經在算的取消不了，算完才會還名額
+            future.cancel()
+            with self._lock:
+                self._timeouts += 1
+            raise HasherBusy('密碼驗證等太久了')
+        except BrokenProcessPool:
+            # worker 被砍掉（OOM 之類），下次重開一組
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+                    self._restarts += 1
+            raise HasherBusy('密碼驗證的 process 掛掉了')
+        finally:
+            if future is None:
+                self._release()
+
+        with self._lock:
+            self._completed += 1
+            self._total.append(time.perf_counter() - start)
+            self._work.append(work)
+        return result
+
+    def _release(self, future=None):
+        with self._lock:
+            self._pending -= 1
+
+    def hash(self, password):
+        return self._call(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._call(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        # hash 的格式是 '方法:參數$salt$hash'，'$' 前面跟現在的設定不一樣就要重算
+        return pwhash.split('$', 1)[0] != self.prefix
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        def ms(values, p):
+            if not values:
+                return None
+            ordered = sorted(values)
+            return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 1)
+
+        with self._lock:
+            total, work = list(self._total), list(self._work)
+            return {
+                'method': self.method,
+                'workers': self.workers,
+                'pending': self._pending,
+                'max_pending': self.max_pending,
+                'max_pending_seen': self._max_pending_seen,
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'timeouts': self._timeouts,
+                'restarts': self._restarts,
+                'latency_p50_ms': ms(total, 0.5),
+                'latency_p95_ms': ms(total, 0.95),
+                'hash_p50_ms': ms(work, 0.5),
+                'hash_p95_ms': ms(work, 0.95),
+            }
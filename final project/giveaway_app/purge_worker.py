@@ -0,0 +1,38 @@
+from batch_worker import BatchWorker
+
+
+class PurgeWorker(BatchWorker):
+    # 背景定時呼叫資料庫的 purge_step()，把刪掉的貼文、帳號底下的資料真的刪掉（migrations/014）
+    # 一批最多刪 batch_size 列；做到哪一步記在資料庫的 purge_job，當掉、重開都是從那一步接著刪
+    # 同時有好幾個 worker 的話，purge_step() 用 SKIP LOCKED 各自拿不同的 job
+    # 按刪除的 route 會呼叫 wake()，不用等到下一輪；on_purged(n) 在有刪到東西的時候呼叫（評價分數可能會變）
+    thread_name = 'purge-worker'
+    count_name = 'deleted'
+
+    def __init__(self, connect, interval=10, batch_size=500, on_purged=None):
+        super().__init__(connect, interval, batch_size, on_done=on_purged)
+        self._jobs_done = 0
+
+    def _batch(self, cur, progress):
+        cur.execute("SELECT * FROM purge_step(%s)", (self.batch_size,))
+        row = cur.fetchone()
+        if row is None:
+            return 0, False
+        job_id, kind, target_id, step, deleted, done = row
+        if done:
+            with self._lock:
+                self._jobs_done += 1
+        if progress is not None:
+            progress(job_id, kind, target_id, step, deleted, done)
+        return deleted, True
+
+    def purge(self, max_batches=None, progress=None):
+        # 刪到沒有 job 為止（或刪了 max_batches 批），回傳這次總共刪了幾列
+        # progress(job_id, kind, target_id, step, deleted, done) 每批之後呼叫（flask purge run 用來印進度）
+        return self.run_batches(max_batches, progress)
+
+    def stats(self):
+        stats = super().stats()
+        with self._lock:
+            stats['jobs_done'] = self._jobs_done
+        return stats
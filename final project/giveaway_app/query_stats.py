@@ -0,0 +1,217 @@
+import contextvars
+import logging
+import re
+import threading
+import time
+
+import psycopg2.extensions
+
+logger = logging.getLogger('giveaway.sql')
+
+# histogram 的分界（毫秒），最後一格是「比 5 秒還久」
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# 慢查詢 log 不能把使用者的資料（密碼 hash、電話、搜尋字...）印出來
+# 參數本來就不會印；execute_values 這種已經把值組進 SQL 的，字串跟數字都換成 ?
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SPACE_RE = re.compile(r'\s+')
+
+
+def redact(query, max_length=1000):
+    if isinstance(query, bytes):
+        query = query.decode(errors='replace')
+    elif not isinstance(query, str):
+        query = str(query)   # psycopg2.sql.Composed 之類的
+    query = _SPACE_RE.sub(' ', _LITERAL_RE.sub('?', query)).strip()
+    return query if len(query) <= max_length else query[:max_length] + '...'
+
+
+class _Histogram:
+    __slots__ = ('counts', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        k = 0
+        while k < len(BUCKETS_MS) and ms > BUCKETS_MS[k]:
+            k += 1
+        self.counts[k] += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def quantile(self, q):
+        # 只知道落在哪一格，回傳那一格的上限（最後一格就回最大值）
+        n = sum(self.counts)
+        if not n:
+            return None
+        seen = 0
+        for k, count in enumerate(self.counts):
+            seen += count
+            if seen >= q * n:
+                return BUCKETS_MS[k] if k < len(BUCKETS_MS) else round(self.max, 1)
+
+    def summary(self):
+        n = sum(self.counts)
+        labels = [f'<={b}' for b in BUCKETS_MS] + [f'>{BUCKETS_MS[-1]}']
+        return {
+            'avg_ms': round(self.total / n, 2) if n else None,
+            'p50_ms': self.quantile(0.5),
+            'p95_ms': self.quantile(0.95),
+            'p99_ms': self.quantile(0.99),
+            'max_ms': round(self.max, 1),
+            'buckets': [[label, c] for label, c in zip(labels, self.counts) if c],   # list 才不會被 jsonify 重新排序
+        }
+
+
+class _RequestQueries:
+    # 一個 request 裡跑過的 SQL，結束時併進那個 route 的統計
+    __slots__ = ('started', 'queries', 'sql_ms', 'rows', 'acquire_ms', 'slow')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_ms = 0.0
+        self.rows = 0
+        self.acquire_ms = 0.0
+        self.slow = 0
+
+
+class _RouteStats:
+    __slots__ = ('requests', 'queries', 'max_queries', 'rows', 'slow', 'duration', 'sql', 'acquire')
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.rows = 0
+        self.slow = 0
+        self.duration = _Histogram()
+        self.sql = _Histogram()
+        self.acquire = _Histogram()
+
+
+class QueryStats:
+    # 每條 SQL 的時間、筆數；每個 request 的查詢次數、借連線的時間；每個 route 的 histogram
+    # 開銷只有每條 SQL 兩次 perf_counter 跟幾個加法，request 結束時鎖一下併進統計，可以一直開著
+    #
+    #   query_stats = QueryStats(slow_query_ms=200)
+    #   psycopg2.connect(..., connection_factory=query_stats.connection_factory)
+    #   query_stats.start_request() / query_stats.finish_request(route) 包住每個 request
+    def __init__(self, slow_query_ms=200):
+        self.slow_query_ms = slow_query_ms   # 超過幾毫秒記到 log，0 就不記
+        self._current = contextvars.ContextVar('query_stats_request', default=None)
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._slow_total = 0
+        self._cursor_classes = {}
+        self.connection_factory = self._make_connection_factory()
+
+    def _make_connection_factory(self):
+        stats = self
+
+        class InstrumentedConnection(psycopg2.extensions.connection):
+            # route 用什麼 cursor_factory（DictCursor、具名 cursor...）都包一層計時
+            def cursor(self, *args, **kwargs):
+                factory = kwargs.pop('cursor_factory', None) or self.cursor_factory or psycopg2.extensions.cursor
+                kwargs['cursor_factory'] = stats._timed(factory)
+                return super().cursor(*args, **kwargs)
+
+        return InstrumentedConnection
+
+    def _timed(self, factory):
+        cls = self._cursor_classes.get(factory)
+        if cls is not None:
+            return cls
+        stats = self
+
+        class TimedCursor(factory):
+            def execute(self, query, vars=None):
+                start = time.perf_counter()
+                try:
+                    return super().execute(query, vars)
+                finally:
+                    stats.record_query(query, vars, time.perf_counter() - start, self.rowcount)
+
+            def executemany(self, query, vars_list):
+                start = time.perf_counter()
+                try:
+                    return super().executemany(query, vars_list)
+                finally:
+                    stats.record_query(query, None, time.perf_counter() - start, self.rowcount)
+
+        self._cursor_classes[factory] = TimedCursor
+        return TimedCursor
+
+    def start_request(self):
+        self._current.set(_RequestQueries())
+
+    def record_acquire(self, seconds):
+        current = self._current.get()
+        if current is not None:
+            current.acquire_ms += seconds * 1000
+
+    def record_query(self, query, vars, seconds, rows):
+        ms = seconds * 1000
+        current = self._current.get()
+        if current is not None:
+            current.queries += 1
+            current.sql_ms += ms
+            if rows and rows > 0:
+                current.rows += rows
+        if self.slow_query_ms and ms >= self.slow_query_ms:
+            with self._lock:
+                self._slow_total += 1
+            if current is not None:
+                current.slow += 1
+            n_params = len(vars) if isinstance(vars, (list, tuple, dict)) else 0
+            logger.warning('slow query %.1f ms (%d rows, %d params): %s', ms, rows, n_params, redact(query))
+
+    def finish_request(self, route):
+        # 回傳這個 request 的紀錄（給 Server-Timing 用），沒有 start_request 過就回 None
+        current = self._current.get()
+        if current is None:
+            return None
+        self._current.set(None)
+        duration_ms = (time.perf_counter() - current.started) * 1000
+        with self._lock:
+            stats = self._routes.get(route)
+            if stats is None:
+                stats = self._routes[route] = _RouteStats()
+            stats.requests += 1
+            stats.queries += current.queries
+            stats.max_queries = max(stats.max_queries, current.queries)
+            stats.rows += current.rows
+            stats.slow += current.slow
+            stats.duration.add(duration_ms)
+            stats.sql.add(current.sql_ms)
+            stats.acquire.add(current.acquire_ms)
+        return current, duration_ms
+
+    def server_timing(self, record):
+        current, duration_ms = record
+        return (f'db;dur={current.sql_ms:.1f};desc="{current.queries} queries, {current.rows} rows", '
+                f'pool;dur={current.acquire_ms:.1f}, app;dur={duration_ms:.1f}')
+
+    def stats(self):
+        with self._lock:
+            routes = {}
+            for route, s in sorted(self._routes.items()):
+                routes[route] = {
+                    'requests': s.requests,
+                    'queries_per_request': round(s.queries / s.requests, 2),
+                    'max_queries': s.max_queries,
+                    'rows_per_request': round(s.rows / s.requests, 1),
+                    'slow_queries': s.slow,
+                    'duration': s.duration.summary(),
+                    'sql': s.sql.summary(),
+                    'acquire': s.acquire.summary(),
+                }
+            return {
+                'slow_query_ms': self.slow_query_ms,
+                'slow_queries': self._slow_total,
+                'routes': routes,
+            }
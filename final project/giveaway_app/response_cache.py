@@ -0,0 +1,93 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    # 記憶體裡的快取，首頁用來存整頁 HTML（key 是 (檢視模式, 分類, 搜尋字, 分頁...)），也拿來存分類清單
+    # 資料有變動（索取、刊登、刪文...）就 bump()，版本號 +1，之前存的全部作廢
+    # 超過 max_entries 筆或 max_bytes 就把最久沒用到的丟掉 (LRU)
+    # ttl：存超過幾秒一律當作過期，就算漏掉了 bump()（例如別的 worker 的通知沒收到）也不會一直給舊資料
+    def __init__(self, max_entries=512, max_bytes=64 * 1024 * 1024, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (version, value, size, 存進來的時間)，最舊的在前面
+        self._bytes = 0
+        self._version = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expired = 0
+        self._invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    @property
+    def version(self):
+        # 查資料庫之前先記下版本號，存的時候帶回來，中間有人改資料就不會存到舊的結果
+        return self._version
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[3] > self.ttl:
+                self._entries.pop(key)
+                self._bytes -= entry[2]
+                self._expired += 1
+                entry = None
+            if entry is None or entry[0] != self._version:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[1]
+
+    def put(self, key, value, version, size=None):
+        # 不是字串的東西（例如查詢結果）請自己給 size
+        if size is None:
+            size = len(value.encode()) if isinstance(value, str) else len(value)
+        if not self.enabled or size > self.max_bytes:
+            return
+        with self._lock:
+            if version != self._version:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (version, value, size, time.monotonic())
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, _, dropped, _) = self._entries.popitem(last=False)
+                self._bytes -= dropped
+                self._evictions += 1
+
+    def bump(self):
+        with self._lock:
+            self._version += 1
+            self._invalidations += 1
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'enabled': self.enabled,
+                'version': self._version,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / lookups, 4) if lookups else None,
+                'evictions': self._evictions,
+                'expired': self._expired,
+                'ttl': self.ttl,
+                'invalidations': self._invalidations,
+            }
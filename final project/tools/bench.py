@@ -0,0 +1,282 @@
+# 對 app.py 的主要 route 打壓力測試，輸出每個 route 的 p50/p95/p99 延遲跟 throughput
+#
+#   python tools/bench.py                                  # Flask test client，不經過網路
+#   python tools/bench.py --server --concurrency 16        # 起一個本機 WSGI server，用 HTTP 打
+#   python tools/bench.py --compare bench-old.json         # 跟之前的結果比較
+#
+# 結果會寫成 JSON（預設 bench-<commit>.json），方便不同 commit 之間比較。
+# claim / post_item 會真的寫進資料庫，請用測試用的資料庫（可以先用 tools/gen_data.py 灌資料）。
+
+import argparse
+import http.client
+import json
+import logging
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlencode
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'giveaway_app'))
+
+import app as giveaway  # noqa: E402
+from response_cache import ResponseCache  # noqa: E402
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    # nearest-rank
+    k = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[k]
+
+
+def load_samples(n):
+    conn = psycopg2.connect(host=giveaway.DB_HOST, database=giveaway.DB_NAME, user=giveaway.DB_USER,
+                            password=giveaway.DB_PASS, port=giveaway.DB_PORT)
+    cur = conn.cursor()
+    cur.execute("SELECT user_id FROM users ORDER BY random() LIMIT %s", (n,))
+    users = [r[0] for r in cur.fetchall()]
+    cur.execute("""
+        SELECT i.item_id, p.user_id
+        FROM item i JOIN post p ON i.post_id = p.post_id
+        WHERE i.quantity > 0 AND NOT i.expired AND i.expiration_date > NOW() AND p.available
+        ORDER BY random() LIMIT %s
+    """, (n,))
+    items = cur.fetchall()
+    cur.execute("SELECT category_id FROM categories")
+    categories = [r[0] for r in cur.fetchall()]
+    cur.execute("""
+        SELECT COUNT(*) FROM users UNION ALL SELECT COUNT(*) FROM post UNION ALL
+        SELECT COUNT(*) FROM item UNION ALL SELECT COUNT(*) FROM trade
+    """)
+    sizes = dict(zip(['users', 'post', 'item', 'trade'], [r[0] for r in cur.fetchall()]))
+    conn.close()
+    return users, items, categories, sizes
+
+
+def session_cookie(user_id):
+    # 直接簽一個登入過的 session cookie，不用真的走 /login（省掉算密碼 hash 的時間）
+    serializer = giveaway.app.session_interface.get_signing_serializer(giveaway.app)
+    return 'session=' + serializer.dumps({'user_id': user_id, 'username': 'bench'})
+
+
+def build_routes(users, items, categories):
+    words = ['課本', '書桌', '耳機', '外套', '吉他', 'iPhone', '延長線', '的']
+
+    def index(view, **extra):
+        def make(rng):
+            args = {'view': view}
+            args.update({k: v(rng) for k, v in extra.items()})
+            return 'GET', '/?' + urlencode(args), None, None
+        return make
+
+    def claim(rng):
+        item_id, owner = rng.choice(items)
+        user = rng.choice(users)
+        if user == owner:
+            user = users[(users.index(user) + 1) % len(users)]
+        return 'POST', f'/claim/{item_id}', {'want_quantity': 1}, user
+
+    def profile(rng):
+        return 'GET', '/profile', None, rng.choice(users)
+
+    def public_profile(rng):
+        return 'GET', f'/user/{rng.choice(users)}', None, None
+
+    def post_item_form(rng):
+        return 'GET', '/post_item', None, rng.choice(users)
+
+    def post_item(rng):
+        n = rng.randint(1, 4)
+        form = {
+            'description': 'bench ' + rng.choice(words),
+            'location_name': '交大圖書館',
+            'item_name': [rng.choice(words) for _ in range(n)],
+            'quantity': [str(rng.randint(1, 3)) for _ in range(n)],
+            'category_id': [str(rng.choice(categories)) for _ in range(n)],
+        }
+        return 'POST', '/post_item', form, rng.choice(users)
+
+    return {
+        'index_post': index('post'),
+        'index_post_category': index('post', category=lambda r: r.choice(categories)),
+        'index_post_search': index('post', q=lambda r: r.choice(words)),
+        'index_item': index('item'),
+        'index_item_category': index('item', category=lambda r: r.choice(categories)),
+        'index_item_search': index('item', q=lambda r: r.choice(words)),
+        'claim': claim,
+        'profile': profile,
+        'public_profile': public_profile,
+        'post_item_form': post_item_form,
+        'post_item': post_item,
+    }
+
+
+class TestClientDriver:
+    def __init__(self):
+        giveaway.app.testing = True
+        self.local = threading.local()
+
+    def request(self, method, path, form, user):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = giveaway.app.test_client(use_cookies=False)
+        headers = {'Cookie': session_cookie(user)} if user else {}
+        if method == 'GET':
+            r = client.get(path, headers=headers)
+        else:
+            r = client.post(path, data=form, headers=headers)
+        r.close()
+        return r.status_code
+
+
+class ServerDriver:
+    def __init__(self):
+        from werkzeug.serving import make_server
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)   # 不要每個 request 都印一行
+        self.server = make_server('127.0.0.1', 0, giveaway.app, threaded=True)
+        self.port = self.server.server_port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.local = threading.local()
+
+    def request(self, method, path, form, user):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection('127.0.0.1', self.port)
+        headers = {'Cookie': session_cookie(user)} if user else {}
+        body = None
+        if form is not None:
+            body = urlencode(form, doseq=True)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        conn.request(method, path, body=body, headers=headers)
+        r = conn.getresponse()
+        r.read()
+        return r.status
+
+    def close(self):
+        self.server.shutdown()
+
+
+def run_route(driver, make_request, n, concurrency, seed):
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+    counter = iter(range(n))
+
+    def worker(k):
+        rng = random.Random(seed * 1000 + k)
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            method, path, form, user = make_request(rng)
+            start = time.perf_counter()
+            status = driver.request(method, path, form, user)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=worker, args=(k,)) for k in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+    return {
+        'requests': len(latencies),
+        'throughput_rps': round(len(latencies) / wall, 2) if wall else None,
+        'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(latencies[-1] if latencies else None),
+        'status': {str(k): v for k, v in sorted(statuses.items())},
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def print_table(results, baseline=None):
+    print(f"{'route':<22}{'req':>6}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}  status")
+    for name, r in results.items():
+        line = f"{name:<22}{r['requests']:>6}{r['throughput_rps']:>9}{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}  {r['status']}"
+        old = (baseline or {}).get(name)
+        if old and old.get('p95_ms'):
+            line += f"  (p95 {(r['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100:+.1f}%)"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='app.py 各 route 的延遲 / throughput 測試')
+    parser.add_argument('--requests', type=int, default=200, help='每個 route 打幾次')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--server', action='store_true', help='起本機 WSGI server 用 HTTP 打，預設用 Flask test client')
+    parser.add_argument('--routes', help='只測這些 route，用逗號分隔')
+    parser.add_argument('--warmup', type=int, default=10, help='每個 route 先打幾次不計入結果')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-cache', action='store_true', help='關掉快取，量資料庫查詢本身的速度')
+    parser.add_argument('--out', help='結果寫到哪個 JSON 檔，預設 bench-<commit>.json')
+    parser.add_argument('--compare', help='跟之前的結果 JSON 比較')
+    args = parser.parse_args()
+
+    if args.no_cache:
+        giveaway.response_cache = ResponseCache(max_entries=0)
+        giveaway.categories_cache = ResponseCache(max_entries=0)
+
+    users, items, categories, sizes = load_samples(1000)
+    routes = build_routes(users, items, categories)
+    if args.routes:
+        routes = {k: v for k, v in routes.items() if k in args.routes.split(',')}
+
+    driver = ServerDriver() if args.server else TestClientDriver()
+    results = {}
+    for name, make_request in routes.items():
+        if args.warmup:
+            run_route(driver, make_request, args.warmup, 1, args.seed + 1)
+        results[name] = run_route(driver, make_request, args.requests, args.concurrency, args.seed)
+    if args.server:
+        driver.close()
+
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'driver': 'server' if args.server else 'test_client',
+        'requests_per_route': args.requests,
+        'concurrency': args.concurrency,
+        'response_cache': not args.no_cache,
+        'db_rows': sizes,
+        'routes': results,
+    }
+    out = args.out or f'bench-{commit}.json'
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)['routes']
+    print_table(results, baseline)
+    print(f'\n結果寫到 {out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+# 量個人頁面對「重度使用者」（索取過幾千次、刊登幾百篇、收到幾千則評價）的延遲
+#
+#   python tools/bench_profile.py                          # 5000 筆 trade、500 篇貼文、2000 則評價
+#   python tools/bench_profile.py --trades 20000 --runs 100
+#   python tools/bench_profile.py --user 42                # 直接量現有的使用者，不建測試資料
+#
+# 會比較三種：
+#   legacy    原本的寫法：五條 SQL 依序查、整個列表全部撈回來、每一列跑一次子查詢（我的評分、物品數）
+#   profile   現在的 /profile（一條 SQL，每個列表只拿一頁）
+#   public    現在的 /user/<id>
+#   deep      /profile 翻到很後面的一頁（keyset 分頁，應該跟第一頁差不多快）
+#
+# 測試資料掛在兩個新建的使用者底下，跑完整個刪掉（加 --keep 就留著）。請用測試用的資料庫。
+
+import argparse
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import psycopg2
+import psycopg2.extras
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'giveaway_app'))
+
+import app as giveaway  # noqa: E402
+from pagination import encode_cursor  # noqa: E402
+
+# 改版之前 profile() 的五條 SQL，原封不動留著當比較基準
+LEGACY_QUERIES = [
+    """
+    SELECT u.name, u.organization, a.username,
+           COALESCE(AVG(c.rating), 0) as avg_score,
+           COUNT(c.comment_id) as review_count
+    FROM ((users u LEFT JOIN account a
+            ON u.user_id = a.user_id) LEFT JOIN post p
+            ON u.user_id = p.user_id) LEFT JOIN comment c
+            ON p.post_id = c.post_id
+    WHERE u.user_id = %(uid)s
+    GROUP BY u.user_id, a.username;
+    """,
+    "SELECT phone_number FROM phone WHERE user_id = %(uid)s",
+    """
+    SELECT c.comment_str, c.rating, c.comment_time, p.description
+    FROM (comment c LEFT JOIN post p
+            ON c.post_id = p.post_id)
+    WHERE p.user_id = %(uid)s
+    ORDER BY c.comment_time DESC
+    """,
+    """
+    SELECT t.trade_time, t.quantity, i.item_name,
+           p.description as post_title, p.post_id,
+            (SELECT rating FROM comment c
+             WHERE c.post_id = p.post_id AND c.user_id = %(uid)s LIMIT 1) as my_rating
+    FROM (trade t LEFT JOIN item i
+             ON t.item_id = i.item_id) LEFT JOIN post p
+             ON i.post_id = p.post_id
+    WHERE t.user_id = %(uid)s
+    ORDER BY t.trade_time DESC
+    """,
+    """
+    SELECT p.post_id,  p.description, p.post_time, p.available,
+           (SELECT COUNT(*) FROM item i WHERE i.post_id = p.post_id) as item_count
+    FROM post p
+    WHERE p.user_id = %(uid)s
+    ORDER BY p.post_time DESC
+    """,
+]
+
+BASE_TIME = datetime(2024, 1, 1)
+
+
+def connect():
+    return psycopg2.connect(host=giveaway.DB_HOST, database=giveaway.DB_NAME, user=giveaway.DB_USER,
+                            password=giveaway.DB_PASS, port=giveaway.DB_PORT)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    # nearest-rank
+    k = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[k]
+
+
+def setup(conn, n_trades, n_posts, n_comments, seed):
+    # heavy：要量的人。supplier：開很多貼文給 heavy 索取，順便給 heavy 的貼文寫評價
+    rng = random.Random(seed)
+    cur = conn.cursor()
+    cur.execute("SELECT category_id FROM categories ORDER BY category_id LIMIT 1")
+    category_id = cur.fetchone()[0]
+    cur.execute("SELECT location_id FROM location ORDER BY location_id LIMIT 1")
+    location_id = cur.fetchone()[0]
+    cur.execute("INSERT INTO users (name, organization) VALUES ('bench_profile', 'bench') RETURNING user_id")
+    heavy = cur.fetchone()[0]
+    cur.execute("INSERT INTO users (name, organization) VALUES ('bench_supplier', 'bench') RETURNING user_id")
+    supplier = cur.fetchone()[0]
+
+    def posts_with_items(owner, n, items_per_post, quantity):
+        post_ids = [r[0] for r in psycopg2.extras.execute_values(
+            cur,
+            "INSERT INTO post (user_id, description, post_time) VALUES %s RETURNING post_id",
+            [(owner, f'bench_profile {k}', BASE_TIME + timedelta(minutes=k)) for k in range(n)],
+            page_size=1000, fetch=True)]
+        item_ids = [r[0] for r in psycopg2.extras.execute_values(
+            cur,
+            """INSERT INTO item (category_id, post_id, location_id, item_name, expiration_date, quantity)
+               VALUES %s RETURNING item_id""",
+            [(category_id, p, location_id, f'bench_profile {p}-{k}', quantity)
+             for p in post_ids for k in range(items_per_post)],
+            template="(%s, %s, %s, %s, NOW() + interval '30 days', %s)", page_size=1000, fetch=True)]
+        return post_ids, item_ids
+
+    my_posts, _ = posts_with_items(heavy, n_posts, 3, 5)
+    source_posts, source_items = posts_with_items(supplier, max(1, n_trades // 20), 1, 1000)
+
+    psycopg2.extras.execute_values(
+        cur,
+        "INSERT INTO trade (user_id, item_id, quantity, trade_time) VALUES %s",
+        [(heavy, rng.choice(source_items), 1, BASE_TIME + timedelta(days=31, seconds=k)) for k in range(n_trades)],
+        page_size=1000)
+    # heavy 評過一半的來源貼文，supplier 對 heavy 的貼文留評價
+    psycopg2.extras.execute_values(
+        cur,
+        "INSERT INTO comment (post_id, user_id, rating, comment_str, comment_time) VALUES %s",
+        [(p, heavy, rng.randint(1, 5), 'bench_profile', BASE_TIME + timedelta(days=60)) for p in source_posts[::2]]
+        + [(rng.choice(my_posts), supplier, rng.randint(0, 5), 'bench_profile',
+            BASE_TIME + timedelta(days=60, seconds=k)) for k in range(n_comments)],
+        page_size=1000)
+    conn.commit()
+    cur.close()
+    return heavy, supplier
+
+
+def deep_cursor(conn, user_id, depth):
+    # 第 depth 筆 trade 的位置，拿來組 claims_after，模擬一直按「更早的紀錄」
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT trade_time, trade_id FROM trade WHERE user_id = %s
+        ORDER BY trade_time DESC, trade_id DESC OFFSET %s LIMIT 1
+    """, (user_id, depth))
+    row = cur.fetchone()
+    cur.close()
+    return encode_cursor(row) if row else None
+
+
+def time_it(fn, runs):
+    fn()   # 先熱身一次
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='個人頁面對重度使用者的延遲')
+    parser.add_argument('--user', type=int, help='直接量這個 user_id，不建測試資料')
+    parser.add_argument('--trades', type=int, default=5000)
+    parser.add_argument('--posts', type=int, default=500)
+    parser.add_argument('--comments', type=int, default=2000)
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--keep', action='store_true', help='跑完不要刪掉測試資料')
+    args = parser.parse_args()
+
+    conn = connect()
+    created = None
+    if args.user:
+        heavy = args.user
+    else:
+        print(f'建測試資料：{args.trades} 筆 trade、{args.posts} 篇貼文、{args.comments} 則評價...')
+        created = setup(conn, args.trades, args.posts, args.comments, args.seed)
+        heavy = created[0]
+
+    giveaway.app.testing = True
+    client = giveaway.app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = heavy
+        sess['username'] = 'bench_profile'
+    viewer = giveaway.app.test_client()
+
+    def legacy():
+        cur = conn.cursor()
+        for sql in LEGACY_QUERIES:
+            cur.execute(sql, {'uid': heavy})
+            cur.fetchall()
+        cur.close()
+        conn.rollback()
+
+    def get(c, path):
+        def run():
+            r = c.get(path)
+            if r.status_code != 200:
+                sys.exit(f'{path} 回了 {r.status_code}')
+        return run
+
+    cases = [
+        ('legacy', legacy),
+        ('profile', get(client, '/profile')),
+        ('public', get(viewer, f'/user/{heavy}')),
+    ]
+    cursor = deep_cursor(conn, heavy, args.trades // 2)
+    if cursor:
+        cases.append(('deep', get(client, f'/profile?claims_after={cursor}')))
+
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT (SELECT COUNT(*) FROM trade WHERE user_id = %(uid)s),
+               (SELECT COUNT(*) FROM post WHERE user_id = %(uid)s),
+               (SELECT COUNT(*) FROM comment c JOIN post p ON c.post_id = p.post_id WHERE p.user_id = %(uid)s)
+    """, {'uid': heavy})
+    trades, posts, comments = cur.fetchone()
+    cur.close()
+    conn.rollback()
+    print(f'user {heavy}：{trades} 筆索取、{posts} 篇貼文、{comments} 則評價，每種跑 {args.runs} 次\n')
+
+    print(f"{'':<10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    results = {}
+    for name, fn in cases:
+        latencies = time_it(fn, args.runs)
+        results[name] = latencies
+        print(f'{name:<10}{percentile(latencies, 50) * 1000:>10.1f}'
+              f'{percentile(latencies, 95) * 1000:>10.1f}{latencies[-1] * 1000:>10.1f}')
+
+    legacy_p50 = percentile(results['legacy'], 50)
+    print(f"\n/profile 比原本的查詢快 {legacy_p50 / percentile(results['profile'], 50):.1f} 倍（p50，原本的還沒算 render）")
+
+    if created and not args.keep:
+        cur = conn.cursor()
+        # 刪 user 會 cascade 刪掉貼文、物品、trade、評價
+        cur.execute("DELETE FROM users WHERE user_id = ANY(%s)", (list(created),))
+        conn.commit()
+        cur.close()
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
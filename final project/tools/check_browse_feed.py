@@ -0,0 +1,264 @@
+# 檢查首頁的 feed 表 (browse_item_feed / browse_post_feed, migrations/011) 是不是一直跟原本的 JOIN 一樣
+# 隨機做一連串會影響首頁的寫入（索取、批次索取、刊登、刪貼文、過期下架、改名字、改地點、改分類、刪帳號、背景刪除…），
+# 每做完一步就用 browse_feed_drift() 比一次 feed 跟 view，有對不起來的就印出是哪一步
+#
+#   python tools/check_browse_feed.py                     # 300 步
+#   python tools/check_browse_feed.py --steps 2000 --seed 7
+#
+# 全部在同一個 transaction 裡做，最後 rollback，不會改到資料庫。
+# 都對得起來就 exit 0，有對不起來 exit 1。
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'giveaway_app'))
+
+import app as giveaway  # noqa: E402
+
+
+def connect():
+    return psycopg2.connect(host=giveaway.DB_HOST, database=giveaway.DB_NAME, user=giveaway.DB_USER,
+                            password=giveaway.DB_PASS, port=giveaway.DB_PORT)
+
+
+def pick(cur, sql, params=()):
+    cur.execute(sql, params)
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def random_live_item(cur, rng):
+    # 隨機挑一個還有庫存的物品（用 item_id 範圍抽，不用 ORDER BY random() 掃整張表）
+    return pick(cur, """
+        SELECT item_id FROM item
+        WHERE quantity > 0 AND NOT expired AND item_id >= (SELECT MIN(item_id) + (MAX(item_id) - MIN(item_id)) * %s FROM item)
+        ORDER BY item_id LIMIT 1
+    """, (rng.random(),))
+
+
+def random_user(cur, rng):
+    return pick(cur, "SELECT user_id FROM users WHERE user_id >= (SELECT MAX(user_id) * %s FROM users) ORDER BY user_id LIMIT 1",
+                (rng.random(),))
+
+
+def random_post(cur, rng, available=True):
+    return pick(cur, f"""
+        SELECT post_id FROM post
+        WHERE {'available AND' if available else ''} post_id >= (SELECT MAX(post_id) * %s FROM post)
+        ORDER BY post_id LIMIT 1
+    """, (rng.random(),))
+
+
+def claim(cur, rng):
+    item_id = random_live_item(cur, rng)
+    if item_id is None:
+        return None
+    cur.execute("SELECT status FROM claim_item(%s, %s, %s)", (random_user(cur, rng), item_id, rng.randint(1, 3)))
+    return f'索取 item {item_id}: {cur.fetchone()[0]}'
+
+
+def claim_batch(cur, rng):
+    post_id = random_post(cur, rng)
+    if post_id is None:
+        return None
+    cur.execute("SELECT item_id, quantity FROM item WHERE post_id = %s AND quantity > 0", (post_id,))
+    items = cur.fetchall()
+    if not items:
+        return None
+    cur.execute("SELECT item_id, status FROM claim_items(%s, %s, %s)",
+                (random_user(cur, rng), [i for i, _ in items], [rng.randint(1, q) for _, q in items]))
+    return f'批次索取 post {post_id}: {[s for _, s in cur.fetchall()]}'
+
+
+def sell_out(cur, rng):
+    # 直接 INSERT trade 把整篇拿光（跟 gen_data / 匯入一樣的路徑）
+    post_id = random_post(cur, rng)
+    if post_id is None:
+        return None
+    cur.execute("""
+        INSERT INTO trade (user_id, item_id, quantity, trade_time)
+        SELECT %s, item_id, quantity, NOW() FROM item WHERE post_id = %s AND quantity > 0
+    """, (random_user(cur, rng), post_id))
+    return f'拿光 post {post_id}（{cur.rowcount} 筆 trade）'
+
+
+def add_post(cur, rng):
+    user_id = random_user(cur, rng)
+    cur.execute("INSERT INTO post (user_id, description) VALUES (%s, %s) RETURNING post_id", (user_id, f'feed 檢查 {rng.random():.6f}'))
+    post_id = cur.fetchone()[0]
+    location_id = pick(cur, "SELECT location_id FROM location ORDER BY location_id LIMIT 1")
+    cur.execute("SELECT category_id FROM categories")
+    categories = [r[0] for r in cur.fetchall()]
+    n = rng.randint(1, 5)
+    cur.execute("""
+        INSERT INTO item (category_id, post_id, location_id, item_name, expiration_date, quantity)
+        SELECT c, %s, %s, 'feed 檢查 ' || k, NOW() + interval '7 days', q
+        FROM unnest(%s::int[], %s::int[], %s::int[]) AS t(k, c, q)
+    """, (post_id, location_id, list(range(n)), [rng.choice(categories) for _ in range(n)],
+          [rng.randint(0, 3) for _ in range(n)]))
+    return f'刊登 post {post_id}（{n} 樣）'
+
+
+def delete_post(cur, rng):
+    post_id = random_post(cur, rng, available=False)
+    if post_id is None:
+        return None
+    cur.execute("DELETE FROM post WHERE post_id = %s", (post_id,))
+    return f'刪除 post {post_id}'
+
+
+def expire(cur, rng):
+    item_id = random_live_item(cur, rng)
+    if item_id is None:
+        return None
+    cur.execute("UPDATE item SET expiration_date = NOW() - interval '1 second' WHERE item_id = %s", (item_id,))
+    cur.execute("SELECT expire_items(100)")
+    return f'item {item_id} 過期，下架了 {cur.fetchone()[0]} 樣'
+
+
+def rename_user(cur, rng):
+    user_id = random_user(cur, rng)
+    cur.execute("UPDATE users SET name = %s WHERE user_id = %s", (f'改名{rng.randint(0, 9999)}', user_id))
+    return f'user {user_id} 改名字'
+
+
+def move_location(cur, rng):
+    item_id = random_live_item(cur, rng)
+    if item_id is None:
+        return None
+    if rng.random() < 0.5 or not has_coordinates(cur):
+        # 巷號帶 location_id，改完才不會跟別的地點變成同一個地址（migrations/013 的 unique）
+        cur.execute("""
+            UPDATE location SET street = street || location_id || '巷'
+            WHERE location_id = (SELECT location_id FROM item WHERE item_id = %s)
+        """, (item_id,))
+        return f'改 item {item_id} 的地點'
+    # 只改經緯度（migrations/012），沒有座標的補一個
+    cur.execute("""
+        UPDATE location SET lat = COALESCE(lat, 24.8) + %s, lon = COALESCE(lon, 121.0) + %s
+        WHERE location_id = (SELECT location_id FROM item WHERE item_id = %s)
+    """, (rng.uniform(-0.02, 0.02), rng.uniform(-0.02, 0.02), item_id))
+    return f'改 item {item_id} 地點的座標'
+
+
+def has_coordinates(cur):
+    cur.execute("SELECT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name = 'location' AND column_name = 'lat')")
+    return cur.fetchone()[0]
+
+
+def rename_category(cur, rng):
+    cur.execute("UPDATE categories SET name = name || '*' WHERE category_id = (SELECT category_id FROM categories ORDER BY random() LIMIT 1)")
+    return '改分類名稱'
+
+
+def close_post(cur, rng):
+    post_id = random_post(cur, rng)
+    if post_id is None:
+        return None
+    cur.execute("UPDATE post SET available = false, description = description || '（結案）' WHERE post_id = %s", (post_id,))
+    return f'手動結案 post {post_id}'
+
+
+def delete_user(cur, rng):
+    user_id = random_user(cur, rng)
+    cur.execute("DELETE FROM users WHERE user_id = %s", (user_id,))
+    return f'刪除 user {user_id}'
+
+
+def soft_delete_post(cur, rng):
+    # 刪貼文的 route 現在是先標起來，再由 purge_step 一批一批刪（migrations/014）
+    if not has_purge(cur):
+        return None
+    post_id = random_post(cur, rng, available=False)
+    if post_id is None:
+        return None
+    cur.execute("SELECT soft_delete_post(%s)", (post_id,))
+    return f'標記刪除 post {post_id}'
+
+
+def soft_delete_user(cur, rng):
+    if not has_purge(cur):
+        return None
+    user_id = random_user(cur, rng)
+    cur.execute("SELECT soft_delete_user(%s)", (user_id,))
+    return f'標記刪除 user {user_id}'
+
+
+def purge(cur, rng):
+    if not has_purge(cur):
+        return None
+    cur.execute("SELECT job_id, step, deleted FROM purge_step(%s)", (rng.choice([1, 10, 100]),))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return f'purge job {row[0]} 刪了 {row[2]} 列（下一步 {row[1]}）'
+
+
+def has_purge(cur):
+    cur.execute("SELECT to_regclass('purge_job') IS NOT NULL")
+    return cur.fetchone()[0]
+
+
+# (動作, 權重)：索取最常見
+ACTIONS = [
+    (claim, 30), (claim_batch, 10), (sell_out, 5), (add_post, 15), (delete_post, 5), (expire, 10),
+    (rename_user, 5), (move_location, 5), (rename_category, 2), (close_post, 5), (delete_user, 2),
+    (soft_delete_post, 5), (soft_delete_user, 2), (purge, 10),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='隨機寫入，檢查首頁的 feed 表一直跟原本的 JOIN 一樣')
+    parser.add_argument('--steps', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    conn = connect()
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('browse_item_feed') IS NOT NULL")
+    if not cur.fetchone()[0]:
+        sys.exit('資料庫還沒有 feed 表，請先執行 database/migrations/011_browse_feed.sql')
+
+    cur.execute("SELECT COUNT(*) FROM browse_feed_drift()")
+    if cur.fetchone()[0]:
+        sys.exit('一開始就對不起來，請先跑 flask --app app feed rebuild')
+
+    actions, weights = zip(*ACTIONS)
+    counts = {}
+    start = time.perf_counter()
+    failed = None
+    for step in range(1, args.steps + 1):
+        action = rng.choices(actions, weights)[0]
+        description = action(cur, rng)
+        if description is None:
+            continue
+        counts[action.__name__] = counts.get(action.__name__, 0) + 1
+        cur.execute("SELECT kind, id, problem FROM browse_feed_drift() LIMIT 10")
+        drift = cur.fetchall()
+        if drift:
+            failed = (step, description, drift)
+            break
+    elapsed = time.perf_counter() - start
+
+    cur.close()
+    conn.rollback()
+    conn.close()
+
+    print(f'做了 {sum(counts.values())} 步（{elapsed:.1f} 秒）：' + '、'.join(f'{k} {v}' for k, v in counts.items()))
+    if failed:
+        step, description, drift = failed
+        print(f'\n第 {step} 步「{description}」之後 feed 對不起來：')
+        for kind, id_, problem in drift:
+            print(f'  {kind} {id_}: {problem}')
+        sys.exit(1)
+    print('feed 每一步都跟 JOIN 的結果一樣')
+
+
+if __name__ == '__main__':
+    main()
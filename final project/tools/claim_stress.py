@@ -0,0 +1,165 @@
+# 很多人同時搶同一個物品，檢查 claim_item() 不會超賣、也不會有莫名其妙的失敗
+#
+#   python tools/claim_stress.py                          # 300 個人搶庫存 200 的物品，每人拿 1 個
+#   python tools/claim_stress.py --claimers 500 --stock 50 --quantity 2
+#   python tools/claim_stress.py --app                    # 改成打 /claim route（Flask test client）
+#
+# 會先開一篇測試用的貼文，跑完檢查結果後整篇刪掉（trade 會跟著 cascade 刪除）。
+# 通過就 exit 0，有問題 exit 1。
+
+import argparse
+import os
+import sys
+import threading
+from collections import Counter
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'giveaway_app'))
+
+import app as giveaway  # noqa: E402
+from db_pool import ConnectionPool  # noqa: E402
+
+
+def connect():
+    return psycopg2.connect(host=giveaway.DB_HOST, database=giveaway.DB_NAME, user=giveaway.DB_USER,
+                            password=giveaway.DB_PASS, port=giveaway.DB_PORT)
+
+
+def setup(conn, stock, claimers):
+    cur = conn.cursor()
+    cur.execute("SELECT user_id FROM users ORDER BY user_id LIMIT %s", (claimers + 1,))
+    users = [r[0] for r in cur.fetchall()]
+    if len(users) < 2:
+        sys.exit('資料庫裡至少要有兩個 user')
+    owner, users = users[0], users[1:]
+    cur.execute("SELECT category_id FROM categories ORDER BY category_id LIMIT 1")
+    category_id = cur.fetchone()[0]
+    cur.execute("SELECT location_id FROM location ORDER BY location_id LIMIT 1")
+    location_id = cur.fetchone()[0]
+    cur.execute("INSERT INTO post (user_id, description) VALUES (%s, 'claim_stress') RETURNING post_id",
+                (owner,))
+    post_id = cur.fetchone()[0]
+    cur.execute("""
+        INSERT INTO item (category_id, post_id, location_id, item_name, expiration_date, quantity)
+        VALUES (%s, %s, %s, 'claim_stress', NOW() + interval '1 day', %s)
+        RETURNING item_id
+    """, (category_id, post_id, location_id, stock))
+    item_id = cur.fetchone()[0]
+    conn.commit()
+    cur.close()
+    # 人數比 user 多的話就重複用
+    return owner, [users[k % len(users)] for k in range(claimers)], post_id, item_id
+
+
+def claim_direct(user_id, item_id, quantity):
+    with giveaway.db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT status FROM claim_item(%s, %s, %s)", (user_id, item_id, quantity))
+        status = cur.fetchone()[0]
+        conn.commit()
+        return status
+
+
+def claim_app(user_id, item_id, quantity):
+    client = giveaway.app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+        sess['username'] = 'claim_stress'
+    r = client.post(f'/claim/{item_id}', data={'want_quantity': quantity})
+    with client.session_transaction() as sess:
+        flashes = [msg for _, msg in sess.get('_flashes', [])]
+    if r.status_code != 302:
+        return f'http_{r.status_code}'
+    if any(msg.startswith('索取成功') for msg in flashes):
+        return 'ok'
+    if any(msg.startswith('庫存不夠') or msg.startswith('這個東西已經被拿完') for msg in flashes):
+        return 'insufficient'
+    return 'error: ' + ' / '.join(flashes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='同時大量索取同一個物品，檢查有沒有超賣')
+    parser.add_argument('--claimers', type=int, default=300)
+    parser.add_argument('--stock', type=int, default=200)
+    parser.add_argument('--quantity', type=int, default=1, help='每個人拿幾個')
+    parser.add_argument('--app', action='store_true', help='透過 /claim route 而不是直接呼叫 claim_item()')
+    parser.add_argument('--connections', type=int, default=50, help='最多同時開幾條資料庫連線')
+    parser.add_argument('--keep', action='store_true', help='跑完不要刪掉測試貼文')
+    args = parser.parse_args()
+
+    # 人數通常比 max_connections 多，連線池排隊；等待時間拉長，避免把等連線逾時算成失敗
+    giveaway.db_pool = ConnectionPool(
+        minconn=1, maxconn=args.connections, wait_timeout=120,
+        host=giveaway.DB_HOST, database=giveaway.DB_NAME, user=giveaway.DB_USER,
+        password=giveaway.DB_PASS, port=giveaway.DB_PORT,
+    )
+
+    conn = connect()
+    owner, users, post_id, item_id = setup(conn, args.stock, args.claimers)
+    claim = claim_direct
+    if args.app:
+        giveaway.app.testing = True
+        claim = claim_app
+
+    statuses = Counter()
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.claimers)
+
+    def worker(user_id):
+        barrier.wait()   # 大家一起開搶
+        try:
+            status = claim(user_id, item_id, args.quantity)
+        except Exception as e:
+            status = f'error: {type(e).__name__}: {e}'.strip()
+        with lock:
+            statuses[status] += 1
+
+    threads = [threading.Thread(target=worker, args=(u,)) for u in users]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    cur = conn.cursor()
+    cur.execute("SELECT quantity FROM item WHERE item_id = %s", (item_id,))
+    left = cur.fetchone()[0]
+    cur.execute("SELECT COALESCE(SUM(quantity), 0), COUNT(*) FROM trade WHERE item_id = %s", (item_id,))
+    claimed, trades = cur.fetchone()
+    cur.execute("SELECT available FROM post WHERE post_id = %s", (post_id,))
+    available = cur.fetchone()[0]
+
+    expected_ok = min(args.claimers, args.stock // args.quantity)
+    problems = []
+    if claimed + left != args.stock:
+        problems.append(f'庫存對不起來：拿走 {claimed} + 剩下 {left} != {args.stock}')
+    if statuses['ok'] != trades:
+        problems.append(f'回報成功 {statuses["ok"]} 次，但 trade 有 {trades} 筆')
+    if statuses['ok'] != expected_ok:
+        problems.append(f'應該要有 {expected_ok} 人成功，實際 {statuses["ok"]} 人')
+    failed = {k: v for k, v in statuses.items() if k not in ('ok', 'insufficient', 'unavailable')}
+    if failed:
+        problems.append(f'不該出現的結果：{failed}')
+    if available != (left > 0):
+        problems.append(f'post.available = {available}，但剩下 {left} 個')
+
+    print(f'{args.claimers} 人搶庫存 {args.stock} 的物品（每人 {args.quantity} 個）')
+    print(f'結果：{dict(statuses)}')
+    print(f'trade {trades} 筆，共拿走 {claimed} 個，剩下 {left} 個，post.available = {available}')
+
+    if not args.keep:
+        cur.execute("DELETE FROM post WHERE post_id = %s", (post_id,))
+        conn.commit()
+    conn.close()
+    giveaway.db_pool.closeall()
+
+    if problems:
+        print('\n有問題：')
+        for p in problems:
+            print('  - ' + p)
+        sys.exit(1)
+    print('\nOK')
+
+
+if __name__ == '__main__':
+    main()
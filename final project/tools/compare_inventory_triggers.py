@@ -0,0 +1,157 @@
+# 比較舊的 FOR EACH ROW trigger (update_inventory) 跟新的 FOR EACH STATEMENT trigger (update_inventory_batch)
+# 對同一批 trade 跑出來的結果是不是一樣，順便比速度
+#
+#   python tools/compare_inventory_triggers.py                      # 2000 筆 trade，每個 INSERT 塞 100 筆
+#   python tools/compare_inventory_triggers.py --trades 20000 --batch 1000
+#
+# 兩種 trigger 都在同一個 transaction 裡換上去、跑完、比對，最後整個 rollback，不會改到資料庫。
+# 不過換 trigger 的時候會鎖住 trade 表，請用測試用的資料庫。
+# 結果一樣就 exit 0，不一樣 exit 1。
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extras
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'giveaway_app'))
+
+import app as giveaway  # noqa: E402
+
+TRIGGERS = {
+    'row': """
+        CREATE TRIGGER trade_insert_trigger
+        AFTER INSERT ON trade
+        FOR EACH ROW
+        EXECUTE FUNCTION update_inventory()
+    """,
+    'statement': """
+        CREATE TRIGGER trade_inventory_trigger
+        AFTER INSERT ON trade
+        REFERENCING NEW TABLE AS new_trades
+        FOR EACH STATEMENT
+        EXECUTE FUNCTION update_inventory_batch()
+    """,
+}
+
+
+def connect():
+    return psycopg2.connect(host=giveaway.DB_HOST, database=giveaway.DB_NAME, user=giveaway.DB_USER,
+                            password=giveaway.DB_PASS, port=giveaway.DB_PORT)
+
+
+def build_workload(conn, n_trades, seed):
+    # 隨機挑還有庫存的物品，大約一半的物品會被拿光，讓有些 post 結案、有些不會
+    rng = random.Random(seed)
+    cur = conn.cursor()
+    cur.execute("SELECT user_id FROM users")
+    users = [r[0] for r in cur.fetchall()]
+    cur.execute("SELECT item_id, quantity FROM item WHERE quantity > 0 ORDER BY item_id")
+    stock = dict(cur.fetchall())
+    cur.close()
+
+    trades = []
+    left = dict(stock)
+    items = list(stock)
+    rng.shuffle(items)
+    for item_id in items:
+        if len(trades) >= n_trades:
+            break
+        target = left[item_id] if rng.random() < 0.5 else rng.randint(0, left[item_id] - 1)
+        while target > 0 and len(trades) < n_trades:
+            q = rng.randint(1, target)
+            trades.append((rng.choice(users), item_id, q))
+            target -= q
+            left[item_id] -= q
+    rng.shuffle(trades)
+    # 超賣的那一筆：兩種 trigger 都應該被 CHECK (quantity >= 0) 擋下來
+    oversell = (rng.choice(users), items[0], stock[items[0]] + 1)
+    return trades, oversell
+
+
+def run(conn, mode, trades, oversell, batch):
+    cur = conn.cursor()
+    cur.execute("DROP TRIGGER IF EXISTS trade_insert_trigger ON trade")
+    cur.execute("DROP TRIGGER IF EXISTS trade_inventory_trigger ON trade")
+    cur.execute(TRIGGERS[mode])
+
+    start = time.perf_counter()
+    for k in range(0, len(trades), batch):
+        psycopg2.extras.execute_values(
+            cur,
+            "INSERT INTO trade (user_id, item_id, quantity, trade_time) VALUES %s",
+            trades[k:k + batch],
+            template='(%s, %s, %s, NOW())',
+            page_size=batch,
+        )
+    elapsed = time.perf_counter() - start
+
+    item_ids = sorted({t[1] for t in trades})
+    cur.execute("SELECT item_id, quantity FROM item WHERE item_id = ANY(%s) ORDER BY item_id", (item_ids,))
+    items = cur.fetchall()
+    cur.execute("""
+        SELECT post_id, available FROM post
+        WHERE post_id IN (SELECT post_id FROM item WHERE item_id = ANY(%s))
+        ORDER BY post_id
+    """, (item_ids,))
+    posts = cur.fetchall()
+
+    cur.execute("SAVEPOINT oversell")
+    try:
+        cur.execute("INSERT INTO trade (user_id, item_id, quantity, trade_time) VALUES (%s, %s, %s, NOW())",
+                    oversell)
+        oversell_result = 'accepted'
+    except psycopg2.Error as e:
+        oversell_result = type(e).__name__
+    cur.execute("ROLLBACK TO SAVEPOINT oversell")
+
+    cur.close()
+    conn.rollback()
+    return elapsed, items, posts, oversell_result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='比較 row-level 跟 statement-level 扣庫存 trigger 的結果跟速度')
+    parser.add_argument('--trades', type=int, default=2000)
+    parser.add_argument('--batch', type=int, default=100, help='每個 INSERT 塞幾筆 trade')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    conn = connect()
+    trades, oversell = build_workload(conn, args.trades, args.seed)
+    if not trades:
+        sys.exit('沒有還有庫存的物品可以測')
+
+    results = {mode: run(conn, mode, trades, oversell, args.batch) for mode in ('row', 'statement')}
+    conn.close()
+
+    print(f'{len(trades)} 筆 trade，{len({t[1] for t in trades})} 個物品，每個 INSERT {args.batch} 筆')
+    for mode, (elapsed, _, posts, oversell_result) in results.items():
+        closed = sum(1 for _, available in posts if not available)
+        print(f'  {mode:<10} {elapsed * 1000:9.1f} ms   結案的 post {closed}/{len(posts)}   超賣：{oversell_result}')
+
+    row, stmt = results['row'], results['statement']
+    problems = []
+    if row[1] != stmt[1]:
+        diff = [(a, b) for a, b in zip(row[1], stmt[1]) if a != b][:5]
+        problems.append(f'item 庫存不一樣，例如 (row, statement)：{diff}')
+    if row[2] != stmt[2]:
+        diff = [(a, b) for a, b in zip(row[2], stmt[2]) if a != b][:5]
+        problems.append(f'post.available 不一樣，例如 (row, statement)：{diff}')
+    if row[3] != stmt[3] or row[3] == 'accepted':
+        problems.append(f'超賣的結果不一樣或沒被擋下來：row {row[3]}，statement {stmt[3]}')
+
+    if problems:
+        print('\n有問題：')
+        for p in problems:
+            print('  - ' + p)
+        sys.exit(1)
+    print(f"\n結果一樣，statement-level 快 {row[0] / stmt[0]:.1f} 倍")
+
+
+if __name__ == '__main__':
+    main()
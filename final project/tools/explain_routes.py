@@ -0,0 +1,238 @@
+# 把 app.py 每個 route 實際跑一次，對每一條 SQL 做 EXPLAIN，列出還在 Seq Scan 的查詢
+#
+#   python tools/explain_routes.py                  # 關掉 seq scan 看「有沒有 index 可以用」
+#   python tools/explain_routes.py --realistic --min-rows 100000
+#                                                   # 用資料庫目前的資料量看 planner 真正的選擇
+#
+# 預設會 SET enable_seqscan = off：只要有 index 能用 planner 就會用，
+# 所以剩下的 Seq Scan 代表真的缺 index，跟資料量無關。
+# --realistic 則是照目前資料庫裡的資料量跑，建議先塞到想測的規模再看。
+# 所有寫入都會 rollback，不會改到資料庫。
+
+import argparse
+import datetime
+import io
+import json
+import os
+import sys
+
+import psycopg2
+import psycopg2.extensions
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'giveaway_app'))
+
+import app as giveaway  # noqa: E402
+from db_pool import ConnectionPool  # noqa: E402
+from lastlogin_buffer import LastLoginBuffer  # noqa: E402
+from purge_worker import PurgeWorker  # noqa: E402
+from response_cache import ResponseCache  # noqa: E402
+from pagination import encode_cursor  # noqa: E402
+
+SQL_VERBS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+# 本來就是整張讀的小表（每個分類 16 列），Seq Scan 是正常的
+WHOLE_TABLE_READS = {'category_stock'}
+
+captured = []        # [(route, statement, plan)]
+current_route = [None]
+force_index = [True]
+
+
+def walk_plan(node, found):
+    if node.get('Node Type') == 'Seq Scan':
+        found.append((node.get('Relation Name'), node.get('Plan Rows')))
+    for child in node.get('Plans', []):
+        walk_plan(child, found)
+    return found
+
+
+def capturing(factory):
+    class CapturingCursor(factory):
+        def execute(self, query, vars=None):
+            statement = self.mogrify(query, vars).decode()
+            if statement.lstrip().upper().startswith(SQL_VERBS):
+                raw = psycopg2.extensions.connection.cursor(self.connection)
+                raw.execute('SAVEPOINT explain_routes')
+                try:
+                    if force_index[0]:
+                        raw.execute('SET LOCAL enable_seqscan = off')
+                    raw.execute('EXPLAIN (FORMAT JSON) ' + statement)
+                    plan = raw.fetchone()[0][0]['Plan']
+                    captured.append((current_route[0], statement, plan))
+                except psycopg2.Error as e:
+                    captured.append((current_route[0], statement, {'error': str(e).strip()}))
+                finally:
+                    raw.execute('ROLLBACK TO SAVEPOINT explain_routes')
+                    raw.close()
+            return super().execute(query, vars)
+    return CapturingCursor
+
+
+class DryRunConnection(psycopg2.extensions.connection):
+    # route 用什麼 cursor_factory 都包一層；commit 一律改成 rollback
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.pop('cursor_factory', None) or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = capturing(factory)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        self.rollback()
+
+
+def pick_samples(conn):
+    cur = conn.cursor()
+    # 最新一篇貼文的發文者，跟一個不是他的、還有庫存的物品
+    cur.execute("""
+        SELECT p.user_id, p.post_id
+        FROM post p JOIN item i ON i.post_id = p.post_id
+        ORDER BY p.post_id DESC LIMIT 1
+    """)
+    user_id, post_id = cur.fetchone()
+    cur.execute("""
+        SELECT i.item_id, i.post_id
+        FROM item i JOIN post p ON i.post_id = p.post_id
+        WHERE i.quantity > 0 AND NOT i.expired AND i.expiration_date > NOW() AND p.user_id <> %s
+        ORDER BY i.item_id DESC LIMIT 1
+    """, (user_id,))
+    item_id, item_post_id = cur.fetchone()
+    cur.execute("SELECT category_id FROM categories ORDER BY category_id LIMIT 1")
+    category_id = cur.fetchone()[0]
+    cur.execute("SELECT username FROM account WHERE user_id = %s", (user_id,))
+    row = cur.fetchone()
+    cur.close()
+    return {
+        'user_id': user_id,
+        'post_id': post_id,
+        'item_id': item_id,
+        'item_post_id': item_post_id,
+        'category_id': category_id,
+        'username': row[0] if row else 'user1',
+        'profile_cursor': encode_cursor([datetime.datetime.now() - datetime.timedelta(days=30), 2 ** 31 - 1]),
+    }
+
+
+def route_calls(s):
+    # (route 名稱, 要不要登入, method, url, form)
+    return [
+        ('index post', False, 'GET', '/?view=post', None),
+        ('index post category', False, 'GET', f"/?view=post&category={s['category_id']}", None),
+        ('index post search', False, 'GET', '/?view=post&q=課本', None),
+        ('index item', False, 'GET', '/?view=item', None),
+        ('index item category', False, 'GET', f"/?view=item&category={s['category_id']}", None),
+        ('index item search', False, 'GET', '/?view=item&q=課本', None),
+        ('index item stream', False, 'GET', '/?view=item&stream=1', None),
+        # 找附近：新竹火車站附近 3 公里（沒跑過 migrations/012 的資料庫會退回一般的物品檢視）
+        ('index item near', False, 'GET', '/?view=item&lat=24.8016&lon=120.9716&radius=3', None),
+        ('public_profile', False, 'GET', f"/user/{s['user_id']}", None),
+        ('login', False, 'POST', '/login', {'username': s['username'], 'password': '1234'}),
+        ('register', False, 'POST', '/register', {
+            'name': 'explain', 'organization': 'x', 'username': 'explain_routes_user',
+            'pwd': 'x', 'confirm_pwd': 'x', 'phone': '0999999999'}),
+        ('profile', True, 'GET', '/profile', None),
+        # 個人頁面的第二頁：從一個月前開始，trade / comment 應該只會看那之前的分區
+        ('profile next page', True, 'GET', '/profile?' + '&'.join(
+            f'{name}_after={s["profile_cursor"]}' for name in ('claims', 'comments', 'posts')), None),
+        ('post_item form', True, 'GET', '/post_item', None),
+        ('post_item', True, 'POST', '/post_item', {
+            'description': 'explain', 'location_name': 'x', 'item_name': ['a', 'b'],
+            'quantity': ['1', '2'], 'category_id': [str(s['category_id'])] * 2}),
+        ('post_item_bulk', True, 'POST', '/post_item/bulk', {
+            'description': 'explain', 'location_name': 'x', 'category_id': str(s['category_id']),
+            'file': (io.BytesIO('name,quantity,location\na,1,x\nb,2,y\n'.encode()), 'items.csv')}),
+        ('claim', True, 'POST', f"/claim/{s['item_id']}", {'want_quantity': '1'}),
+        ('claim_batch', True, 'POST', '/claim_batch', {'item_id': [str(s['item_id'])], 'want_quantity': ['1']}),
+        ('add_comment form', True, 'GET', f"/add_comment/{s['item_post_id']}", None),
+        ('add_comment', True, 'POST', f"/add_comment/{s['item_post_id']}", {'rating': '5', 'comment_str': 'x'}),
+        ('add_phone', True, 'POST', '/add_phone', {'phone': '0999999998'}),
+        ('edit_name', True, 'POST', '/edit_name', {'name': 'explain'}),
+        ('change_pwd', True, 'POST', '/change_pwd', {'old_pwd': '1234', 'new_pwd': 'x', 'confirm_pwd': 'x'}),
+        ('delete_post', True, 'POST', f"/delete_post/{s['post_id']}", None),
+        ('delete_account', True, 'POST', '/delete_account', None),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='對 app.py 每個 route 用到的 SQL 做 EXPLAIN，找出 Seq Scan')
+    parser.add_argument('--realistic', action='store_true',
+                        help='不要關掉 seq scan，用資料庫目前的資料量看 planner 的選擇')
+    parser.add_argument('--min-rows', type=int, default=0,
+                        help='表格估計列數小於這個數字的 Seq Scan 不列出來（預設 0）')
+    parser.add_argument('--json', action='store_true', help='輸出 JSON')
+    args = parser.parse_args()
+    force_index[0] = not args.realistic
+
+    giveaway.db_pool = ConnectionPool(
+        minconn=1, maxconn=2,
+        connection_factory=DryRunConnection,
+        host=giveaway.DB_HOST, database=giveaway.DB_NAME, user=giveaway.DB_USER,
+        password=giveaway.DB_PASS, port=giveaway.DB_PORT,
+    )
+
+    # 登入時間的 buffer 在 import 的時候就拿了原本連線池的 connection，要換成用上面這個的，不然會真的寫進 account
+    # 背景不要自己寫（interval 設很長），最後手動寫一次，那條 UPDATE 也會 EXPLAIN 到
+    giveaway.lastlogin_buffer = LastLoginBuffer(giveaway.db_pool.connection, interval=3600)
+
+    conn = psycopg2.connect(host=giveaway.DB_HOST, database=giveaway.DB_NAME, user=giveaway.DB_USER,
+                            password=giveaway.DB_PASS, port=giveaway.DB_PORT)
+    samples = pick_samples(conn)
+    cur = conn.cursor()
+    cur.execute("SELECT relname, reltuples FROM pg_class WHERE relkind IN ('r', 'p', 'm')")
+    table_rows = {rel: max(rows, 0) for rel, rows in cur.fetchall()}   # 沒 ANALYZE 過的是 -1
+    conn.close()
+
+    # 快取關掉，每個 route 的 SQL 才會真的跑
+    giveaway.response_cache = ResponseCache(max_entries=0)
+    giveaway.categories_cache = ResponseCache(max_entries=0)
+    giveaway.facets_cache = ResponseCache(max_entries=0)
+    # 背景的過期下架、刪除不要開，不然它的 SQL 會算到剛好在跑的 route 上
+    # 刪除的 route 會 wake() 背景刪除，換成用上面那個連線池的，就算跑起來也只會 rollback
+    giveaway.EXPIRY_SWEEP_INTERVAL = 0
+    giveaway.PARTITION_CHECK_INTERVAL = 0
+    giveaway.PURGE_INTERVAL = 0
+    giveaway.purge_worker = PurgeWorker(giveaway.db_pool.connection, interval=0)
+
+    giveaway.app.testing = True
+    client = giveaway.app.test_client()
+    for name, login, method, url, form in route_calls(samples):
+        current_route[0] = name
+        with client.session_transaction() as sess:
+            sess.clear()
+            if login:
+                sess['user_id'] = samples['user_id']
+                sess['username'] = 'explain'
+        if method == 'GET':
+            client.get(url)
+        else:
+            client.post(url, data=form)
+    current_route[0] = 'login (lastlogin flush)'
+    giveaway.lastlogin_buffer.flush()
+
+    report = []
+    for route, statement, plan in captured:
+        if 'error' in plan:
+            report.append({'route': route, 'statement': statement, 'error': plan['error']})
+            continue
+        scans = [(rel, rows) for rel, rows in walk_plan(plan, [])
+                 if table_rows.get(rel, 0) >= args.min_rows and rel not in WHOLE_TABLE_READS]
+        if scans:
+            report.append({'route': route, 'statement': statement,
+                           'seq_scans': [{'table': rel, 'plan_rows': rows} for rel, rows in scans]})
+
+    if args.json:
+        print(json.dumps({'statements': len(captured), 'problems': report}, ensure_ascii=False, indent=2))
+    else:
+        print(f'共檢查 {len(captured)} 條 SQL，{len(report)} 條有問題\n')
+        for r in report:
+            print(f"[{r['route']}]")
+            print('    ' + ' '.join(r['statement'].split())[:200])
+            if 'error' in r:
+                print(f"    EXPLAIN 失敗：{r['error']}")
+            for scan in r.get('seq_scans', []):
+                print(f"    Seq Scan on {scan['table']} (估計 {scan['plan_rows']} 列)")
+            print()
+
+    sys.exit(1 if report else 0)
+
+
+if __name__ == '__main__':
+    main()
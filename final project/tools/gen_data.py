@@ -0,0 +1,315 @@
+# 產生大量假資料，用來測 app.py 在資料量大的時候會不會變慢
+#
+#   python tools/gen_data.py --users 1000000 --posts 3000000 --items 10000000 --trades 50000000
+#   python tools/gen_data.py --scale 0.001        # 上面那組的千分之一，快速試跑
+#
+# 用 COPY 一次灌進去，資料會接在現有資料後面（id 從目前最大值往後接），不會動到原本的資料。
+# 灌資料的時候用 session_replication_role = replica 暫時關掉 trigger 跟 foreign key 檢查，
+# 所以庫存、貼文上架狀態都是這支程式自己算好的，灌完會重設 sequence、重算 trigger 維護的計數並 ANALYZE。
+# 需要資料庫的 superuser（預設的 postgres 就是）。
+
+import argparse
+import bisect
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+import unicodedata
+from datetime import datetime, timedelta
+
+import psycopg2
+from werkzeug.security import generate_password_hash
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'giveaway_app'))
+
+import app as giveaway  # noqa: E402
+
+# 灌完要重算的、由 trigger 維護的資料（沒跑過對應 migration 的資料庫會跳過）
+REBUILDS = [
+    ('rebuild_stock_counters()', '庫存計數'),
+    ('rebuild_user_reputation()', '使用者評價'),
+    ('rebuild_browse_feed()', '首頁的 feed'),
+]
+
+SURNAMES = '陳林黃張李王吳劉蔡楊許鄭謝郭洪曾邱廖賴徐周葉蘇莊呂江何蕭羅高潘簡朱鍾彭游詹胡施沈余趙盧梁顏柯翁魏孫戴'
+GIVEN = '家怡雅冠志淑俊欣佩宗建郁柏佳承婷宏偉君明芬豪瑋翰廷琪傑涵慧強心憲穎輝軒倫筱彥萱佑靜哲儀信妤智美男蓉榮文'
+ORGS = ['NCTU', 'NYCU', 'NTHU', 'NTU', 'NCCU', 'TSMC', 'MediaTek', 'Google', 'Microsoft', 'ASUS',
+        'Acer', 'Realtek', 'Shopee', 'Line', 'Apple', 'Meta', 'Foodpanda', 'Uber', None]
+# (城市, 區, 街道, 這一區大概的中心經緯度)
+CITIES = [('新竹市', '東區', ['大學路', '光復路二段', '建功路', '金山街', '關新路', '食品路'], (24.786, 120.997)),
+          ('新竹市', '北區', ['中正路', '北大路', '西大路'], (24.812, 120.962)),
+          ('新竹縣', '竹北市', ['光明六路', '自強南路', '文興路'], (24.830, 121.010)),
+          ('台北市', '大安區', ['羅斯福路四段', '新生南路三段', '復興南路一段'], (25.026, 121.543)),
+          ('台中市', '西屯區', ['台灣大道四段', '福星路'], (24.178, 120.640)),
+          ('台南市', '東區', ['大學路', '長榮路三段'], (22.990, 120.222))]
+PLACES = ['圖書館', '學生活動中心', '宿舍大廳', '超商門口', '捷運站出口', '系館一樓', '校門口', '咖啡廳', '夜市入口', '停車場']
+WORDS = {
+    '教科書/參考書': ['微積分課本', '線性代數', '普通物理', '計算機概論', '資料結構', '演算法', '經濟學原理', '統計學'],
+    '筆記型電腦': ['MacBook Air', 'ThinkPad', 'ASUS ZenBook', 'Acer Swift', '二手筆電'],
+    '手機/平板': ['iPhone 手機殼', 'iPad 保護套', '舊手機', '平板支架', '充電線'],
+    '電腦周邊配件': ['機械鍵盤', '無線滑鼠', '螢幕', 'USB Hub', '耳機', '網路線'],
+    '攝影器材': ['腳架', '相機包', '記憶卡', '鏡頭保護鏡'],
+    '生活家電': ['電風扇', '吹風機', '電鍋', '除濕機', '延長線', '檯燈'],
+    '家具/寢具': ['書桌', '椅子', '床墊', '枕頭', '收納櫃', '衣架'],
+    '流行服飾': ['外套', 'T恤', '帽T', '牛仔褲', '系服'],
+    '鞋包/配件': ['後背包', '球鞋', '皮夾', '雨傘'],
+    '美妝/保養': ['化妝水', '乳液', '防曬乳', '面膜'],
+    '運動/戶外用品': ['羽球拍', '籃球', '瑜珈墊', '啞鈴', '帳篷'],
+    '電玩遊戲': ['Switch 遊戲片', 'PS5 手把', '桌遊'],
+    '票券/點數卡': ['電影票', '咖啡券', '演唱會門票'],
+    '文具/辦公用品': ['筆記本', '原子筆', '計算機', '文具組', '資料夾'],
+    '一般書籍/雜誌': ['小說', '漫畫', '雜誌', '旅遊書'],
+    '樂器': ['吉他', '烏克麗麗', '電子琴', '譜架'],
+    '機車/腳踏車': ['腳踏車', '安全帽', '車鎖', '機車雨衣'],
+    '寵物用品': ['貓砂', '飼料', '寵物提籠', '逗貓棒'],
+    '手作/設計小物': ['貼紙', '明信片', '鑰匙圈', '手作卡片'],
+    '其他': ['紙箱', '衣架', '保鮮盒', '雜物'],
+}
+DESCRIPTIONS = ['期末清倉，全部帶走優先', '搬家帶不走，需自取', '畢業大出清', '用不到了，送給需要的人',
+                '多買了一份', '九成新，功能正常', '宿舍整理出來的', '換新的了，舊的送人']
+
+
+def address_key(*fields):
+    # 跟 schema.sql 的 normalize_address() 一樣的正規化
+    return '\x1f'.join(''.join(unicodedata.normalize('NFKC', f).split()) for f in fields).replace('臺', '台').lower()
+
+
+class ZipfChooser:
+    # 越前面的選項越常被選到，用來模擬熱門分類、熱門地點、活躍使用者
+    def __init__(self, n, s):
+        weights = [1.0 / (k ** s) for k in range(1, n + 1)]
+        self.cum = list(itertools.accumulate(weights))
+        self.total = self.cum[-1]
+
+    def __call__(self, rng):
+        return bisect.bisect_left(self.cum, rng.random() * self.total)
+
+
+class CopyStream:
+    # 讓 copy_expert 一邊產生資料一邊讀，不用先全部放在記憶體
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.buf = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            try:
+                self.buf += next(self.lines).encode()
+            except StopIteration:
+                break
+        if size < 0:
+            data, self.buf = self.buf, b''
+        else:
+            data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    readline = read
+
+
+def esc(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', ' ').replace('\n', ' ')
+
+
+def line(*values):
+    return '\t'.join(esc(v) for v in values) + '\n'
+
+
+def copy(cur, table, columns, lines):
+    start = time.perf_counter()
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", CopyStream(lines))
+    print(f'  {table}: {cur.rowcount} 列，{time.perf_counter() - start:.1f} 秒')
+
+
+def max_id(cur, table, column):
+    cur.execute(f'SELECT COALESCE(MAX({column}), 0) FROM {table}')
+    return cur.fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='用 COPY 產生大量假資料')
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--locations', type=int, default=20_000)
+    parser.add_argument('--posts', type=int, default=3_000_000)
+    parser.add_argument('--items', type=int, default=10_000_000)
+    parser.add_argument('--trades', type=int, default=50_000_000)
+    parser.add_argument('--comments', type=int, default=5_000_000)
+    parser.add_argument('--scale', type=float, default=1.0, help='上面每個數量都乘上這個倍率')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf 指數，越大越集中在熱門的分類/地點/使用者')
+    parser.add_argument('--days', type=int, default=730, help='貼文時間分布在過去幾天內')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    n = {k: max(1, int(getattr(args, k) * args.scale))
+         for k in ('users', 'locations', 'posts', 'items', 'trades', 'comments')}
+    rng = random.Random(args.seed)
+    now = datetime.now().replace(microsecond=0)
+
+    conn = psycopg2.connect(host=giveaway.DB_HOST, database=giveaway.DB_NAME, user=giveaway.DB_USER,
+                            password=giveaway.DB_PASS, port=giveaway.DB_PORT)
+    cur = conn.cursor()
+    cur.execute("SET session_replication_role = replica")
+
+    # 跑過 migrations/009 的資料庫：已經過期的物品直接標成 expired，不算庫存
+    cur.execute("SELECT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name = 'item' AND column_name = 'expired')")
+    has_expired = cur.fetchone()[0]
+
+    # 跑過 migrations/010 的資料庫：先建好這次資料會用到的月份分區，不然 trade / comment 全部會灌進 default 分區
+    cur.execute("SELECT to_regprocedure('create_month_partition(text, text, date)') IS NOT NULL")
+    if cur.fetchone()[0]:
+        cur.execute("""
+            SELECT create_month_partition(v.tbl, v.col, m::date)
+            FROM (VALUES ('trade', 'trade_time'), ('comment', 'comment_time')) AS v(tbl, col),
+                 generate_series(date_trunc('month', %s::timestamp), %s::timestamp, interval '1 month') AS m
+        """, (now - timedelta(days=args.days), now))
+
+    cur.execute("SELECT category_id, name FROM categories ORDER BY category_id")
+    categories = cur.fetchall()
+    if not categories:
+        cur.execute("INSERT INTO categories (name) SELECT unnest(%s::text[]) RETURNING category_id, name",
+                    (list(WORDS),))
+        categories = cur.fetchall()
+    rng.shuffle(categories)
+    pick_category = ZipfChooser(len(categories), args.skew)
+
+    user0 = max_id(cur, 'users', 'user_id')
+    loc0 = max_id(cur, 'location', 'location_id')
+    post0 = max_id(cur, 'post', 'post_id')
+    item0 = max_id(cur, 'item', 'item_id')
+    trade0 = max_id(cur, 'trade', 'trade_id')
+    comment0 = max_id(cur, 'comment', 'comment_id')
+    if user0 + n['users'] >= 10_000_000:
+        sys.exit('使用者 id 超過 10,000,000，電話號碼會重複')
+
+    print(f"產生資料：{n}")
+
+    # users / account / phone
+    pwd = generate_password_hash('1234')   # 全部共用一個 hash，密碼都是 1234
+    orgs = ZipfChooser(len(ORGS), args.skew)
+    copy(cur, 'users', ['user_id', 'name', 'organization'],
+         (line(user0 + k, rng.choice(SURNAMES) + rng.choice(GIVEN) + rng.choice(GIVEN), ORGS[orgs(rng)])
+          for k in range(1, n['users'] + 1)))
+    copy(cur, 'account', ['user_id', 'username', 'pwd', 'lastlogin'],
+         (line(user0 + k, f'gen{user0 + k}', pwd, now - timedelta(seconds=rng.randrange(args.days * 86400)))
+          for k in range(1, n['users'] + 1)))
+    copy(cur, 'phone', ['phone_number', 'user_id'],
+         (line(f'09{90000000 + user0 + k}', user0 + k) for k in range(1, n['users'] + 1)))
+
+    # 跑過 migrations/012 的資料庫：地點加上經緯度，散在那一區的中心附近（標準差大約 2 公里）
+    cur.execute("SELECT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name = 'location' AND column_name = 'lat')")
+    has_coordinates = cur.fetchone()[0]
+
+    # 跑過 migrations/013 的資料庫：一樣的地址只能有一筆，抽到重複的就在門牌後面加「之2」「之3」…
+    cur.execute("SELECT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name = 'location' AND column_name = 'address_key')")
+    used_addresses = None
+    if cur.fetchone()[0]:
+        cur.execute("SELECT address_key FROM location")
+        used_addresses = {row[0] for row in cur.fetchall()}
+
+    def location_rows():
+        for k in range(1, n['locations'] + 1):
+            city, district, streets, (lat, lon) = CITIES[min(int(rng.expovariate(0.8)), len(CITIES) - 1)]
+            values = [loc0 + k, rng.choice(PLACES), city, district, rng.choice(streets), f'{rng.randint(1, 500)}號']
+            if used_addresses is not None:
+                number, suffix = values[5], 1
+                while address_key(*values[1:6]) in used_addresses:
+                    suffix += 1
+                    values[5] = f'{number}之{suffix}'
+                used_addresses.add(address_key(*values[1:6]))
+            if has_coordinates:
+                values += [round(rng.gauss(lat, 0.018), 6), round(rng.gauss(lon, 0.02), 6)]
+            yield line(*values)
+    copy(cur, 'location', ['location_id', 'location_name', 'city', 'district', 'street', 'number']
+         + (['lat', 'lon'] if has_coordinates else []), location_rows())
+
+    # post / item / trade / comment 一起算：item.quantity 是被索取完剩下的庫存，
+    # 貼文上架狀態 = 還有沒有物品有庫存，item 跟 trade 先寫到暫存檔，post 灌完再灌
+    pick_user = ZipfChooser(n['users'], args.skew)
+    pick_location = ZipfChooser(n['locations'], args.skew)
+    trades_per_item = n['trades'] / n['items']
+    comment_rate = min(1.0, n['comments'] / n['trades'])
+
+    item_file = tempfile.TemporaryFile('w+', encoding='utf-8')
+    trade_file = tempfile.TemporaryFile('w+', encoding='utf-8')
+    comment_file = tempfile.TemporaryFile('w+', encoding='utf-8')
+    counts = {'item': 0, 'trade': 0, 'comment': 0}
+
+    def post_rows():
+        item_id, trade_id, comment_id = item0, trade0, comment0
+        for k in range(1, n['posts'] + 1):
+            post_id = post0 + k
+            owner = user0 + 1 + pick_user(rng)
+            post_time = now - timedelta(seconds=rng.randrange(args.days * 86400))
+            location_id = loc0 + 1 + pick_location(rng)
+            # 平均每篇貼文 items/posts 個物品，總數到了就不再產生
+            n_items = min(n['items'] - counts['item'],
+                          max(1, round(rng.expovariate(1 / (n['items'] / n['posts'])))))
+            in_stock = False
+            commenters = set()
+            for _ in range(n_items):
+                item_id += 1
+                category_id, category_name = categories[pick_category(rng)]
+                name = rng.choice(WORDS.get(category_name, WORDS['其他']))
+                n_trades = int(rng.expovariate(1 / trades_per_item)) if trades_per_item > 0 else 0
+                left_trades = n['trades'] - counts['trade']
+                n_trades = min(n_trades, left_trades)
+                for _ in range(n_trades):
+                    trade_id += 1
+                    qty = 1 if rng.random() < 0.8 else rng.randint(2, 3)
+                    claimer = user0 + 1 + pick_user(rng)
+                    trade_time = post_time + timedelta(seconds=rng.randrange(1, 14 * 86400))
+                    trade_file.write(line(trade_id, claimer, item_id, qty, min(trade_time, now)))
+                    counts['trade'] += 1
+                    if claimer not in commenters and claimer != owner and rng.random() < comment_rate:
+                        commenters.add(claimer)
+                        comment_id += 1
+                        rating = min(5, max(0, int(rng.gauss(4.3, 0.9) + 0.5)))
+                        comment_file.write(line(comment_id, post_id, claimer, rating, '謝謝！東西很好',
+                                                min(trade_time + timedelta(hours=rng.randint(1, 72)), now)))
+                        counts['comment'] += 1
+                left_qty = 0 if rng.random() < 0.3 else rng.randint(1, 5)
+                expiration = post_time + timedelta(days=rng.randint(7, 60))
+                expired = left_qty > 0 and expiration <= now
+                in_stock = in_stock or (left_qty > 0 and not (has_expired and expired))
+                values = [item_id, category_id, post_id, location_id, name, expiration, left_qty]
+                item_file.write(line(*values, expired) if has_expired else line(*values))
+                counts['item'] += 1
+            yield line(post_id, owner, f'{rng.choice(DESCRIPTIONS)} {name}', post_time, in_stock)
+
+    copy(cur, 'post', ['post_id', 'user_id', 'description', 'post_time', 'available'], post_rows())
+    for f, table, columns in [
+        (item_file, 'item', ['item_id', 'category_id', 'post_id', 'location_id', 'item_name', 'expiration_date', 'quantity']
+                            + (['expired'] if has_expired else [])),
+        (trade_file, 'trade', ['trade_id', 'user_id', 'item_id', 'quantity', 'trade_time']),
+        (comment_file, 'comment', ['comment_id', 'post_id', 'user_id', 'rating', 'comment_str', 'comment_time']),
+    ]:
+        f.seek(0)
+        copy(cur, table, columns, f)
+        f.close()
+
+    cur.execute("SET session_replication_role = DEFAULT")
+    for table, column in [('users', 'user_id'), ('location', 'location_id'), ('post', 'post_id'),
+                          ('item', 'item_id'), ('trade', 'trade_id'), ('comment', 'comment_id'),
+                          ('categories', 'category_id')]:
+        cur.execute(f"SELECT setval(pg_get_serial_sequence('{table}', '{column}'), (SELECT MAX({column}) FROM {table}))")
+
+    # 灌資料的時候 trigger 沒跑，trigger 維護的計數要整個重算
+    for function, label in REBUILDS:
+        cur.execute("SELECT to_regprocedure(%s) IS NOT NULL", (function,))
+        if cur.fetchone()[0]:
+            print(f'重算{label} ...')
+            cur.execute(f"SELECT * FROM {function}")
+    conn.commit()
+
+    conn.autocommit = True
+    print('ANALYZE ...')
+    cur.execute('ANALYZE')
+    conn.close()
+    print('完成')
+
+
+if __name__ == '__main__':
+    main()